@@ -0,0 +1,105 @@
+# Copyright 2013-2017 The Salish Sea MEOPAR Contributors
+# and The University of British Columbia
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark of the deflate sub-command backends.
+
+Reports the throughput and compression ratio of the nccopy and netcdf4
+deflation backends side by side on a set of FVCOM-like results files.
+
+The nccopy backend is skipped if :program:`nccopy` is not on
+:envvar:`PATH`.
+
+Usage:
+
+.. code-block:: bash
+
+    $ python benchmarks/deflate_backends.py --files 8 --jobs 4
+"""
+import argparse
+import shutil
+import tempfile
+try:
+    from pathlib import Path
+except ImportError:
+    # Python 2.7
+    from pathlib2 import Path
+
+import netCDF4
+import numpy
+
+from fvcom_cmd import deflate
+from fvcom_cmd.fspath import fspath
+
+
+def make_files(tmp_dir, n_files, n_times, n_nodes, n_layers=10):
+    """Create n_files netCDF-3 files with FVCOM-like 2D and 3D fields.
+    """
+    filepaths = []
+    for i in range(n_files):
+        filepath = tmp_dir / 'results_{:04d}.nc'.format(i)
+        with netCDF4.Dataset(
+            fspath(filepath), 'w', format='NETCDF3_64BIT_OFFSET'
+        ) as ds:
+            ds.createDimension('time', None)
+            ds.createDimension('siglay', n_layers)
+            ds.createDimension('node', n_nodes)
+            time_ = ds.createVariable('time', 'f4', ('time', ))
+            x = ds.createVariable('x', 'f4', ('node', ))
+            zeta = ds.createVariable('zeta', 'f4', ('time', 'node'))
+            temp = ds.createVariable('temp', 'f4', ('time', 'siglay', 'node'))
+            x[:] = numpy.linspace(0, 1e5, n_nodes)
+            for t in range(n_times):
+                time_[t] = t / 24
+                zeta[t] = numpy.sin(x[:] / 1e4 + t).astype('f4')
+                temp[t] = (
+                    10 + numpy.random.random_sample((n_layers, n_nodes))
+                ).astype('f4')
+        filepaths.append(filepath)
+    return filepaths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=8)
+    parser.add_argument('--times', type=int, default=24)
+    parser.add_argument('--nodes', type=int, default=20000)
+    parser.add_argument('--jobs', type=int, default=4)
+    args = parser.parse_args()
+    tmp_dir = Path(tempfile.mkdtemp())
+    try:
+        for backend in deflate.BACKENDS:
+            if backend == 'nccopy' and shutil.which('nccopy') is None:
+                print('{:>8}: skipped; nccopy not found'.format(backend))
+                continue
+            filepaths = make_files(
+                tmp_dir, args.files, args.times, args.nodes
+            )
+            report = deflate.deflate(filepaths, args.jobs, backend=backend)
+            print(
+                '{backend:>8}: {mb:.1f} MB in {t:.2f} s = {rate:.1f} MB/s, '
+                'compression ratio {ratio:.2f}, CPU time {cpu:.2f} s'.format(
+                    backend=backend,
+                    mb=report.in_bytes / 1e6,
+                    t=report.wall_time,
+                    rate=report.throughput / 1e6,
+                    ratio=report.compression_ratio,
+                    cpu=report.cpu_time
+                )
+            )
+    finally:
+        shutil.rmtree(fspath(tmp_dir))
+
+
+if __name__ == '__main__':
+    main()
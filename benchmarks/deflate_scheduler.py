@@ -0,0 +1,123 @@
+# Copyright 2013-2017 The Salish Sea MEOPAR Contributors
+# and The University of British Columbia
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark of the deflate sub-command job scheduler.
+
+Compares the total wall time to deflate many small netCDF files using the
+event-driven scheduler in :func:`fvcom_cmd.deflate.deflate` with that of
+the 1 second sleep polling loop that it replaced.
+
+Requires :program:`nccopy` on :envvar:`PATH`,
+and the netCDF4 package to create the test files.
+
+Usage:
+
+.. code-block:: bash
+
+    $ python benchmarks/deflate_scheduler.py --files 200 --jobs 4
+"""
+import argparse
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
+try:
+    from pathlib import Path
+except ImportError:
+    # Python 2.7
+    from pathlib2 import Path
+
+import netCDF4
+import numpy
+
+from fvcom_cmd import deflate
+from fvcom_cmd.fspath import fspath
+
+
+def make_files(tmp_dir, n_files, n_nodes):
+    """Create n_files netCDF-3 files with a single time-series variable.
+    """
+    filepaths = []
+    for i in range(n_files):
+        filepath = tmp_dir / 'small_{:04d}.nc'.format(i)
+        with netCDF4.Dataset(
+            fspath(filepath), 'w', format='NETCDF3_64BIT_OFFSET'
+        ) as ds:
+            ds.createDimension('time', None)
+            ds.createDimension('node', n_nodes)
+            temp = ds.createVariable('temp', 'f4', ('time', 'node'))
+            temp[0:4, :] = numpy.random.random_sample((4, n_nodes))
+        filepaths.append(filepath)
+    return filepaths
+
+
+def polling_deflate(filepaths, max_concurrent_jobs):
+    """The scheduler that :func:`fvcom_cmd.deflate.deflate` replaced:
+    launch up to max_concurrent_jobs nccopy processes,
+    then sleep 1 second between polls for finished processes.
+    """
+    pending = list(filepaths)
+    running = {}
+
+    def launch():
+        filepath = pending.pop(0)
+        cmd = 'nccopy -s -4 -d4 {0} {0}.nccopy.tmp'.format(filepath)
+        process = subprocess.Popen(
+            shlex.split(cmd),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True
+        )
+        running[process.pid] = (process, filepath)
+
+    while pending and len(running) < max_concurrent_jobs:
+        launch()
+    while pending or running:
+        time.sleep(1)
+        for pid, (process, filepath) in running.copy().items():
+            if process.poll() is not None:
+                process.communicate()
+                Path('{}.nccopy.tmp'.format(filepath)).rename(filepath)
+                running.pop(pid)
+                if pending:
+                    launch()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--nodes', type=int, default=1000)
+    parser.add_argument('--jobs', type=int, default=4)
+    args = parser.parse_args()
+    tmp_dir = Path(tempfile.mkdtemp())
+    try:
+        for name, scheduler in (
+            ('1s polling', polling_deflate),
+            ('event-driven', deflate.deflate),
+        ):
+            filepaths = make_files(tmp_dir, args.files, args.nodes)
+            t_start = time.time()
+            scheduler(filepaths, args.jobs)
+            wall_time = time.time() - t_start
+            print(
+                '{name:>14}: {n} files, {jobs} jobs, {t:.2f} s wall time'.
+                format(name=name, n=args.files, jobs=args.jobs, t=wall_time)
+            )
+    finally:
+        shutil.rmtree(fspath(tmp_dir))
+
+
+if __name__ == '__main__':
+    main()
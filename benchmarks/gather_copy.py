@@ -0,0 +1,129 @@
+# Copyright 2013-2017 The Salish Sea MEOPAR Contributors
+# and The University of British Columbia
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark of the gather sub-command file copy methods.
+
+Reports the throughput of each of the ways that
+:func:`fvcom_cmd.gather.gather` can copy files into a results directory
+(hard link, reflink, :func:`os.copy_file_range`, :func:`os.sendfile`,
+and buffered copy) on a set of large FVCOM-like results files.
+Methods that aren't supported between the run and results file systems
+are reported as such.
+
+Give a --results-dir on a different file system from --run-dir,
+e.g. project storage and scratch storage,
+to measure the cross-device methods;
+the page cache is not dropped between methods.
+
+Usage:
+
+.. code-block:: bash
+
+    $ python benchmarks/gather_copy.py --files 4 --times 48 \\
+        --run-dir /scratch/$USER --results-dir /project/$USER
+"""
+import argparse
+import os
+import shutil
+import tempfile
+try:
+    from pathlib import Path
+except ImportError:
+    # Python 2.7
+    from pathlib2 import Path
+
+import netCDF4
+import numpy
+
+from fvcom_cmd import gather
+from fvcom_cmd.fspath import fspath
+
+
+def make_files(tmp_dir, n_files, n_times, n_nodes, n_layers=10):
+    """Create n_files netCDF-3 files with FVCOM-like 2D and 3D fields.
+    """
+    filepaths = []
+    for i in range(n_files):
+        filepath = tmp_dir / 'results_{:04d}.nc'.format(i)
+        with netCDF4.Dataset(
+            fspath(filepath), 'w', format='NETCDF3_64BIT_OFFSET'
+        ) as ds:
+            ds.createDimension('time', None)
+            ds.createDimension('siglay', n_layers)
+            ds.createDimension('node', n_nodes)
+            time_ = ds.createVariable('time', 'f4', ('time', ))
+            temp = ds.createVariable('temp', 'f4', ('time', 'siglay', 'node'))
+            for t in range(n_times):
+                time_[t] = t / 24
+                temp[t] = (
+                    10 + numpy.random.random_sample((n_layers, n_nodes))
+                ).astype('f4')
+        filepaths.append(filepath)
+    return filepaths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--times', type=int, default=48)
+    parser.add_argument('--nodes', type=int, default=100000)
+    parser.add_argument('--run-dir', type=Path, default=None)
+    parser.add_argument('--results-dir', type=Path, default=None)
+    args = parser.parse_args()
+    run_dir = Path(tempfile.mkdtemp(dir=args.run_dir and fspath(args.run_dir)))
+    results_dir = Path(
+        tempfile.mkdtemp(dir=args.results_dir and fspath(args.results_dir))
+    )
+    cwd = os.getcwd()
+    try:
+        templates = make_files(run_dir, args.files, args.times, args.nodes)
+        os.chdir(fspath(run_dir))
+        for method in gather.COPY_METHODS:
+            work_dir = run_dir / method
+            work_dir.mkdir()
+            srcs = []
+            for template in templates:
+                srcs.append(work_dir / template.name)
+                shutil.copy2(fspath(template), fspath(srcs[-1]))
+            dst_dir = results_dir / method
+            dst_dir.mkdir()
+            try:
+                moves = [
+                    gather._copy_file(src, dst_dir / src.name, (method, ))
+                    for src in srcs
+                ]
+            except OSError as exc:
+                print('{:>15}: not supported; {}'.format(method, exc))
+                continue
+            report = gather.GatherReport(
+                moves, sum(move.wall_time for move in moves)
+            )
+            print(
+                '{method:>15}: {mb:.1f} MB in {t:.2f} s = {rate:.1f} MB/s'.
+                format(
+                    method=method,
+                    mb=report.copied_bytes / 1e6,
+                    t=report.wall_time,
+                    rate=report.throughput / 1e6
+                )
+            )
+            shutil.rmtree(fspath(dst_dir))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(fspath(run_dir))
+        shutil.rmtree(fspath(results_dir))
+
+
+if __name__ == '__main__':
+    main()
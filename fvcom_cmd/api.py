@@ -32,9 +32,13 @@ import subprocess
 import cliff.commandmanager
 import yaml
 
+from fvcom_cmd import expanded_path
+from fvcom_cmd import dedup as dedup_plugin
 from fvcom_cmd import deflate as deflate_plugin
 from fvcom_cmd import gather as gather_plugin
+from fvcom_cmd import pack as pack_plugin
 from fvcom_cmd import prepare as prepare_plugin
+from fvcom_cmd import verify as verify_plugin
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
@@ -45,9 +49,27 @@ handler.setFormatter(formatter)
 log.addHandler(handler)
 
 
-def deflate(filepaths, max_concurrent_jobs):
+def deflate(
+    filepaths,
+    max_concurrent_jobs=None,
+    backend='nccopy',
+    split_large=False,
+    priorities=None,
+    force=False,
+    scratch_dir=None,
+    profile_dir=None,
+    codec='zlib',
+    dfl_lvl=4,
+    shuffle=True,
+    keep_bits=None,
+    keep_digits=None,
+    verify_samples=0,
+    json_report=False,
+    process_priority=None
+):
     """Deflate variables in each of the netCDF files in filepaths using
-    Lempel-Ziv compression.
+    Lempel-Ziv compression,
+    or another compression codec.
 
     Converts files to netCDF-4 format.
     The deflated file replaces the original file.
@@ -56,17 +78,163 @@ def deflate(filepaths, max_concurrent_jobs):
 
     :param int max_concurrent_jobs: Maximum number of concurrent deflation
                                     processes allowed.
+                                    If it is :py:obj:`None` the number of
+                                    concurrent processes is adapted to the
+                                    measured throughput,
+                                    up to the number of CPUs that the CPU
+                                    affinity and cgroup CPU quota of the
+                                    process allow.
+
+    :param str backend: Deflation engine to use:
+                        :kbd:`nccopy` runs :program:`nccopy` in a
+                        sub-process for each file;
+                        :kbd:`netcdf4` deflates the files in-process.
+
+    :param boolean split_large: Deflate zlib files of 1 GB or more
+                                in-process when the backend is
+                                :kbd:`nccopy`,
+                                so that their chunks are compressed in
+                                parallel;
+                                those jobs can't be killed when they time
+                                out.
+
+    :param dict priorities: Mapping of glob patterns to integer priorities
+                            for the files whose names match them;
+                            e.g. :kbd:`{'*restart*.nc': 1}`.
+                            Files with higher priority are deflated first,
+                            and larger files first within a priority.
+
+    :param boolean force: Deflate files even if they are recorded as
+                          deflated by a previous run,
+                          or their headers show that they are already
+                          deflated.
+
+    :param scratch_dir: Directory on fast local storage,
+                        e.g. :envvar:`TMPDIR` or :file:`/dev/shm`,
+                        in which to write the temporary deflated files before
+                        copying them back beside the original files.
+    :type scratch_dir: :py:class:`pathlib.Path` or str
+
+    :param profile_dir: Directory of per-variable deflation profiles created
+                        by :py:func:`fvcom_cmd.api.tune_deflate` that are
+                        applied when deflating with zlib;
+                        defaults to :file:`~/.fvcom-cmd/deflate-profiles`.
+    :type profile_dir: :py:class:`pathlib.Path` or str
+
+    :param str codec: Compression codec to use:
+                      :kbd:`zlib`, :kbd:`zstd`, :kbd:`bzip2`,
+                      or one of the Blosc codecs,
+                      e.g. :kbd:`blosc_lz4`.
+                      Codecs other than zlib require the corresponding HDF5
+                      filter plugin;
+                      files compressed with them are read back before they
+                      replace the original files.
+
+    :param int dfl_lvl: Compression level to use; 0 means no compression.
+
+    :param boolean shuffle: Shuffle the bytes of the values before
+                            compression;
+                            applies to the zlib and Blosc codecs.
+
+    :param dict keep_bits: Mapping of glob patterns of variable names to the
+                           number of significant mantissa bits to round the
+                           values of the floating point variables whose
+                           names match them to before compression;
+                           e.g. :kbd:`{'temp': 10}`.
+                           This lossy quantization is recorded in the
+                           variable attributes.
+                           Requires the netcdf4 backend.
+
+    :param dict keep_digits: Like keep_bits,
+                             with the precision given as a number of
+                             significant decimal digits.
+
+    :param int verify_samples: Before each deflated file replaces its
+                               original,
+                               compare their metadata and the values in
+                               this many randomly chosen hyperslabs of each
+                               variable;
+                               files that don't match are left undeflated.
+                               0 means no verification.
+
+    :param boolean json_report: Write the returned statistics as JSON to
+                                :file:`fvc_deflate_report.json` in the
+                                directory that contains filepaths.
+
+    :param process_priority: Niceness, I/O scheduling class, and CPUs to
+                             run the deflation with.
+    :type process_priority:
+        :py:class:`fvcom_cmd.process_priority.ProcessPriority`
+
+    :returns: Statistics of the batch: the total input and output bytes,
+              compression ratio, throughput, CPU time, peak RSS,
+              and verification time,
+              and the same statistics for each file.
+    :rtype: :py:class:`fvcom_cmd.deflate.DeflateReport`
+
+    :raises: :py:exc:`ValueError` if the HDF5 filter for codec is not
+             available,
+             quantization is requested with the nccopy backend,
+             or verification is requested without the netCDF4 package.
     """
-    try:
-        return deflate_plugin.deflate(filepaths, max_concurrent_jobs)
-    except AttributeError:
-        # filepaths is sequence of path strings not Path objects
-        return deflate_plugin.deflate(
-            map(Path, filepaths), max_concurrent_jobs
-        )
+    return deflate_plugin.deflate(
+        [Path(fp) for fp in filepaths],
+        max_concurrent_jobs,
+        backend=backend,
+        split_large=split_large,
+        priorities=priorities,
+        force=force,
+        scratch_dir=scratch_dir,
+        profile_dir=expanded_path(
+            profile_dir or deflate_plugin.ncdeflate.PROFILE_DIR
+        ),
+        codec=codec,
+        dfl_lvl=dfl_lvl,
+        shuffle=shuffle,
+        quantize=deflate_plugin.quantize_settings(
+            (keep_bits or {}).items(), (keep_digits or {}).items()
+        ),
+        verify_samples=verify_samples,
+        json_report=json_report,
+        process_priority=process_priority
+    )
+
+
+def tune_deflate(filepaths, profile_dir=None):
+    """Calculate and store a per-variable deflation profile for each of the
+    netCDF files in filepaths.
+
+    The variables in each file are sampled to find the compression level and
+    shuffle setting that give close to the best compression ratio for the
+    least CPU time.
+    The profile is applied to files produced by the same model configuration
+    when they are deflated with zlib.
 
+    :param sequence filepaths: Paths/names of files to tune on.
 
-def gather(results_dir):
+    :param profile_dir: Directory in which to store the profiles;
+                        defaults to :file:`~/.fvcom-cmd/deflate-profiles`.
+    :type profile_dir: :py:class:`pathlib.Path` or str
+
+    :returns: Paths/names of the profile files.
+    :rtype: list
+    """
+    return deflate_plugin.tune(
+        [Path(fp) for fp in filepaths],
+        expanded_path(profile_dir or deflate_plugin.ncdeflate.PROFILE_DIR)
+    )
+
+
+def gather(
+    results_dir,
+    process_priority=None,
+    max_threads=gather_plugin.GATHER_THREADS,
+    deflate=False,
+    manifest=False,
+    bandwidth=None,
+    pack_threshold=None,
+    dedup=False
+):
     """Move all of the files and directories from the present working directory
     into results_dir.
 
@@ -77,8 +245,83 @@ def gather(results_dir):
     :param results_dir: Path of the directory into which to store the run
                         results.
     :type results_dir: :py:class:`pathlib.Path`
+
+    :param process_priority: Niceness, I/O scheduling class, and CPUs to
+                             run the gathering with.
+    :type process_priority:
+        :py:class:`fvcom_cmd.process_priority.ProcessPriority`
+
+    :param int max_threads: Maximum number of files to copy concurrently
+                            when results_dir is on a different file system
+                            from the present working directory.
+
+    :param boolean deflate: Deflate the netCDF files into results_dir in a
+                            single pass instead of moving them.
+
+    :param boolean manifest: Write a checksum manifest of results_dir for
+                             :py:func:`verify`,
+                             hashing the files as they are copied.
+
+    :param float bandwidth: Maximum total rate in bytes per second at which
+                            to copy files to a results_dir on a different
+                            file system;
+                            :py:obj:`None` means unlimited.
+
+    :param int pack_threshold: Size in bytes below which files are packed
+                               into a single archive in results_dir that
+                               :py:func:`read_packed` reads them from;
+                               :py:obj:`None` means don't pack.
+
+    :param boolean dedup: Hard-link the files in results_dir to the objects
+                          with the same contents in the content-addressed
+                          store in the parent directory of results_dir;
+                          see :py:func:`dedup`.
+
+    :returns: Throughput statistics of the gather and of each file copied.
+    :rtype: :py:class:`fvcom_cmd.gather.GatherReport`
     """
-    return gather_plugin.gather(results_dir)
+    return gather_plugin.gather(
+        results_dir, process_priority, max_threads, deflate, manifest,
+        bandwidth, pack_threshold, dedup
+    )
+
+
+def dedup(
+    results_root,
+    results_dirs=(),
+    gc=False,
+    max_threads=dedup_plugin.DEDUP_THREADS
+):
+    """Deduplicate results directories against the content-addressed store
+    in results_root,
+    and report the space saved by the store.
+
+    :param results_root: Path of the directory of results directories that
+                         holds the store.
+    :type results_root: :py:class:`pathlib.Path`
+
+    :param results_dirs: Paths of results directories to deduplicate.
+    :type results_dirs: list
+
+    :param boolean gc: Delete the objects in the store that no results file
+                       is linked to.
+
+    :param int max_threads: Maximum number of files to read concurrently.
+
+    :returns: Space used and saved by the store.
+    :rtype: :py:class:`fvcom_cmd.dedup.StoreReport`
+    """
+    store = dedup_plugin.store_dir(results_root)
+    for results_dir in results_dirs:
+        dedup_plugin.dedup(
+            Path(results_dir),
+            store,
+            verify_plugin.checksum_algorithm(),
+            max_threads=max_threads
+        )
+    if gc:
+        dedup_plugin.collect_garbage(store)
+    return dedup_plugin.store_report(store)
 
 
 def prepare(run_desc_file, nocheck_init=False):
@@ -107,6 +350,45 @@ def prepare(run_desc_file, nocheck_init=False):
     return prepare_plugin.prepare(run_desc_file, nocheck_init)
 
 
+def verify(results_dir, max_threads=verify_plugin.VERIFY_THREADS):
+    """Check the files in results_dir against the checksum manifest written
+    by :py:func:`gather`.
+
+    :param results_dir: Path of the directory of gathered results.
+    :type results_dir: :py:class:`pathlib.Path`
+
+    :param int max_threads: Maximum number of files to read concurrently.
+
+    :returns: Files that are missing or have changed,
+              and files that aren't in the manifest.
+    :rtype: :py:class:`fvcom_cmd.verify.VerifyReport`
+    """
+    return verify_plugin.verify(Path(results_dir), max_threads)
+
+
+def read_packed(results_dir, path):
+    """Return the contents of a file that :py:func:`gather` packed into
+    the archive in results_dir,
+    without unpacking the other files.
+
+    Use :py:class:`fvcom_cmd.pack.PackedFiles` to read several files,
+    or to stream a large one.
+
+    :param results_dir: Path of the directory of gathered results.
+    :type results_dir: :py:class:`pathlib.Path`
+
+    :param path: Path of the file relative to the run directory,
+                 e.g. :file:`output/casename_station_timeseries.nc`.
+    :type path: :py:class:`pathlib.Path` or str
+
+    :rtype: bytes
+
+    :raises: :py:exc:`KeyError` if the file isn't in the archive.
+    """
+    with pack_plugin.PackedFiles(results_dir) as packed:
+        return packed.read(path)
+
+
 def run_in_subprocess(run_id, run_desc, results_dir):
     """Execute `fvcom run` in a subprocess.
 
@@ -0,0 +1,478 @@
+# Copyright 2013-2017 The Salish Sea MEOPAR Contributors
+# and The University of British Columbia
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""FVCOM-Cmd command plug-in for dedup sub-command.
+
+Deduplicate the files of results directories against a content-addressed
+store.
+
+Consecutive runs and ensemble members produce many byte-identical files,
+like static grid variables,
+copied namelists,
+and station files.
+The store is a :py:data:`STORE_DIR` directory in the results root,
+the directory of the results directories,
+that holds one object file for each distinct file content,
+named by its checksum.
+Each results file is hard-linked to the object with its checksum,
+so identical files share their data blocks,
+whichever run they belong to.
+Deduplicated files are made read-only because changing one of them in
+place would change all of them.
+Hard links share their inode,
+so a file that is linked to an existing object takes on the object's
+permissions,
+owner,
+and modification time,
+which are those of the first file that was stored with its contents.
+
+The reference count of an object is its number of hard links,
+less the object's own,
+which the file system keeps up to date as results directories are
+deleted,
+so collecting garbage is deleting the objects that have only one link.
+"""
+from __future__ import division
+
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import fnmatch
+import logging
+import os
+try:
+    from pathlib import Path
+except ImportError:
+    # Python 2.7
+    from pathlib2 import Path
+import stat
+import time
+
+import attr
+import cliff.command
+
+from fvcom_cmd import verify as verify_plugin
+from fvcom_cmd.fspath import fspath
+
+logger = logging.getLogger(__name__)
+
+#: Name of the content-addressed store directory in a results root.
+STORE_DIR = '.fvc_store'
+#: Patterns of the names of files that are never deduplicated because they
+#: are changed in place or rewritten,
+#: e.g. the deflated file records that are appended to,
+#: the checksum manifest,
+#: and the pack archive.
+UNSHARED_PATTERNS = ('.fvc_*', 'fvc_*')
+#: Default number of threads that read files to compute their checksums.
+DEDUP_THREADS = 4
+#: Permission bits that are cleared from deduplicated files.
+_WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+
+class Dedup(cliff.command.Command):
+    """Deduplicate results files, report space saved, and collect garbage.
+    """
+
+    def get_parser(self, prog_name):
+        parser = super(Dedup, self).get_parser(prog_name)
+        parser.description = '''
+            Hard-link the files in each RESULTS_DIR to the objects with the
+            same contents in the content-addressed store in the {}
+            directory of RESULTS_ROOT,
+            adding objects for files whose contents aren't stored yet,
+            as fvc gather --dedup does,
+            then report the space saved by the store.
+            The store has to be on the same file system as the results
+            directories.
+        '''.format(STORE_DIR)
+        parser.add_argument(
+            'results_root',
+            type=Path,
+            metavar='RESULTS_ROOT',
+            help='directory of results directories that holds the store'
+        )
+        parser.add_argument(
+            'results_dirs',
+            nargs='*',
+            type=Path,
+            metavar='RESULTS_DIR',
+            help='directory of gathered results to deduplicate'
+        )
+        parser.add_argument(
+            '--gc',
+            action='store_true',
+            help=(
+                'Delete the objects that are no longer linked to by any '
+                'results file, e.g. after results directories have been '
+                'deleted.'
+            )
+        )
+        parser.add_argument(
+            '-j',
+            '--jobs',
+            type=int,
+            default=DEDUP_THREADS,
+            help=(
+                'Maximum number of files to read concurrently. '
+                'Defaults to {}.'.format(DEDUP_THREADS)
+            )
+        )
+        return parser
+
+    def take_action(self, parsed_args):
+        """Execute the `fvc dedup` sub-command.
+
+        Deduplicate results directories,
+        collect garbage in the store if requested,
+        and log the space saved by the store.
+        """
+        store = store_dir(parsed_args.results_root)
+        for results_dir in parsed_args.results_dirs:
+            dedup(
+                results_dir,
+                store,
+                verify_plugin.checksum_algorithm(),
+                max_threads=parsed_args.jobs
+            )
+        if parsed_args.gc:
+            collect_garbage(store)
+        store_report(store)
+
+
+@attr.s
+class DedupReport(object):
+    """Results of deduplicating a results directory.
+
+    Returned by :func:`dedup`.
+    """
+    #: Number of files that were considered.
+    n_files = attr.ib(default=0)
+    #: Number of files that were linked to objects that were already in the
+    #: store.
+    n_linked = attr.ib(default=0)
+    #: Number of objects that were added to the store.
+    n_added = attr.ib(default=0)
+    #: Bytes of storage that were freed by linking files to existing
+    #: objects.
+    saved_bytes = attr.ib(default=0)
+    #: Wall time in seconds of the deduplication.
+    wall_time = attr.ib(default=0)
+
+    def summary(self):
+        """Return a 1 line summary of the deduplication.
+
+        :rtype: str
+        """
+        return (
+            'Deduplicated {n_linked} of {n} files, saving {mb:.1f} MB, '
+            'and stored {n_added} new objects in {wall:.1f} s'.format(
+                n_linked=self.n_linked,
+                n=self.n_files,
+                mb=self.saved_bytes / 1e6,
+                n_added=self.n_added,
+                wall=self.wall_time
+            )
+        )
+
+
+@attr.s
+class StoreReport(object):
+    """Space used and saved by a content-addressed store.
+
+    Returned by :func:`store_report`.
+    """
+    #: Number of objects in the store.
+    n_objects = attr.ib(default=0)
+    #: Number of results files that are linked to the objects.
+    n_references = attr.ib(default=0)
+    #: Total size in bytes of the objects.
+    stored_bytes = attr.ib(default=0)
+    #: Total size in bytes of the results files that are linked to the
+    #: objects.
+    referenced_bytes = attr.ib(default=0)
+    #: Bytes of storage saved by sharing the objects between results files.
+    saved_bytes = attr.ib(default=0)
+    #: Number of objects that no results file is linked to.
+    n_unreferenced = attr.ib(default=0)
+
+    def summary(self):
+        """Return a 1 line summary of the store usage.
+
+        :rtype: str
+        """
+        return (
+            '{n_refs} results files of {ref_mb:.1f} MB share {n_objects} '
+            'stored objects of {stored_mb:.1f} MB, saving {saved_mb:.1f} MB; '
+            '{n_unref} objects are unreferenced'.format(
+                n_refs=self.n_references,
+                ref_mb=self.referenced_bytes / 1e6,
+                n_objects=self.n_objects,
+                stored_mb=self.stored_bytes / 1e6,
+                saved_mb=self.saved_bytes / 1e6,
+                n_unref=self.n_unreferenced
+            )
+        )
+
+
+@attr.s
+class GarbageReport(object):
+    """Objects deleted from a content-addressed store.
+
+    Returned by :func:`collect_garbage`.
+    """
+    #: Number of objects that were deleted.
+    n_objects = attr.ib(default=0)
+    #: Total size in bytes of the objects that were deleted.
+    nbytes = attr.ib(default=0)
+
+
+def store_dir(results_root):
+    """Return the path of the content-addressed store of results_root.
+
+    :param results_root: Directory of results directories.
+    :type results_root: :py:class:`pathlib.Path`
+
+    :rtype: :py:class:`pathlib.Path`
+    """
+    return Path(results_root) / STORE_DIR
+
+
+def object_path(store, algorithm, checksum):
+    """Return the path of the object with checksum in store.
+
+    Objects are fanned out into sub-directories by the first 2 characters
+    of their checksums to keep the directories small.
+
+    :param store: Content-addressed store directory.
+    :type store: :py:class:`pathlib.Path`
+
+    :param str algorithm: Name of the hash algorithm of checksum.
+
+    :param str checksum: Hex digest of the object contents.
+
+    :rtype: :py:class:`pathlib.Path`
+    """
+    return store / algorithm / checksum[:2] / checksum[2:]
+
+
+def dedup(
+    results_dir,
+    store,
+    algorithm,
+    checksums=None,
+    max_threads=DEDUP_THREADS,
+    exclude=()
+):
+    """Hard-link the files in results_dir to the objects in store that have
+    the same contents,
+    and add objects to store for the others.
+
+    Files are replaced by links to existing objects atomically,
+    and they are made read-only.
+    A file that is replaced by a link takes on the permissions and
+    modification time of the object,
+    rather than keeping its own.
+    Files that are already linked to their objects are left as they are,
+    so deduplicating a results directory again only handles the files that
+    have been added to it since.
+    Empty files,
+    symbolic links,
+    and files whose names match :py:data:`UNSHARED_PATTERNS` are skipped.
+
+    :param results_dir: Results directory.
+    :type results_dir: :py:class:`pathlib.Path`
+
+    :param store: Content-addressed store directory;
+                  it has to be on the same file system as results_dir.
+    :type store: :py:class:`pathlib.Path`
+
+    :param str algorithm: Name of the hash algorithm to address objects
+                          by;
+                          see :func:`fvcom_cmd.verify.checksum_algorithm`.
+
+    :param dict checksums: Checksums that have already been computed with
+                           algorithm,
+                           e.g. while the files were copied,
+                           by path relative to results_dir;
+                           the checksums of the other files are computed and
+                           added to it.
+
+    :param int max_threads: Maximum number of files to read concurrently.
+
+    :param exclude: Names of files at the top of results_dir to skip,
+                    e.g. the journal of a gather that is finishing.
+    :type exclude: set
+
+    :returns: Numbers of files linked and bytes saved.
+    :rtype: :py:class:`DedupReport`
+    """
+    t_start = time.time()
+    checksums = {} if checksums is None else checksums
+    report = DedupReport()
+    filepaths = []
+    for dirpath, dirnames, filenames in os.walk(fspath(results_dir)):
+        for name in filenames:
+            if Path(dirpath) == results_dir and name in exclude:
+                continue
+            if any(fnmatch.fnmatch(name, pat) for pat in UNSHARED_PATTERNS):
+                continue
+            filepath = Path(dirpath) / name
+            st = os.lstat(fspath(filepath))
+            if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+                filepaths.append(filepath)
+    report.n_files = len(filepaths)
+    unhashed = [
+        filepath for filepath in filepaths
+        if filepath.relative_to(results_dir) not in checksums
+    ]
+
+    def checksum(filepath):
+        return verify_plugin.file_checksum(filepath, algorithm)
+
+    with ThreadPoolExecutor(max_threads) as executor:
+        for filepath, digest in zip(
+            unhashed, executor.map(checksum, unhashed)
+        ):
+            checksums[filepath.relative_to(results_dir)] = digest
+    for filepath in filepaths:
+        digest = checksums[filepath.relative_to(results_dir)]
+        try:
+            _link_object(
+                filepath, object_path(store, algorithm, digest), report
+            )
+        except OSError as exc:
+            if exc.errno != errno.EXDEV:
+                raise
+            logger.error(
+                'unable to deduplicate {} because {} is on a different file '
+                'system'.format(results_dir, store)
+            )
+            break
+    report.wall_time = time.time() - t_start
+    logger.info(report.summary())
+    return report
+
+
+def _link_object(filepath, obj, report):
+    """Hard-link filepath to obj,
+    or add it to the store as obj if there is no such object.
+
+    A file that is linked to an existing object takes on the object's mode
+    and modification time because they belong to the shared inode.
+    """
+    st = os.lstat(fspath(filepath))
+    try:
+        obj_st = os.lstat(fspath(obj))
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+        obj_st = None
+    if obj_st is not None and os.path.samestat(st, obj_st):
+        return
+    if obj_st is None:
+        obj.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(fspath(filepath), fspath(obj))
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+            # Another gather stored the same contents first
+            return _link_object(filepath, obj, report)
+        os.chmod(fspath(filepath), stat.S_IMODE(st.st_mode) & ~_WRITE_BITS)
+        report.n_added += 1
+        return
+    if obj_st.st_size != st.st_size:
+        logger.warning(
+            'size of {} does not match object {}, so it was not '
+            'deduplicated'.format(filepath, obj)
+        )
+        return
+    tmp_link = filepath.with_name('.{}.fvc_dedup'.format(filepath.name))
+    try:
+        os.link(fspath(obj), fspath(tmp_link))
+    except OSError as exc:
+        if exc.errno == errno.ENOENT:
+            # The object was collected as garbage since it was checked
+            return _link_object(filepath, obj, report)
+        if exc.errno == errno.EMLINK:
+            logger.debug('{} has the maximum number of links'.format(obj))
+            return
+        raise
+    os.rename(fspath(tmp_link), fspath(filepath))
+    report.n_linked += 1
+    report.saved_bytes += st.st_size
+
+
+def store_report(store):
+    """Report the space used and saved by the objects in store.
+
+    :param store: Content-addressed store directory.
+    :type store: :py:class:`pathlib.Path`
+
+    :rtype: :py:class:`StoreReport`
+    """
+    report = StoreReport()
+    for obj_st in _object_stats(store):
+        report.n_objects += 1
+        report.stored_bytes += obj_st.st_size
+        n_references = obj_st.st_nlink - 1
+        report.n_references += n_references
+        report.referenced_bytes += n_references * obj_st.st_size
+        if n_references:
+            report.saved_bytes += (n_references - 1) * obj_st.st_size
+        else:
+            report.n_unreferenced += 1
+    logger.info(report.summary())
+    return report
+
+
+def collect_garbage(store):
+    """Delete the objects in store that no results file is linked to,
+    and the fan-out directories that are left empty.
+
+    :param store: Content-addressed store directory.
+    :type store: :py:class:`pathlib.Path`
+
+    :rtype: :py:class:`GarbageReport`
+    """
+    report = GarbageReport()
+    for dirpath, dirnames, filenames in os.walk(
+        fspath(store), topdown=False
+    ):
+        for name in filenames:
+            obj = os.path.join(dirpath, name)
+            obj_st = os.lstat(obj)
+            if obj_st.st_nlink == 1:
+                os.unlink(obj)
+                report.n_objects += 1
+                report.nbytes += obj_st.st_size
+        if dirpath != fspath(store) and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+    logger.info(
+        'Deleted {} unreferenced objects of {:.1f} MB from {}'.format(
+            report.n_objects, report.nbytes / 1e6, store
+        )
+    )
+    return report
+
+
+def _object_stats(store):
+    """Return the :py:func:`os.lstat` results of the objects in store.
+    """
+    stats = []
+    for dirpath, dirnames, filenames in os.walk(fspath(store)):
+        stats.extend(
+            os.lstat(os.path.join(dirpath, name)) for name in filenames
+        )
+    return stats
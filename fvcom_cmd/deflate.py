@@ -16,23 +16,128 @@
 
 Deflate variables in netCDF files using Lempel-Ziv compression.
 """
+from __future__ import division
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import fnmatch
+import functools
+import hashlib
+import itertools
+import json
 import logging
 import math
 import multiprocessing
+import os
 try:
     from pathlib import Path
 except ImportError:
     # Python 2.7
     from pathlib2 import Path
-import shlex
+try:
+    import queue
+except ImportError:
+    # Python 2.7
+    import Queue as queue
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+import signal
 import subprocess
+import sys
+import threading
 import time
+import zlib
 
 import attr
 import cliff.command
 
+from fvcom_cmd import filewatch, ncdeflate
+from fvcom_cmd import verify as verify_plugin
+from fvcom_cmd.process_priority import ProcessPriority, add_arguments
+from fvcom_cmd.fspath import expanded_path, fspath
+
 logger = logging.getLogger(__name__)
 
+#: Available deflation engines.
+BACKENDS = ('nccopy', 'netcdf4')
+
+#: Size in bytes of the buffer used to copy staged deflated files back from
+#: the scratch directory.
+COPY_BUFSIZE = 16 * 1024**2
+
+#: Name of the file in each directory that records the files in the
+#: directory that have been deflated.
+DEFLATED_RECORD = '.fvc_deflated'
+
+#: Name of the JSON deflation report file written beside the deflated
+#: files.
+DEFLATE_REPORT = 'fvc_deflate_report.json'
+
+#: Deflation job journal states recorded in :py:data:`DEFLATED_RECORD`;
+#: see :py:class:`DeflatedRecords`.
+STARTED = 'started'
+WRITTEN = 'written'
+FAILED = 'failed'
+DEFLATED = 'deflated'
+
+#: Factor by which the disk space estimate for a deflated file is inflated
+#: to allow for files that compress less well than those seen so far.
+DISK_SAFETY_FACTOR = 1.25
+#: Upper limit in bytes of the memory estimate for a deflation job;
+#: neither nccopy nor the netcdf4 backend holds a whole file in memory.
+MAX_JOB_MEMORY = 256 * 1024**2
+#: Number of concurrent jobs that adaptive concurrency starts with.
+ADAPTIVE_START_JOBS = 2
+#: Minimum number of jobs that have to finish before the throughput at a
+#: concurrency level is measured.
+ADAPTIVE_MIN_WINDOW = 2
+#: Fractional throughput gain that a change of concurrency must produce
+#: for adaptive concurrency to keep moving in the same direction.
+ADAPTIVE_TOLERANCE = 0.05
+
+#: Longest interval in seconds between re-checks of free disk space and
+#: memory when no deflation job can be admitted.
+MAX_BACKOFF = 60
+#: Total time in seconds to wait for free disk space and memory when no
+#: deflation job can be admitted before giving up on the remaining files.
+ADMISSION_TIMEOUT = 600
+
+#: Throughput in bytes per second of a single deflation job that job
+#: timeouts are based on until jobs in the batch have succeeded and the
+#: actual throughput is known;
+#: deliberately low so that slow file systems don't cause spurious
+#: timeouts.
+EXPECTED_JOB_THROUGHPUT = 4 * 1024**2
+#: Factor by which a job may overrun its expected duration before it is
+#: considered hung and is killed.
+TIMEOUT_FACTOR = 10
+#: Shortest timeout in seconds for a deflation job.
+MIN_JOB_TIMEOUT = 300
+#: Number of times that a failed or hung deflation job is retried before
+#: its file is reported as permanently failed.
+MAX_RETRIES = 2
+#: Delay in seconds before the first retry of a failed deflation job;
+#: doubled for each subsequent retry, up to :py:data:`MAX_BACKOFF`.
+RETRY_DELAY = 10
+
+#: Size in bytes from which the nccopy backend hands a file to the
+#: in-process engine instead when large files are split,
+#: so that the file's chunks are compressed in parallel on all of the
+#: worker threads rather than by a single nccopy process.
+LARGE_FILE_SIZE = 1024**3
+
+#: Lowest niceness of the watch mode process and its nccopy jobs,
+#: unless a niceness is given,
+#: so that deflation yields the CPU to the running model.
+WATCH_NICENESS = 10
+#: Longest interval in seconds between checks for finished files and for
+#: the request to stop in watch mode.
+WATCH_WAKE_INTERVAL = 1
+
 
 class Deflate(cliff.command.Command):
     """Deflate variables in netCDF files using Lempel-Ziv compression.
@@ -47,24 +152,240 @@ class Deflate(cliff.command.Command):
             This command is effectively the same as running
             ncks -4 -L -O FILEPATH FILEPATH
             for each FILEPATH.
+            Other compression codecs can be selected with --codec.
+            With --watch, files are deflated in the background as a running
+            model finishes writing them.
         '''
         parser.add_argument(
             'filepaths',
-            nargs='+',
+            nargs='*',
             type=Path,
             metavar='FILEPATH',
             help='Path/name of file to be deflated.'
         )
+        parser.add_argument(
+            '--watch',
+            dest='watch_dir',
+            type=Path,
+            default=None,
+            metavar='DIR',
+            help=(
+                'Instead of deflating FILEPATHs, watch DIR for netCDF files '
+                'that the model has finished writing, and deflate them one '
+                'at a time at low CPU priority while the model runs. '
+                'A file is finished when it has been closed for the '
+                '--settle time and a later file in its numbered series '
+                'exists. '
+                'On SIGTERM or SIGINT the remaining files are deflated '
+                'with --jobs concurrent jobs and the command exits; '
+                'e.g. "fvc deflate --watch output & WATCH=$!", '
+                'run the model, then "kill -TERM $WATCH; wait $WATCH".'
+            )
+        )
+        parser.add_argument(
+            '--settle',
+            dest='settle_time',
+            type=float,
+            default=filewatch.SETTLE_TIME,
+            metavar='SECONDS',
+            help=(
+                'Time that a file in the --watch directory has to be closed '
+                'and unchanged to be considered finished. '
+                'Defaults to {} seconds.'.format(filewatch.SETTLE_TIME)
+            )
+        )
         parser.add_argument(
             '-j',
             '--jobs',
             type=int,
-            default=math.floor(multiprocessing.cpu_count() / 2),
+            default=None,
             help=(
                 'Maximum number of concurrent deflation processes allowed. '
-                'Defaults to 1/2 the number of cores detected.'
+                'Defaults to adapting the number of processes to the '
+                'measured throughput, '
+                'up to the number of CPUs that the CPU affinity and cgroup '
+                'CPU quota of the process allow.'
+            )
+        )
+        parser.add_argument(
+            '--backend',
+            choices=BACKENDS,
+            default='nccopy',
+            help=(
+                'Deflation engine to use: '
+                'nccopy runs the netCDF-C nccopy tool in a sub-process '
+                'for each file; '
+                'netcdf4 deflates the files in-process with the netCDF4 and '
+                'h5py packages. '
+                'Defaults to nccopy.'
             )
         )
+        parser.add_argument(
+            '--split-large',
+            action='store_true',
+            help=(
+                'Deflate zlib files of {} GB or more with the netcdf4 '
+                'backend when the nccopy backend is selected, '
+                'so that their chunks are compressed in parallel. '
+                'Those files can\'t be killed if they exceed their '
+                'timeouts.'.format(LARGE_FILE_SIZE // 1024**3)
+            )
+        )
+        parser.add_argument(
+            '--codec',
+            choices=ncdeflate.CODECS,
+            default='zlib',
+            help=(
+                'Compression codec to use. '
+                'Codecs other than zlib require the corresponding HDF5 '
+                'filter plugin, e.g. via HDF5_PLUGIN_PATH; '
+                'the deflated files are read back before they replace the '
+                'original files to confirm that they can be decompressed. '
+                'Defaults to zlib (Lempel-Ziv).'
+            )
+        )
+        parser.add_argument(
+            '-d',
+            '--level',
+            dest='dfl_lvl',
+            type=int,
+            default=4,
+            metavar='LEVEL',
+            help=(
+                'Compression level to use; 0 means no compression. '
+                'Defaults to 4.'
+            )
+        )
+        parser.add_argument(
+            '--no-shuffle',
+            dest='shuffle',
+            action='store_false',
+            help=(
+                'Don\'t shuffle the bytes of the values before compression. '
+                'Shuffling applies to the zlib and blosc codecs; '
+                'netCDF4 does not combine it with zstd or bzip2.'
+            )
+        )
+        parser.add_argument(
+            '--keep-bits',
+            action='append',
+            type=_keep_arg,
+            default=[],
+            metavar='PATTERN=BITS',
+            help=(
+                'Quantize the floating point variables whose names match the '
+                'glob PATTERN by rounding their values to BITS significant '
+                'mantissa bits before compression. '
+                'This is lossy, but the discarded noise in the low bits '
+                'compresses to almost nothing. '
+                'The quantization is recorded in the variable attributes. '
+                'Requires the netcdf4 backend. '
+                'May be used more than once; e.g. --keep-bits "temp=10".'
+            )
+        )
+        parser.add_argument(
+            '--keep-digits',
+            action='append',
+            type=_keep_arg,
+            default=[],
+            metavar='PATTERN=DIGITS',
+            help=(
+                'Like --keep-bits, with the precision given as a number of '
+                'significant decimal digits.'
+            )
+        )
+        parser.add_argument(
+            '--priority',
+            dest='priorities',
+            action='append',
+            type=_priority_arg,
+            default=[],
+            metavar='PATTERN=PRIORITY',
+            help=(
+                'Deflate files whose names match the glob PATTERN with '
+                'integer PRIORITY. '
+                'Files with higher priority are deflated first; '
+                'within a priority, larger files are deflated first. '
+                'The default priority is 0. '
+                'May be used more than once; '
+                'e.g. --priority "*restart*.nc=1".'
+            )
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help=(
+                'Deflate files even if they are recorded as deflated, '
+                'or their headers show that they are already deflated.'
+            )
+        )
+        parser.add_argument(
+            '--scratch-dir',
+            type=Path,
+            default=None,
+            metavar='DIR',
+            help=(
+                'Directory on fast local storage, e.g. $TMPDIR or /dev/shm, '
+                'in which to write the temporary deflated files. '
+                'Each one is then copied back beside its original file, '
+                'and its size and checksum are verified. '
+                'Files for which there is not enough space in DIR are '
+                'deflated in place. '
+                'Defaults to writing the temporary files beside the '
+                'original files.'
+            )
+        )
+        parser.add_argument(
+            '--verify',
+            dest='verify_samples',
+            type=int,
+            nargs='?',
+            const=ncdeflate.VERIFY_SAMPLES,
+            default=0,
+            metavar='SAMPLES',
+            help=(
+                'Before each deflated file replaces its original, compare '
+                'their dimensions, attributes, and variable definitions, '
+                'and the values in SAMPLES randomly chosen hyperslabs of '
+                'each variable (default {}). '
+                'Files that don\'t match are left undeflated. '
+                'Requires the netCDF4 package.'.format(
+                    ncdeflate.VERIFY_SAMPLES
+                )
+            )
+        )
+        parser.add_argument(
+            '--json-report',
+            action='store_true',
+            help=(
+                'Write the per-file and batch throughput and compression '
+                'statistics as JSON to {} in the directory that contains '
+                'the files.'.format(DEFLATE_REPORT)
+            )
+        )
+        parser.add_argument(
+            '--tune',
+            action='store_true',
+            help=(
+                'Instead of deflating the files, sample the variables in '
+                'each file to find the cheapest compression level and '
+                'shuffle setting for each of them, and store the results '
+                'as a profile in the profile directory. '
+                'The stored profile is applied when files from the same '
+                'model configuration are deflated with zlib.'
+            )
+        )
+        parser.add_argument(
+            '--profile-dir',
+            type=expanded_path,
+            default=ncdeflate.PROFILE_DIR,
+            metavar='DIR',
+            help=(
+                'Directory in which per-variable deflation profiles are '
+                'stored. Defaults to {}.'.format(ncdeflate.PROFILE_DIR)
+            )
+        )
+        add_arguments(parser)
         return parser
 
     def take_action(self, parsed_args):
@@ -75,8 +396,102 @@ class Deflate(cliff.command.Command):
         The deflated file replaces the original file.
         This command is effectively the same as
         :command:`ncks -4 -L -O filename filename`.
+
+        Exits with status 1 if any of the files could not be deflated.
         """
-        deflate(parsed_args.filepaths, parsed_args.jobs)
+        if not parsed_args.filepaths and parsed_args.watch_dir is None:
+            logger.error('FILEPATH or --watch DIR is required')
+            raise SystemExit(2)
+        if parsed_args.tune:
+            tune(parsed_args.filepaths, parsed_args.profile_dir)
+            return
+        if parsed_args.watch_dir is not None:
+            deflate_func = functools.partial(
+                watch,
+                parsed_args.watch_dir,
+                settle_time=parsed_args.settle_time
+            )
+        else:
+            deflate_func = functools.partial(deflate, parsed_args.filepaths)
+        report = deflate_func(
+            max_concurrent_jobs=parsed_args.jobs,
+            backend=parsed_args.backend,
+            split_large=parsed_args.split_large,
+            priorities=dict(parsed_args.priorities),
+            force=parsed_args.force,
+            scratch_dir=parsed_args.scratch_dir,
+            profile_dir=parsed_args.profile_dir,
+            codec=parsed_args.codec,
+            dfl_lvl=parsed_args.dfl_lvl,
+            shuffle=parsed_args.shuffle,
+            quantize=quantize_settings(
+                parsed_args.keep_bits, parsed_args.keep_digits
+            ),
+            verify_samples=parsed_args.verify_samples,
+            json_report=parsed_args.json_report,
+            process_priority=ProcessPriority.from_parsed_args(parsed_args)
+        )
+        if report.failed:
+            logger.error(
+                '{} of {} files could not be deflated: {}'.format(
+                    len(report.failed), len(report.jobs), ', '.join(
+                        fspath(job.filepath) for job in report.failed
+                    )
+                )
+            )
+            raise SystemExit(1)
+
+
+def _priority_arg(arg):
+    """Parse a PATTERN=PRIORITY command-line argument.
+    """
+    pattern, sep, priority = arg.rpartition('=')
+    try:
+        return pattern, int(priority)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected PATTERN=PRIORITY with integer PRIORITY: {}'.format(arg)
+        )
+
+
+def _keep_arg(arg):
+    """Parse a PATTERN=N command-line argument of --keep-bits or
+    --keep-digits.
+    """
+    pattern, sep, n = arg.rpartition('=')
+    try:
+        n = int(n)
+    except ValueError:
+        n = 0
+    if not pattern or n < 1:
+        raise argparse.ArgumentTypeError(
+            'expected PATTERN=N with positive integer N: {}'.format(arg)
+        )
+    return pattern, n
+
+
+def quantize_settings(keep_bits=(), keep_digits=()):
+    """Combine variable name patterns with numbers of mantissa bits and
+    numbers of decimal digits to keep into a mapping of patterns to
+    numbers of mantissa bits.
+
+    :param sequence keep_bits: Pattern, number of mantissa bits pairs.
+
+    :param sequence keep_digits: Pattern, number of significant decimal
+                                 digits pairs.
+
+    :returns: Mapping of patterns to numbers of mantissa bits;
+              the larger number applies to patterns given in both.
+    :rtype: dict
+    """
+    quantize = {}
+    pairs = itertools.chain(
+        keep_bits, ((pattern, ncdeflate.digits_to_bits(digits))
+                    for pattern, digits in keep_digits)
+    )
+    for pattern, bits in pairs:
+        quantize[pattern] = max(quantize.get(pattern, 0), bits)
+    return quantize
 
 
 @attr.s
@@ -85,100 +500,1967 @@ class DeflateJob(object):
     """
     #: Path/name of the netCDF file to deflate.
     filepath = attr.ib()
-    #: Lempel-Ziv compression level to use.
+    #: Compression level to use.
     dfl_lvl = attr.ib(default=4)
+    #: Deflation engine to use; one of :py:data:`BACKENDS`.
+    backend = attr.ib(default='nccopy')
+    #: Size of the netCDF file in bytes.
+    size = attr.ib(default=0)
+    #: Scheduling priority; higher priority jobs are started first.
+    priority = attr.ib(default=0)
     #: Deflation job subprocess object.
     process = attr.ib(default=None)
     #: Deflation job process PID.
     pid = attr.ib(default=None)
     #: Deflation job process return code.
     returncode = attr.ib(default=None)
+    #: Lines of stdout/stderr output from the deflation job process.
+    output = attr.ib(default=attr.Factory(list))
+    #: Size of the deflated file in bytes.
+    deflated_size = attr.ib(default=None)
+    #: Directory on fast local storage in which to write the temporary
+    #: deflated file before it is copied back beside the original file;
+    #: :py:obj:`None` means write it beside the original file.
+    scratch_dir = attr.ib(default=None)
+    #: Directory of per-variable deflation profiles to apply;
+    #: used by the netcdf4 backend.
+    profile_dir = attr.ib(default=None)
+    #: Compression codec to use; one of :py:data:`ncdeflate.CODECS`.
+    codec = attr.ib(default='zlib')
+    #: Shuffle the bytes of the values before compression.
+    shuffle = attr.ib(default=True)
+    #: Mapping of variable name patterns to the number of mantissa bits to
+    #: keep when quantizing floating point variables;
+    #: used by the netcdf4 backend.
+    quantize = attr.ib(default=None)
+    #: Time at which the job was started.
+    start_time = attr.ib(default=None)
+    #: Wall time in seconds that the job took,
+    #: including staging out and checking the deflated file.
+    wall_time = attr.ib(default=None)
+    #: CPU time in seconds used by the deflation.
+    cpu_time = attr.ib(default=None)
+    #: Peak resident set size in bytes of the deflation process;
+    #: for the netcdf4 backend, of the fvc process.
+    max_rss = attr.ib(default=None)
+    #: Number of times that the job has been started.
+    attempts = attr.ib(default=0)
+    #: Time before which a job that is to be retried must not be started.
+    not_before = attr.ib(default=0)
+    #: The job ran for longer than its timeout.
+    timed_out = attr.ib(default=False)
+    #: Number of randomly chosen hyperslabs of each variable to compare
+    #: between the deflated file and the original file before the original
+    #: is replaced; 0 means no verification.
+    verify_samples = attr.ib(default=0)
+    #: Wall time in seconds that the verification took.
+    verify_time = attr.ib(default=None)
+    #: Differences between the deflated file and the original file found by
+    #: verification.
+    mismatches = attr.ib(default=attr.Factory(list))
+    #: Path/name to store the deflated file as instead of replacing the
+    #: original file,
+    #: which is deleted when the job finishes successfully;
+    #: e.g. in a results directory that the file is being gathered into.
+    dest_filepath = attr.ib(default=None)
 
-    def start(self):
-        """Start the deflation job in a subprocess.
-
-        Cache the subprocess object and its process id as job attributes.
+    @property
+    def target_filepath(self):
+        """Path/name of the deflated file when the job finishes
+        successfully;
+        :py:attr:`dest_filepath` if it is set,
+        otherwise the original file.
         """
-        cmd = 'nccopy -s -4 -d{0.dfl_lvl} {0.filepath} {0.filepath}.nccopy.tmp'.format(
-            self
+        return self.filepath if self.dest_filepath is None else Path(
+            self.dest_filepath
         )
-        self.process = subprocess.Popen(
-            shlex.split(cmd),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True
+
+    @property
+    def replacement_filepath(self):
+        """Path/name of the temporary deflated file beside
+        :py:attr:`target_filepath` that is renamed to it when the job
+        finishes successfully.
+        """
+        return Path('{}.nccopy.tmp'.format(self.target_filepath))
+
+    @property
+    def tmp_filepath(self):
+        """Path/name of the temporary deflated file that the job writes;
+        in :py:attr:`scratch_dir` if the job is staged there,
+        otherwise :py:attr:`replacement_filepath`.
+        """
+        if self.scratch_dir is None:
+            return self.replacement_filepath
+        path_hash = hashlib.md5(
+            fspath(self.filepath.resolve()).encode('utf-8')
+        ).hexdigest()[:12]
+        return Path(self.scratch_dir) / '{}-{}.nccopy.tmp'.format(
+            path_hash, self.filepath.name
         )
-        self.pid = self.process.pid
-        logger.debug('deflating {0.filepath} in process {0.pid}'.format(self))
+
+    @property
+    def written_filepaths(self):
+        """Paths/names of the files that the job writes deflated data into.
+        """
+        if self.scratch_dir is None:
+            return [self.tmp_filepath]
+        return [self.tmp_filepath, self.replacement_filepath]
+
+    def start(self, finished_jobs, executor=None):
+        """Start the deflation job in a subprocess,
+        or in a thread for the in-process netcdf4 backend.
+
+        Cache the subprocess object and its process id as job attributes.
+
+        A watcher thread drains the subprocess output as it is produced,
+        so that a chatty process can't block on a full pipe,
+        and puts the job on the finished_jobs queue as soon as the
+        subprocess exits.
+
+        :param finished_jobs: Queue on which to put the job when it finishes.
+        :type finished_jobs: :py:class:`queue.Queue`
+
+        :param executor: Executor on which the netcdf4 backend compresses
+                         variable chunks.
+        :type executor: :py:class:`concurrent.futures.Executor`
+        """
+        self.start_time = time.time()
+        self.attempts += 1
+        if self.backend == 'netcdf4':
+            target, args = self._deflate_in_process, (finished_jobs, executor)
+            logger.debug('deflating {0.filepath} in-process'.format(self))
+        else:
+            self.process = subprocess.Popen(
+                self.nccopy_cmd(),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True
+            )
+            self.pid = self.process.pid
+            target, args = self._watch, (finished_jobs, )
+            logger.debug(
+                'deflating {0.filepath} in process {0.pid}'.format(self)
+            )
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def nccopy_cmd(self):
+        """Return the :program:`nccopy` command line for the job as a list.
+
+        zlib is selected with the :kbd:`-d` option,
+        and the other codecs by their HDF5 filter ids with the :kbd:`-F`
+        option.
+        The compression level and shuffle setting of the variables in the
+        zlib deflation profile in the job's profile directory for the file,
+        if there is one,
+        are selected by per-variable :kbd:`-F` options.
+        """
+        cmd = ['nccopy']
+        if self.shuffle and not self.codec.startswith('blosc'):
+            cmd.append('-s')
+        cmd.append('-4')
+        if self.codec == 'zlib' or self.dfl_lvl == 0:
+            cmd.append('-d{.dfl_lvl}'.format(self))
+        else:
+            cmd.extend([
+                '-F', '*,{}'.format(
+                    ncdeflate.hdf5_filter_spec(
+                        self.codec, self.dfl_lvl, self.shuffle
+                    )
+                )
+            ])
+        if self.codec == 'zlib' and self.profile_dir is not None:
+            profile = ncdeflate.file_profile(self.filepath, self.profile_dir)
+            variables = (profile or {}).get('variables', {})
+            for name, settings in sorted(variables.items()):
+                cmd.extend([
+                    '-F', '{},{}'.format(
+                        name,
+                        ncdeflate.nccopy_filter_spec(
+                            settings.get('dfl_lvl', self.dfl_lvl),
+                            settings.get('shuffle', self.shuffle)
+                        )
+                    )
+                ])
+        cmd.extend([fspath(self.filepath), fspath(self.tmp_filepath)])
+        return cmd
+
+    def _watch(self, finished_jobs):
+        try:
+            for line in self.process.stdout:
+                self.output.append(line)
+            self.process.stdout.close()
+            self.returncode = self._wait()
+            self._check_read_back()
+            self._verify()
+            self._stage_out()
+        except Exception as exc:
+            self.output.append('{}: {}\n'.format(self.filepath, exc))
+            self.returncode = 1
+        self.wall_time = time.time() - self.start_time
+        finished_jobs.put(self)
+
+    def _wait(self):
+        """Wait for the subprocess to exit,
+        and collect its CPU time and peak RSS from its resource usage.
+
+        The subprocess object reaps the process itself when it is polled,
+        e.g. by :meth:`kill`,
+        in which case the return code that it collected is used,
+        without the resource usage.
+
+        :returns: Return code of the subprocess.
+        :rtype: int
+        """
+        try:
+            pid, status, rusage = os.wait4(self.pid, 0)
+        except AttributeError:
+            # Windows
+            return self.process.wait()
+        except OSError as exc:
+            if exc.errno != errno.ECHILD:
+                raise
+            # Process was reaped by the subprocess object
+            return self.process.wait()
+        self.cpu_time = rusage.ru_utime + rusage.ru_stime
+        self.max_rss = _max_rss_bytes(rusage.ru_maxrss)
+        if os.WIFSIGNALED(status):
+            self.process.returncode = -os.WTERMSIG(status)
+        else:
+            self.process.returncode = os.WEXITSTATUS(status)
+        return self.process.returncode
+
+    def _deflate_in_process(self, finished_jobs, executor):
+        try:
+            self.cpu_time = ncdeflate.deflate_file(
+                self.filepath,
+                self.tmp_filepath,
+                self.dfl_lvl,
+                shuffle=self.shuffle,
+                executor=executor,
+                profile_dir=self.profile_dir,
+                codec=self.codec,
+                quantize=self.quantize
+            )
+            self.returncode = 0
+        except Exception as exc:
+            self.output.append('{}: {}\n'.format(self.filepath, exc))
+            self.returncode = 1
+        if resource is not None:
+            self.max_rss = _max_rss_bytes(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            )
+        self._check_read_back()
+        self._verify()
+        self._stage_out()
+        self.wall_time = time.time() - self.start_time
+        finished_jobs.put(self)
+
+    def _check_read_back(self):
+        """Confirm that a file deflated with a codec other than zlib can be
+        decompressed before it replaces the original file.
+        """
+        if self.returncode != 0 or self.codec == 'zlib':
+            return
+        try:
+            ncdeflate.check_readable(
+                self.tmp_filepath, self.codec, self.dfl_lvl
+            )
+        except Exception as exc:
+            self.output.append(
+                'read back check of {0.tmp_filepath} failed: {1}\n'.format(
+                    self, exc
+                )
+            )
+            self.returncode = 1
+
+    def _verify(self):
+        """Compare the metadata and a random sample of hyperslabs of the
+        temporary deflated file with those of the original file before it
+        replaces the original file,
+        if :py:attr:`verify_samples` is set.
+
+        The differences found are recorded in :py:attr:`mismatches`,
+        and fail the job.
+        """
+        if not self.verify_samples or self.returncode != 0:
+            return
+        t_start = time.time()
+        try:
+            self.mismatches = ncdeflate.verify_sample(
+                self.filepath, self.tmp_filepath, self.verify_samples
+            )
+        except Exception as exc:
+            self.mismatches = ['unable to verify: {}'.format(exc)]
+        self.verify_time = time.time() - t_start
+        if self.mismatches:
+            self.output.append(
+                'verification of {0.tmp_filepath} against {0.filepath} '
+                'failed: {1}\n'.format(self, '; '.join(self.mismatches))
+            )
+            self.returncode = 1
+
+    def _stage_out(self):
+        """Copy the temporary deflated file from scratch_dir back beside the
+        original file, verifying its size and checksum.
+
+        A temporary deflated file that was written in place is flushed to
+        disk so that it survives a crash once it is journaled as
+        :py:data:`WRITTEN`.
+        """
+        if self.scratch_dir is None:
+            if self.returncode == 0:
+                try:
+                    _fsync(self.replacement_filepath)
+                except (IOError, OSError) as exc:
+                    self.output.append(
+                        'flushing {0.replacement_filepath} failed: {1}\n'.
+                        format(self, exc)
+                    )
+                    self.returncode = 1
+            return
+        try:
+            if self.returncode == 0:
+                _copy_verified(self.tmp_filepath, self.replacement_filepath)
+        except (IOError, OSError) as exc:
+            self.output.append(
+                'copying {0.tmp_filepath} to {0.replacement_filepath} '
+                'failed: {1}\n'.format(self, exc)
+            )
+            self.returncode = 1
+        finally:
+            if self.tmp_filepath.exists():
+                self.tmp_filepath.unlink()
 
     @property
     def done(self):
         """Return a boolean indicating whether or not the job has finished.
+        """
+        return self.returncode is not None
+
+    def kill(self, timeout):
+        """Kill the job's subprocess because the job has run for longer
+        than its timeout.
 
-        Cache the subprocess return code as a job attribute.
+        Jobs running in-process with the netcdf4 backend can't be
+        interrupted,
+        so they are only reported as stragglers.
+
+        :param float timeout: Timeout of the job in seconds.
         """
-        finished = False
-        self.returncode = self.process.poll()
-        if self.returncode is not None:
-            if self.returncode == 0:
-                Path('{0.filepath}.nccopy.tmp'.format(self)
-                     ).rename(self.filepath)
-            finished = True
+        self.timed_out = True
+        if self.process is None:
+            logger.warning(
+                'deflating {0.filepath} in-process has taken more than '
+                '{1:.0f} s; in-process jobs can\'t be interrupted'.format(
+                    self, timeout
+                )
+            )
+            return
+        logger.error(
+            'deflating {0.filepath} timed out after {1:.0f} s; '
+            'killing process {0.pid}'.format(self, timeout)
+        )
+        try:
+            self.process.kill()
+        except OSError:
+            # Process has already exited
+            pass
+
+    def reset(self, not_before):
+        """Reset the job so that it can be started again,
+        no earlier than not_before.
+
+        :param float not_before: Time before which the job must not be
+                                 started.
+        """
+        self.process = self.pid = self.returncode = None
+        self.output = []
+        self.deflated_size = self.cpu_time = self.max_rss = None
+        self.verify_time = None
+        self.mismatches = []
+        self.timed_out = False
+        self.not_before = not_before
+
+    def finish(self):
+        """Replace the original file with the deflated one if the job
+        finished successfully,
+        or store the deflated file as :py:attr:`dest_filepath` and delete
+        the original file if that is set.
+        """
+        if self.returncode == 0:
+            self.deflated_size = self.replacement_filepath.stat().st_size
+            self.replacement_filepath.rename(self.target_filepath)
+            if self.dest_filepath is not None:
+                self.filepath.unlink()
+        else:
+            for filepath in self.written_filepaths:
+                if filepath.exists():
+                    filepath.unlink()
+        logger.debug(
+            'deflating {0.filepath} finished '
+            'with return code {0.returncode}'.format(self)
+        )
+
+
+def _max_rss_bytes(ru_maxrss):
+    # ru_maxrss is in bytes on macOS, and in kilobytes elsewhere
+    return ru_maxrss if sys.platform == 'darwin' else ru_maxrss * 1024
+
+
+@attr.s
+class JobStats(object):
+    """Measurements of a deflation job.
+    """
+    #: Path/name of the netCDF file.
+    filepath = attr.ib()
+    #: Return code of the job; 0 for success,
+    #: :py:obj:`None` if the job was never started.
+    returncode = attr.ib()
+    #: Size in bytes of the file before deflation.
+    in_bytes = attr.ib()
+    #: Size in bytes of the deflated file;
+    #: :py:obj:`None` if the job failed.
+    out_bytes = attr.ib()
+    #: Wall time in seconds that the job took.
+    wall_time = attr.ib()
+    #: CPU time in seconds used by the deflation.
+    cpu_time = attr.ib()
+    #: Peak resident set size in bytes of the deflation process.
+    max_rss = attr.ib()
+    #: Number of times that the job was started.
+    attempts = attr.ib(default=1)
+    #: The last attempt ran for longer than the job's timeout.
+    timed_out = attr.ib(default=False)
+    #: Wall time in seconds of the verification of the deflated file;
+    #: :py:obj:`None` if it wasn't verified.
+    verify_time = attr.ib(default=None)
+    #: Differences between the deflated file and the original file found by
+    #: verification.
+    mismatches = attr.ib(default=attr.Factory(list))
+
+    @classmethod
+    def from_job(cls, job):
+        """Return the measurements of a :py:class:`DeflateJob`.
+        """
+        return cls(
+            job.filepath, job.returncode, job.size, job.deflated_size,
+            job.wall_time, job.cpu_time, job.max_rss, job.attempts,
+            job.timed_out, job.verify_time, list(job.mismatches)
+        )
+
+
+@attr.s
+class DeflateReport(object):
+    """Throughput and compression statistics of a batch of deflation jobs.
+
+    Returned by :func:`deflate`.
+    """
+    #: Deflation engine used.
+    backend = attr.ib()
+    #: Compression codec used.
+    codec = attr.ib()
+    #: Compression level used.
+    dfl_lvl = attr.ib()
+    #: :py:class:`JobStats` of the files that were to be deflated.
+    jobs = attr.ib(default=attr.Factory(list))
+    #: Number of files that were skipped because they are missing or
+    #: already deflated.
+    n_skipped = attr.ib(default=0)
+    #: Wall time in seconds of the whole batch.
+    wall_time = attr.ib(default=0)
+
+    @property
+    def deflated(self):
+        """:py:class:`JobStats` of the files that were deflated.
+        """
+        return [job for job in self.jobs if job.returncode == 0]
+
+    @property
+    def failed(self):
+        """:py:class:`JobStats` of the files that could not be deflated.
+        """
+        return [job for job in self.jobs if job.returncode != 0]
+
+    @property
+    def in_bytes(self):
+        """Total size in bytes of the deflated files before deflation.
+        """
+        return sum(job.in_bytes for job in self.deflated)
+
+    @property
+    def out_bytes(self):
+        """Total size in bytes of the deflated files.
+        """
+        return sum(job.out_bytes for job in self.deflated)
+
+    @property
+    def compression_ratio(self):
+        """Ratio of the size of the deflated files before and after
+        deflation; :py:obj:`None` if no files were deflated.
+        """
+        return self.in_bytes / self.out_bytes if self.out_bytes else None
+
+    @property
+    def throughput(self):
+        """Bytes of input deflated per second of batch wall time.
+        """
+        return self.in_bytes / self.wall_time if self.wall_time else 0
+
+    @property
+    def cpu_time(self):
+        """Total CPU time in seconds used by the jobs.
+        """
+        return sum(job.cpu_time or 0 for job in self.jobs)
+
+    @property
+    def max_rss(self):
+        """Largest peak resident set size in bytes of the jobs.
+        """
+        return max([job.max_rss or 0 for job in self.jobs] or [0])
+
+    @property
+    def verify_time(self):
+        """Total wall time in seconds spent verifying deflated files;
+        included in the wall times of the jobs.
+        """
+        return sum(job.verify_time or 0 for job in self.jobs)
+
+    @property
+    def mismatched(self):
+        """:py:class:`JobStats` of the files whose deflated copies didn't
+        match them.
+        """
+        return [job for job in self.jobs if job.mismatches]
+
+    def summary(self):
+        """Return a 1 line summary of the batch statistics.
+
+        The ratio of CPU time to wall time indicates whether deflation was
+        CPU-bound (close to the number of concurrent jobs) or I/O-bound
+        (well below it).
+
+        :rtype: str
+        """
+        summary = (
+            'Deflated {n} of {total} files: {in_mb:.1f} MB to '
+            '{out_mb:.1f} MB (compression ratio {ratio:.2f}) in {wall:.1f} s '
+            '= {rate:.1f} MB/s; CPU time {cpu:.1f} s ({cpus:.1f} CPUs busy), '
+            'peak RSS {rss:.0f} MB'.format(
+                n=len(self.deflated),
+                total=len(self.jobs),
+                in_mb=self.in_bytes / 1e6,
+                out_mb=self.out_bytes / 1e6,
+                ratio=self.compression_ratio or 1,
+                wall=self.wall_time,
+                rate=self.throughput / 1e6,
+                cpu=self.cpu_time,
+                cpus=self.cpu_time / self.wall_time if self.wall_time else 0,
+                rss=self.max_rss / 1e6,
+            )
+        )
+        if any(job.verify_time is not None for job in self.jobs):
+            summary += '; verification {:.1f} s'.format(self.verify_time)
+        if self.failed:
+            summary += '; {} failed'.format(len(self.failed))
+        if self.mismatched:
+            summary += ' ({} mismatched)'.format(len(self.mismatched))
+        if self.n_skipped:
+            summary += '; {} skipped'.format(self.n_skipped)
+        return summary
+
+    def as_dict(self):
+        """Return the batch statistics and the statistics of each job as a
+        JSON-serializable dict.
+
+        :rtype: dict
+        """
+        report = attr.asdict(self, recurse=False)
+        report['jobs'] = [
+            dict(attr.asdict(job), filepath=fspath(job.filepath))
+            for job in self.jobs
+        ]
+        report.update({
+            'n_deflated': len(self.deflated),
+            'n_failed': len(self.failed),
+            'in_bytes': self.in_bytes,
+            'out_bytes': self.out_bytes,
+            'compression_ratio': self.compression_ratio,
+            'throughput': self.throughput,
+            'cpu_time': self.cpu_time,
+            'max_rss': self.max_rss,
+            'verify_time': self.verify_time,
+            'n_mismatched': len(self.mismatched),
+        })
+        return report
+
+    def write_json(self, filepath):
+        """Write the statistics returned by :py:meth:`as_dict` to filepath
+        as JSON.
+
+        :param filepath: Path/name of the file to write.
+        :type filepath: :py:class:`pathlib.Path`
+        """
+        with filepath.open('wt') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+
+@attr.s
+class AdmissionControl(object):
+    """Admission control for deflation jobs based on the free disk space and
+    memory that they are estimated to need.
+
+    The disk space needed for a job's temporary file is estimated from
+    the size of its input file and the aggregate compression ratio observed
+    for the jobs that have finished so far.
+    """
+    #: Total size in bytes of the input files of the finished jobs.
+    in_bytes = attr.ib(default=0)
+    #: Total size in bytes of the deflated files of the finished jobs.
+    out_bytes = attr.ib(default=0)
+
+    @property
+    def compression_ratio(self):
+        """Observed ratio of deflated to input file size;
+        1 until a job has finished.
+        """
+        return self.out_bytes / self.in_bytes if self.in_bytes else 1.0
+
+    def disk_needed(self, job):
+        """Estimated disk space in bytes needed for job's temporary file.
+        """
+        return int(job.size * self.compression_ratio * DISK_SAFETY_FACTOR)
+
+    def memory_needed(self, job):
+        """Estimated memory in bytes needed to run job.
+        """
+        return min(job.size, MAX_JOB_MEMORY)
+
+    def admits(self, job, jobs_in_progress):
+        """Return a boolean indicating whether or not there is enough free
+        disk space and memory to start job.
+
+        Each of the files that the job writes must fit on its file system.
+        Free disk space is reduced by the space that the files written by
+        the jobs in progress on the same file system are still expected to
+        grow by.
+        """
+        for filepath in job.written_filepaths:
+            dir_path = filepath.parent
+            device = _device(dir_path)
+            reserved = 0
+            for running_job in jobs_in_progress.values():
+                for running_filepath in running_job.written_filepaths:
+                    if _device(running_filepath.parent) != device:
+                        continue
+                    try:
+                        size = running_filepath.stat().st_size
+                    except OSError:
+                        size = 0
+                    reserved += max(self.disk_needed(running_job) - size, 0)
+            if self.disk_needed(job) > _free_disk_space(dir_path) - reserved:
+                return False
+        memory = _available_memory()
+        if memory is not None:
+            reserved = sum(
+                self.memory_needed(running_job)
+                for running_job in jobs_in_progress.values()
+            )
+            if self.memory_needed(job) > memory - reserved:
+                return False
+        return True
+
+    def record(self, job):
+        """Include the sizes of a successfully finished job in the observed
+        compression ratio.
+        """
+        if job.deflated_size is not None:
+            self.in_bytes += job.size
+            self.out_bytes += job.deflated_size
+
+
+@attr.s
+class ConcurrencyController(object):
+    """Limit on the number of concurrent deflation jobs.
+
+    In adaptive mode the limit starts low and is moved one job at a time
+    by hill-climbing on the aggregate throughput in bytes per second of the
+    jobs that finish at each limit:
+    a move that increases throughput by more than
+    :py:data:`ADAPTIVE_TOLERANCE` is followed by another in the same
+    direction,
+    otherwise the direction is reversed.
+    So the limit settles around the knee beyond which more jobs don't
+    increase throughput,
+    e.g. because the file system is saturated.
+    """
+    #: Upper limit on the number of concurrent jobs.
+    max_jobs = attr.ib()
+    #: Current limit on the number of concurrent jobs.
+    jobs = attr.ib()
+    #: Adjust jobs according to the measured throughput.
+    adaptive = attr.ib(default=False)
+    #: Direction of the next adjustment of jobs; 1 or -1.
+    step = attr.ib(default=1)
+    #: Throughput in bytes per second measured at the previous limit.
+    throughput = attr.ib(default=None)
+    #: Time at which the measurement at the current limit started.
+    window_start = attr.ib(default=attr.Factory(time.time))
+    #: Bytes of input deflated at the current limit.
+    window_bytes = attr.ib(default=0)
+    #: Number of jobs finished at the current limit.
+    window_jobs = attr.ib(default=0)
+
+    @classmethod
+    def fixed(cls, jobs):
+        """Return a controller with a fixed limit of jobs.
+        """
+        jobs = max(int(jobs), 1)
+        return cls(jobs, jobs)
+
+    @classmethod
+    def adaptive_up_to(cls, max_jobs):
+        """Return an adaptive controller with an upper limit of max_jobs.
+        """
+        return cls(
+            max_jobs, min(ADAPTIVE_START_JOBS, max_jobs), adaptive=True
+        )
+
+    def record(self, job, now=None):
+        """Include a successfully finished job in the throughput
+        measurement at the current limit,
+        and adjust the limit when the measurement is complete.
+
+        :returns: New limit on the number of concurrent jobs.
+        :rtype: int
+        """
+        if not self.adaptive or job.deflated_size is None:
+            return self.jobs
+        now = time.time() if now is None else now
+        self.window_bytes += job.size
+        self.window_jobs += 1
+        if self.window_jobs < max(self.jobs, ADAPTIVE_MIN_WINDOW):
+            return self.jobs
+        throughput = self.window_bytes / max(now - self.window_start, 1e-6)
+        if (
+            self.throughput is not None
+            and throughput < self.throughput * (1 + ADAPTIVE_TOLERANCE)
+        ):
+            self.step = -self.step
+        jobs = min(max(self.jobs + self.step, 1), self.max_jobs)
+        if jobs == self.jobs:
+            # At a limit; try the other direction next time
+            self.step = -self.step
+        else:
             logger.debug(
-                'deflating {0.filepath} finished '
-                'with return code {0.returncode}'.format(self)
+                '{:.1f} MB/s with {} concurrent jobs; changing to {}'.format(
+                    throughput / 1e6, self.jobs, jobs
+                )
             )
-        return finished
+        self.jobs, self.throughput = jobs, throughput
+        self.window_start, self.window_bytes, self.window_jobs = now, 0, 0
+        return self.jobs
+
+
+@attr.s
+class JobTimeouts(object):
+    """Timeouts for deflation jobs based on the throughput expected for
+    the size of each job's file.
+
+    The expected throughput of a job is the aggregate throughput of the
+    jobs that have succeeded so far,
+    or :py:data:`EXPECTED_JOB_THROUGHPUT` until one has.
+    A job may take :py:data:`TIMEOUT_FACTOR` times as long as expected,
+    but no less than :py:data:`MIN_JOB_TIMEOUT` seconds,
+    before it is considered hung.
+    """
+    #: Total size in bytes of the input files of the jobs that succeeded.
+    in_bytes = attr.ib(default=0)
+    #: Total wall time in seconds of the jobs that succeeded.
+    wall_time = attr.ib(default=0)
+
+    @property
+    def job_throughput(self):
+        """Expected throughput in bytes per second of a single job.
+        """
+        if not self.wall_time:
+            return EXPECTED_JOB_THROUGHPUT
+        return self.in_bytes / self.wall_time
+
+    def timeout(self, job):
+        """Return the timeout of job in seconds.
+        """
+        return max(
+            TIMEOUT_FACTOR * job.size / self.job_throughput, MIN_JOB_TIMEOUT
+        )
+
+    def next_deadline(self, jobs_in_progress):
+        """Return the earliest time at which one of jobs_in_progress that
+        has not already timed out will time out;
+        :py:obj:`None` if there is no such job.
+        """
+        deadlines = [
+            job.start_time + self.timeout(job)
+            for job in jobs_in_progress.values() if not job.timed_out
+        ]
+        return min(deadlines) if deadlines else None
+
+    def overdue(self, jobs_in_progress, now=None):
+        """Return the jobs in jobs_in_progress that have run for longer
+        than their timeouts,
+        and have not already timed out,
+        with their timeouts.
+
+        :rtype: list of (:py:class:`DeflateJob`, float) tuples
+        """
+        now = time.time() if now is None else now
+        return [
+            (job, self.timeout(job)) for job in jobs_in_progress.values()
+            if not job.timed_out and now - job.start_time > self.timeout(job)
+        ]
+
+    def record(self, job):
+        """Record the throughput of a finished job if it succeeded.
+        """
+        if job.returncode == 0 and job.wall_time:
+            self.in_bytes += job.size
+            self.wall_time += job.wall_time
+
+
+def available_cpus():
+    """Return the number of CPUs that the process may use.
+
+    That is the number of CPUs in the process' CPU affinity mask,
+    where the operating system provides it,
+    further limited by the CPU quota of the process' cgroup,
+    if it has one.
+
+    :rtype: int
+    """
+    try:
+        n_cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n_cpus = multiprocessing.cpu_count()
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        n_cpus = min(n_cpus, int(math.ceil(quota)))
+    return max(n_cpus, 1)
 
 
-def deflate(filepaths, max_concurrent_jobs):
+def _cgroup_cpu_quota():
+    """Return the CPU quota of the process' cgroup as a number of CPUs,
+    or :py:obj:`None` if it doesn't have one.
+
+    cgroup v2 :file:`cpu.max`,
+    and cgroup v1 :file:`cpu.cfs_quota_us` and :file:`cpu.cfs_period_us`
+    are checked.
+    """
+    cgroup_root = Path('/sys/fs/cgroup')
+    cgroup_path = ''
+    try:
+        with open('/proc/self/cgroup', 'rt') as f:
+            for line in f:
+                hierarchy, controllers, path = line.strip().split(':', 2)
+                if hierarchy == '0' and not controllers:
+                    cgroup_path = path.lstrip('/')
+    except (IOError, OSError, ValueError):
+        pass
+    for cpu_max in (
+        cgroup_root / cgroup_path / 'cpu.max', cgroup_root / 'cpu.max'
+    ):
+        try:
+            quota, period = cpu_max.read_text().split()[:2]
+        except (IOError, OSError, ValueError):
+            continue
+        if quota == 'max':
+            return None
+        return int(quota) / int(period)
+    try:
+        quota = int((cgroup_root / 'cpu' / 'cpu.cfs_quota_us').read_text())
+        period = int((cgroup_root / 'cpu' / 'cpu.cfs_period_us').read_text())
+    except (IOError, OSError, ValueError):
+        return None
+    return quota / period if quota > 0 and period > 0 else None
+
+
+@attr.s
+class DeflatedRecords(object):
+    """On-disk records of the files that have been deflated,
+    and journal of the states of deflation jobs.
+
+    Each directory that contains deflated files gets a
+    :py:data:`DEFLATED_RECORD` file to which a line of JSON is appended
+    for each file deflated in it.
+    Files are identified by their inode, size, and modification time,
+    so a file that is replaced or changed after it was deflated is no longer
+    recognized as deflated.
+    The compression settings are recorded with them,
+    so a file deflated with different settings is deflated again.
+
+    Lines are also appended,
+    and flushed to disk,
+    as each deflation job is started (:py:data:`STARTED`),
+    has completely written its temporary deflated file beside the original
+    file (:py:data:`WRITTEN`),
+    and fails (:py:data:`FAILED`);
+    the line recording that a file is deflated has the state
+    :py:data:`DEFLATED`.
+    That lets :func:`recover` tidy up after a batch that was killed part way
+    through.
+    """
+    #: Record entries by directory; loaded on first use.
+    entries = attr.ib(default=attr.Factory(dict))
+    #: Last journal record of each file name by directory;
+    #: loaded on first use.
+    states = attr.ib(default=attr.Factory(dict))
+    #: Lock that serializes appends to the record files.
+    lock = attr.ib(default=attr.Factory(threading.Lock))
+
+    def contains(
+        self, filepath, dfl_lvl, codec='zlib', shuffle=True, quantize=None
+    ):
+        """Return a boolean indicating whether or not filepath is recorded as
+        compressed with codec at dfl_lvl with the shuffle setting and
+        quantization.
+        """
+        key = _record_key(filepath.stat(), dfl_lvl, codec, shuffle, quantize)
+        return key in self._load(filepath.parent)
+
+    def add(
+        self, filepath, dfl_lvl, codec='zlib', shuffle=True, quantize=None
+    ):
+        """Record that filepath has been compressed with codec at dfl_lvl
+        with the shuffle setting and quantization.
+        """
+        stat = filepath.stat()
+        self._load(filepath.parent).add(
+            _record_key(stat, dfl_lvl, codec, shuffle, quantize)
+        )
+        self._append(
+            filepath, stat, DEFLATED, dfl_lvl, codec, shuffle, quantize
+        )
+
+    def journal(self, job, state):
+        """Record the state of a deflation job.
+
+        The record is flushed to disk before this method returns.
+
+        :param job: Deflation job.
+        :type job: :py:class:`DeflateJob`
+
+        :param str state: One of :py:data:`STARTED`, :py:data:`WRITTEN`,
+                          or :py:data:`FAILED`.
+        """
+        try:
+            stat = job.filepath.stat()
+        except OSError:
+            return
+        fields = {}
+        if job.scratch_dir is not None:
+            fields['tmp_filepath'] = fspath(job.tmp_filepath)
+        if job.dest_filepath is not None:
+            fields['dest_filepath'] = fspath(job.dest_filepath)
+        self._append(
+            job.filepath,
+            stat,
+            state,
+            job.dfl_lvl,
+            job.codec,
+            job.shuffle,
+            job.quantize,
+            sync=True,
+            **fields
+        )
+
+    def unfinished(self, dir_path):
+        """Return the last journal records of the files in dir_path whose
+        deflation jobs were started but never finished or failed.
+
+        :param dir_path: Directory to check.
+        :type dir_path: :py:class:`pathlib.Path`
+
+        :returns: Last journal records by file name.
+        :rtype: dict
+        """
+        self._load(dir_path)
+        return {
+            name: record
+            for name, record in self.states[dir_path].items()
+            if record['state'] in (STARTED, WRITTEN)
+        }
+
+    def _append(
+        self,
+        filepath,
+        stat,
+        state,
+        dfl_lvl,
+        codec,
+        shuffle=True,
+        quantize=None,
+        sync=False,
+        **fields
+    ):
+        record = dict(
+            fields,
+            name=filepath.name,
+            state=state,
+            inode=stat.st_ino,
+            size=stat.st_size,
+            mtime_ns=verify_plugin.mtime_ns(stat),
+            dfl_lvl=dfl_lvl,
+            codec=codec,
+            shuffle=shuffle,
+            quantize=quantize or None,
+        )
+        with self.lock:
+            self._load(filepath.parent)
+            self.states[filepath.parent][filepath.name] = record
+            try:
+                with (filepath.parent / DEFLATED_RECORD).open('a+b') as f:
+                    # A line left partially written by a crash has to be
+                    # terminated so that it doesn't swallow this record
+                    f.seek(0, os.SEEK_END)
+                    if f.tell():
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b'\n':
+                            f.write(b'\n')
+                    f.write(
+                        u'{}\n'.format(json.dumps(record, sort_keys=True)).
+                        encode('utf-8')
+                    )
+                    if sync:
+                        f.flush()
+                        os.fsync(f.fileno())
+            except (IOError, OSError) as exc:
+                logger.warning(
+                    'unable to record that {} is {}: {}'.format(
+                        filepath, state, exc
+                    )
+                )
+
+    def _load(self, dir_path):
+        if dir_path not in self.entries:
+            self.entries[dir_path] = set()
+            self.states[dir_path] = {}
+            try:
+                with (dir_path / DEFLATED_RECORD).open('rt') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                            # Records written before the shuffle setting and
+                            # quantization were recorded lack them
+                            key = (
+                                record['inode'], record['size'],
+                                record['mtime_ns'], record['dfl_lvl'],
+                                record.get('codec', 'zlib'),
+                                record.get('shuffle', True),
+                                _quantize_key(record.get('quantize'))
+                            )
+                            state = record.setdefault('state', DEFLATED)
+                            self.states[dir_path][record['name']] = record
+                        except (ValueError, KeyError):
+                            # Partially written line
+                            continue
+                        if state == DEFLATED:
+                            self.entries[dir_path].add(key)
+            except (IOError, OSError):
+                pass
+        return self.entries[dir_path]
+
+
+def _record_key(stat, dfl_lvl, codec, shuffle=True, quantize=None):
+    return (
+        stat.st_ino, stat.st_size, verify_plugin.mtime_ns(stat), dfl_lvl,
+        codec, shuffle, _quantize_key(quantize)
+    )
+
+
+def _quantize_key(quantize):
+    """Return a hashable form of a quantize mapping that is the same
+    after a round trip through JSON.
+    """
+    return tuple(sorted(quantize.items())) if quantize else None
+
+
+def _copy_verified(src, dst):
+    """Copy src to dst, then confirm that the size and CRC-32 checksum of
+    dst match those of src.
+
+    :raises: :py:exc:`IOError` if the verification fails.
+    """
+    crc = 0
+    with src.open('rb') as f_src, dst.open('wb') as f_dst:
+        for buf in iter(lambda: f_src.read(COPY_BUFSIZE), b''):
+            crc = zlib.crc32(buf, crc)
+            f_dst.write(buf)
+        f_dst.flush()
+        os.fsync(f_dst.fileno())
+    if dst.stat().st_size != src.stat().st_size:
+        raise IOError('size of {} does not match {}'.format(dst, src))
+    dst_crc = 0
+    with dst.open('rb') as f:
+        for buf in iter(lambda: f.read(COPY_BUFSIZE), b''):
+            dst_crc = zlib.crc32(buf, dst_crc)
+    if dst_crc != crc:
+        raise IOError('checksum of {} does not match {}'.format(dst, src))
+
+
+def _fsync(filepath):
+    fd = os.open(fspath(filepath), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _device(dir_path):
+    return os.stat(fspath(dir_path)).st_dev
+
+
+def _free_disk_space(dir_path):
+    stats = os.statvfs(fspath(dir_path))
+    return stats.f_bavail * stats.f_frsize
+
+
+def _available_memory():
+    """Return the memory in bytes available for new processes without
+    swapping as reported by :file:`/proc/meminfo`,
+    or :py:obj:`None` on systems that don't provide it.
+    """
+    try:
+        with open('/proc/meminfo', 'rt') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def deflate(
+    filepaths,
+    max_concurrent_jobs=None,
+    backend='nccopy',
+    split_large=False,
+    priorities=None,
+    force=False,
+    scratch_dir=None,
+    profile_dir=ncdeflate.PROFILE_DIR,
+    codec='zlib',
+    dfl_lvl=4,
+    shuffle=True,
+    quantize=None,
+    verify_samples=0,
+    json_report=False,
+    process_priority=None,
+    destinations=None
+):
     """Deflate variables in each of the netCDF files in filepaths using
-    Lempel-Ziv compression.
+    Lempel-Ziv compression,
+    or another compression codec.
 
     Converts files to netCDF-4 format.
-    The deflated file replaces the original file.
+    The deflated file replaces the original file,
+    unless a destination is given for it in destinations.
+
+    A new deflation job is launched as soon as a running one exits,
+    rather than on a polling interval.
+    Jobs are started in order of decreasing priority,
+    and largest file first within a priority,
+    so that a big file doesn't end up running alone at the end of the batch.
+    A job is only started when the free disk space and memory are estimated
+    to be sufficient for it;
+    otherwise the next job that fits is started,
+    or, if none fits and no jobs are running,
+    the check is retried with increasing intervals for up to
+    :py:data:`ADMISSION_TIMEOUT` seconds before the remaining files are
+    left undeflated.
+
+    Files that are recorded as having been deflated by a previous run,
+    or whose headers show that they are already deflated,
+    are skipped,
+    so re-running a partially failed batch only deflates the remaining files.
+    The state of each job is journaled in the :py:data:`DEFLATED_RECORD`
+    file of its directory,
+    and temporary files left by a batch that was killed part way through
+    are completed or deleted by :func:`recover` before the remaining files
+    are deflated.
+
+    A job that runs for longer than its timeout is killed;
+    see :py:class:`JobTimeouts`.
+    Failed jobs are retried up to :py:data:`MAX_RETRIES` times with
+    increasing delays while the rest of the batch carries on;
+    the files of jobs that fail permanently are left undeflated and are
+    listed in :py:attr:`DeflateReport.failed`.
 
     :param sequence filepaths: Paths/names of files to be deflated.
 
     :param int max_concurrent_jobs: Maximum number of concurrent deflation
     processes allowed.
+    If it is :py:obj:`None` the number of concurrent jobs is adapted to the
+    measured throughput,
+    up to the number of CPUs returned by :func:`available_cpus`;
+    see :py:class:`ConcurrencyController`.
+
+    :param str backend: Deflation engine to use; one of :py:data:`BACKENDS`.
+                        The netcdf4 backend deflates as many files at a
+                        time in-process as the concurrent job limit allows,
+                        and compresses their variable chunks on a pool of
+                        as many threads as the upper limit of concurrent
+                        jobs.
+
+    :param boolean split_large: Hand nccopy zlib jobs on files of
+                                :py:data:`LARGE_FILE_SIZE` or more to the
+                                netcdf4 backend so that their chunks are
+                                compressed in parallel on its thread pool.
+                                In-process jobs can't be killed when they
+                                run for longer than their timeouts.
+
+    :param dict priorities: Mapping of glob patterns to integer priorities
+                            for the files whose names match them;
+                            the highest matching priority applies.
+                            The default priority is 0.
+
+    :param boolean force: Deflate files even if they are recorded as
+                          deflated or their headers show that they are
+                          already deflated.
+
+    :param scratch_dir: Directory on fast local storage in which to write
+                        the temporary deflated files before copying them back
+                        beside the original files.
+                        Files for which there is not enough space in
+                        scratch_dir are deflated in place.
+    :type scratch_dir: :py:class:`pathlib.Path`
+
+    :param profile_dir: Directory of per-variable deflation profiles created
+                        by :func:`tune`.
+                        The profile for the model configuration that
+                        produced each file,
+                        if there is one,
+                        is applied when the codec is zlib;
+                        by per-variable options of :program:`nccopy` with
+                        the nccopy backend.
+                        A warning is logged if there are profiles that
+                        can't be applied.
+    :type profile_dir: :py:class:`pathlib.Path`
+
+    :param str codec: Compression codec to use;
+                      one of :py:data:`ncdeflate.CODECS`.
+                      Files compressed with codecs other than zlib are read
+                      back before they replace the original files to confirm
+                      that they can be decompressed.
+
+    :param int dfl_lvl: Compression level to use; 0 means no compression.
+
+    :param boolean shuffle: Shuffle the bytes of the values before
+                            compression;
+                            see :func:`ncdeflate.deflate_file`.
+
+    :param dict quantize: Mapping of glob patterns of variable names to the
+                          number of mantissa bits to keep in the floating
+                          point variables whose names match them;
+                          see :func:`ncdeflate.deflate_file`.
+                          Requires the netcdf4 backend.
+
+    :param int verify_samples: Number of randomly chosen hyperslabs of each
+                               variable to compare between each deflated
+                               file and its original,
+                               along with their metadata,
+                               before the original is replaced;
+                               see :func:`ncdeflate.verify_sample`.
+                               0 means no verification.
+
+    :param boolean json_report: Write the returned report as JSON to
+                                :py:data:`DEFLATE_REPORT` in the directory
+                                that contains filepaths.
+
+    :param process_priority: CPU and I/O scheduling priority settings to
+                             apply to the process before any jobs are
+                             started;
+                             the jobs inherit them.
+    :type process_priority: :py:class:`ProcessPriority`
+
+    :param dict destinations: Mapping of paths in filepaths to the
+                              paths/names to store their deflated files as
+                              instead of replacing them;
+                              the original files are deleted once their
+                              deflated files are stored.
+                              Files that are already deflated are left
+                              where they are.
+
+    :returns: Throughput and compression statistics of the batch and of each
+              file.
+    :rtype: :py:class:`DeflateReport`
+
+    :raises: :py:exc:`ValueError` if backend or codec is unknown,
+             the HDF5 filter for codec is not available,
+             quantize is used with the nccopy backend,
+             or verification is requested without the netCDF4 package.
     """
+    if backend not in BACKENDS:
+        raise ValueError('unknown deflate backend: {}'.format(backend))
+    if codec not in ncdeflate.CODECS:
+        raise ValueError('unknown compression codec: {}'.format(codec))
+    if quantize and backend != 'netcdf4':
+        raise ValueError('quantization requires the netcdf4 backend')
+    if verify_samples and not ncdeflate.available():
+        raise ValueError(
+            'verification requires the netCDF4, h5py, and numpy packages'
+        )
+    if not ncdeflate.codec_available(codec):
+        raise ValueError(
+            'HDF5 filter for {} compression is not available; '
+            'check HDF5_PLUGIN_PATH'.format(codec)
+        )
+    _check_profiles(profile_dir, codec)
+    t_start = time.time()
+    if process_priority is not None:
+        process_priority.apply()
+    if max_concurrent_jobs is None:
+        controller = ConcurrencyController.adaptive_up_to(available_cpus())
+    else:
+        controller = ConcurrencyController.fixed(max_concurrent_jobs)
     logger.info(
-        'Deflating in up to {} concurrent sub-processes'.
-        format(int(max_concurrent_jobs))
+        'Deflating with {} ({} level {}) in up to {} {}concurrent jobs'.
+        format(
+            backend, codec, dfl_lvl, controller.max_jobs,
+            'adaptive ' if controller.adaptive else ''
+        )
     )
-    jobs = [DeflateJob(fp) for fp in filepaths if fp.exists()]
-    jobs_in_progress = _launch_initial_jobs(jobs, max_concurrent_jobs)
-    while jobs or jobs_in_progress:
-        time.sleep(1)
-        _poll_and_launch(jobs, jobs_in_progress)
+    records = DeflatedRecords()
+    filepaths = list(_unique(filepaths))
+    recover(filepaths, records)
+    jobs = _schedule(
+        filepaths,
+        backend,
+        priorities or {},
+        records,
+        force,
+        codec=codec,
+        dfl_lvl=dfl_lvl,
+        shuffle=shuffle,
+        destinations=destinations,
+        profile_dir=profile_dir,
+        quantize=quantize
+    )
+    for job in jobs:
+        if scratch_dir is not None:
+            job.scratch_dir = Path(scratch_dir)
+        job.profile_dir = profile_dir
+        job.verify_samples = verify_samples
+        if split_large and _split_in_process(job, controller.max_jobs):
+            logger.info(
+                'deflating {0.filepath} ({1:.1f} GB) with the netcdf4 '
+                'backend in parallel in-process, without a timeout'.format(
+                    job, job.size / 1024**3
+                )
+            )
+            job.backend = 'netcdf4'
+    report = DeflateReport(
+        backend, codec, dfl_lvl, n_skipped=len(filepaths) - len(jobs)
+    )
+    scheduled_jobs = list(jobs)
+    executor = (
+        ThreadPoolExecutor(controller.max_jobs)
+        if any(job.backend == 'netcdf4' for job in jobs) else None
+    )
+    finished_jobs = queue.Queue()
+    admission = AdmissionControl()
+    timeouts = JobTimeouts()
+    jobs_in_progress = {}
+    try:
+        while jobs or jobs_in_progress:
+            _launch_jobs(
+                jobs, jobs_in_progress, controller.jobs, admission,
+                finished_jobs, executor, records
+            )
+            wait_time = _wait_time(jobs, jobs_in_progress, timeouts)
+            if jobs_in_progress:
+                try:
+                    finished_job = finished_jobs.get(timeout=wait_time)
+                except queue.Empty:
+                    for job, timeout in timeouts.overdue(jobs_in_progress):
+                        job.kill(timeout)
+                    continue
+                _finish_job(
+                    finished_job, jobs_in_progress, admission, records
+                )
+                controller.record(finished_job)
+                timeouts.record(finished_job)
+                if finished_job.returncode != 0:
+                    _retry(finished_job, jobs)
+            elif all(job.not_before > time.time() for job in jobs):
+                time.sleep(wait_time)
+            else:
+                _back_off(
+                    jobs, jobs_in_progress, controller.jobs, admission,
+                    finished_jobs, executor, records
+                )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    report.jobs = [JobStats.from_job(job) for job in scheduled_jobs]
+    report.wall_time = time.time() - t_start
+    if report.jobs:
+        logger.info(report.summary())
+    if json_report and filepaths:
+        report_file = _common_dir(filepaths) / DEFLATE_REPORT
+        report.write_json(report_file)
+        logger.info('Wrote deflation report to {}'.format(report_file))
+    return report
 
 
-def _launch_initial_jobs(jobs, max_concurrent_jobs):
-    jobs_in_progress = {}
-    for process in range(int(max_concurrent_jobs)):
+def watch(
+    dir_path,
+    max_concurrent_jobs=None,
+    settle_time=filewatch.SETTLE_TIME,
+    pattern='*.nc',
+    stop=None,
+    json_report=False,
+    process_priority=None,
+    **kwargs
+):
+    """Deflate the netCDF files in dir_path as a running model finishes
+    writing them.
+
+    Unless process_priority sets a niceness,
+    the process lowers its CPU priority to a niceness of at least
+    :py:data:`WATCH_NICENESS`,
+    and deflates the finished files one at a time,
+    so that deflation uses the cycles that the model leaves idle,
+    e.g. while it waits on MPI communication or I/O.
+    See :py:mod:`fvcom_cmd.filewatch` for how finished files are detected.
+
+    Watching ends when the stop event is set,
+    or, when called in the main thread without a stop event,
+    on SIGTERM or SIGINT.
+    The remaining files,
+    normally just the last file of each series,
+    are then deflated with up to max_concurrent_jobs concurrent jobs.
+    They are deflated at the same niceness as the others because
+    an unprivileged process can't lower its niceness again.
+
+    :param dir_path: Directory to watch.
+    :type dir_path: :py:class:`pathlib.Path`
+
+    :param int max_concurrent_jobs: Maximum number of concurrent deflation
+                                    jobs for the files that remain when
+                                    watching ends;
+                                    see :func:`deflate`.
+
+    :param float settle_time: Seconds that a file has to be closed and
+                              unchanged to be considered finished.
+
+    :param str pattern: Glob pattern of the names of the files to deflate.
+
+    :param stop: Event to set to end watching.
+    :type stop: :py:class:`threading.Event`
+
+    :param boolean json_report: Write the returned report as JSON to
+                                :py:data:`DEFLATE_REPORT` in dir_path.
+
+    :param process_priority: CPU and I/O scheduling priority settings to
+                             apply to the process before watching starts.
+    :type process_priority: :py:class:`ProcessPriority`
+
+    :param kwargs: Other keyword arguments of :func:`deflate`.
+
+    :returns: Throughput and compression statistics of all of the files.
+    :rtype: :py:class:`DeflateReport`
+    """
+    t_start = time.time()
+    dir_path = Path(dir_path)
+    if process_priority is not None:
+        process_priority.apply()
+    if (process_priority is None or process_priority.nice is None) and (
+        hasattr(os, 'nice') and os.nice(0) < WATCH_NICENESS
+    ):
+        os.nice(WATCH_NICENESS - os.nice(0))
+    watcher = filewatch.FileWatcher(dir_path, pattern, settle_time)
+    watcher.start()
+    logger.info(
+        'Watching {} for finished {} files to deflate'.format(
+            dir_path, pattern
+        )
+    )
+    batches = []
+    previous_handlers = {}
+    if stop is None:
+        stop = threading.Event()
         try:
-            job = jobs.pop(0)
-        except IndexError:
-            break
-        else:
-            job.start()
-            jobs_in_progress[job.pid] = job
-    return jobs_in_progress
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                previous_handlers[signum] = signal.signal(
+                    signum, lambda signum, frame: stop.set()
+                )
+        except ValueError:
+            # Signal handlers can only be installed in the main thread
+            pass
+    try:
+        while not stop.is_set():
+            watcher.wait(WATCH_WAKE_INTERVAL)
+            finished = watcher.finished()
+            if finished:
+                batches.append(deflate(finished, 1, **kwargs))
+        logger.info('Deflating remaining files in {}'.format(dir_path))
+        batches.append(
+            deflate(watcher.remaining(), max_concurrent_jobs, **kwargs)
+        )
+    finally:
+        watcher.close()
+        for signum, handler in previous_handlers.items():
+            # None means that the handler wasn't installed from Python
+            if handler is not None:
+                signal.signal(signum, handler)
+    report = DeflateReport(
+        batches[-1].backend,
+        batches[-1].codec,
+        batches[-1].dfl_lvl,
+        jobs=[job for batch in batches for job in batch.jobs],
+        n_skipped=sum(batch.n_skipped for batch in batches),
+        wall_time=time.time() - t_start
+    )
+    if report.jobs:
+        logger.info(report.summary())
+    if json_report:
+        report_file = dir_path / DEFLATE_REPORT
+        report.write_json(report_file)
+        logger.info('Wrote deflation report to {}'.format(report_file))
+    return report
+
+
+def _common_dir(filepaths):
+    """Return the deepest directory that contains all of filepaths.
+    """
+    return Path(
+        os.path.commonpath([
+            fspath(fp.resolve().parent) for fp in filepaths
+        ])
+    )
+
 
+def recover(filepaths, records):
+    """Tidy up after deflation jobs on filepaths that were interrupted,
+    e.g. because the batch job running them was killed at its wall time
+    limit.
 
-def _poll_and_launch(jobs, jobs_in_progress):
-    for running_job in jobs_in_progress.copy().values():
-        if running_job.done:
-            result, _ = running_job.process.communicate()
-            logger.error(result) if result else logger.info(
-                'netCDF4 deflated {.filepath}'.format(running_job)
+    Interrupted jobs are found in the journal in records.
+    A job that had completely written its temporary deflated file beside the
+    original file is completed by renaming the temporary file over the
+    original file,
+    provided that the original file hasn't changed since;
+    a job that was storing its deflated file elsewhere,
+    e.g. in a results directory,
+    is completed by renaming the temporary file there and deleting the
+    original file.
+    The temporary files of the other interrupted jobs are deleted,
+    as are temporary files beside filepaths that aren't in the journal.
+
+    :param sequence filepaths: Paths/names of files to be deflated.
+
+    :param records: Deflated file records and job journal.
+    :type records: :py:class:`DeflatedRecords`
+
+    :returns: Paths/names of the files whose deflation was completed.
+    :rtype: list
+    """
+    completed = []
+    for dir_path in sorted({fp.parent for fp in filepaths}):
+        for name, record in sorted(records.unfinished(dir_path).items()):
+            job = DeflateJob(
+                dir_path / name,
+                dfl_lvl=record['dfl_lvl'],
+                codec=record['codec'],
+                shuffle=record.get('shuffle', True),
+                quantize=record.get('quantize'),
+                dest_filepath=record.get('dest_filepath')
             )
-            jobs_in_progress.pop(running_job.pid)
-            try:
-                job = jobs.pop(0)
-            except IndexError:
+            if record['state'] == WRITTEN and _adoptable(job, record):
+                job.replacement_filepath.rename(job.target_filepath)
+                records.add(
+                    job.target_filepath, job.dfl_lvl, job.codec, job.shuffle,
+                    job.quantize
+                )
+                if job.dest_filepath is not None:
+                    job.filepath.unlink()
+                completed.append(job.filepath)
+                logger.info(
+                    'completed interrupted deflation of {.filepath}'.
+                    format(job)
+                )
                 continue
-            else:
-                job.start()
-                jobs_in_progress[job.pid] = job
+            tmp_filepaths = [job.replacement_filepath]
+            if record.get('tmp_filepath') is not None:
+                tmp_filepaths.append(Path(record['tmp_filepath']))
+            for tmp_filepath in tmp_filepaths:
+                if tmp_filepath.exists():
+                    tmp_filepath.unlink()
+                    logger.info(
+                        'removed {} left by interrupted deflation'.
+                        format(tmp_filepath)
+                    )
+            records.journal(job, FAILED)
+    for fp in filepaths:
+        tmp_filepath = DeflateJob(fp).replacement_filepath
+        if tmp_filepath.exists():
+            tmp_filepath.unlink()
+            logger.info('removed orphaned {}'.format(tmp_filepath))
+    return completed
+
+
+def _adoptable(job, record):
+    """Return a boolean indicating whether or not the temporary deflated
+    file of an interrupted job can replace the original file.
+    """
+    try:
+        stat = job.filepath.stat()
+        with job.replacement_filepath.open('rb') as f:
+            signature = f.read(len(ncdeflate.HDF5_SIGNATURE))
+    except (IOError, OSError):
+        return False
+    return (
+        (stat.st_ino, stat.st_size, verify_plugin.mtime_ns(stat)) ==
+        (record['inode'], record['size'], record['mtime_ns'])
+        and signature == ncdeflate.HDF5_SIGNATURE
+    )
+
+
+def _schedule(
+    filepaths,
+    backend,
+    priorities,
+    records,
+    force=False,
+    codec='zlib',
+    dfl_lvl=4,
+    shuffle=True,
+    destinations=None,
+    profile_dir=None,
+    quantize=None
+):
+    """Create deflation jobs for the files that exist in filepaths,
+    ordered by decreasing priority, and by decreasing size within a
+    priority (longest processing time first).
+
+    Unless force is :py:obj:`True`, files that are recorded as deflated,
+    or whose headers show that they are already deflated,
+    with the deflation profile in profile_dir if there is one for them,
+    and with the quantization in quantize,
+    are skipped.
+
+    The jobs of files in the destinations mapping store their deflated
+    files at the mapped paths.
+    """
+    jobs = []
+    n_skipped = 0
+    for fp in filepaths:
+        try:
+            size = fp.stat().st_size
+        except OSError:
+            continue
+        job = DeflateJob(
+            fp,
+            dfl_lvl=dfl_lvl,
+            backend=backend,
+            size=size,
+            priority=_priority(fp, priorities),
+            codec=codec,
+            shuffle=shuffle,
+            quantize=quantize,
+            dest_filepath=(destinations or {}).get(fp)
+        )
+        if not force and _already_deflated(job, records, profile_dir):
+            logger.debug('{.filepath} is already deflated'.format(job))
+            n_skipped += 1
+            continue
+        jobs.append(job)
+    if n_skipped:
+        logger.info(
+            'Skipping {} files that are already deflated'.format(n_skipped)
+        )
+    jobs.sort(key=lambda job: (job.priority, job.size), reverse=True)
+    return jobs
+
+
+def _split_in_process(job, max_workers):
+    """Return :py:obj:`True` if job is an nccopy job on a file of at least
+    :py:data:`LARGE_FILE_SIZE` that the in-process engine can deflate in
+    parallel on max_workers threads instead.
+
+    The in-process engine only parallelizes zlib compression.
+    """
+    return (
+        job.backend == 'nccopy' and job.codec == 'zlib'
+        and job.size >= LARGE_FILE_SIZE and max_workers > 1
+        and ncdeflate.available()
+    )
+
+
+def _check_profiles(profile_dir, codec):
+    """Log a warning if there are deflation profiles in profile_dir that
+    won't be applied.
+    """
+    if profile_dir is None:
+        return
+    profile_dir = expanded_path(profile_dir)
+    if not profile_dir.is_dir() or not any(profile_dir.glob('*.yaml')):
+        return
+    if codec != 'zlib':
+        logger.warning(
+            'deflation profiles in {} are only applied with the zlib codec; '
+            'deflating all variables with {}'.format(profile_dir, codec)
+        )
+    elif ncdeflate.netCDF4 is None:
+        logger.warning(
+            'applying the deflation profiles in {} requires the netCDF4 '
+            'package; deflating all variables at the same level'.
+            format(profile_dir)
+        )
+
+
+def _already_deflated(job, records, profile_dir=None):
+    settings = (job.dfl_lvl, job.codec, job.shuffle, job.quantize)
+    if records.contains(job.filepath, *settings):
+        return True
+    if ncdeflate.is_deflated(
+        job.filepath,
+        job.dfl_lvl,
+        job.codec,
+        job.shuffle,
+        profile_dir,
+        quantize=job.quantize
+    ):
+        records.add(job.filepath, *settings)
+        return True
+    return False
+
+
+def _priority(filepath, priorities):
+    matches = [
+        priority for pattern, priority in priorities.items()
+        if fnmatch.fnmatch(filepath.name, pattern)
+    ]
+    return max(matches) if matches else 0
+
+
+def tune(filepaths, profile_dir=ncdeflate.PROFILE_DIR):
+    """Calculate and store a per-variable deflation profile for each of the
+    netCDF files in filepaths.
+
+    The variables in each file are sampled to find the compression level and
+    shuffle setting that give close to the best compression ratio for the
+    least CPU time.
+    The profile is stored in profile_dir under a signature of the model
+    configuration that produced the file,
+    from where it is applied to files from the same configuration that are
+    deflated with zlib.
+
+    :param sequence filepaths: Paths/names of files to tune on.
+
+    :param profile_dir: Directory in which to store the profiles.
+    :type profile_dir: :py:class:`pathlib.Path`
+
+    :returns: Paths/names of the profile files.
+    :rtype: list
+    """
+    profile_files = []
+    for fp in _unique(filepaths):
+        profile = ncdeflate.tune(fp)
+        profile_file = ncdeflate.save_profile(profile, profile_dir)
+        for name, settings in sorted(profile['variables'].items()):
+            logger.info(
+                '{fp}: {name}: level {dfl_lvl}, shuffle {shuffle}, '
+                'ratio {ratio}'.format(fp=fp, name=name, **settings)
+            )
+        logger.info(
+            'Stored deflation profile for {} in {}'.format(fp, profile_file)
+        )
+        profile_files.append(profile_file)
+    return profile_files
+
+
+def _unique(filepaths):
+    seen = set()
+    for fp in filepaths:
+        if fspath(fp) not in seen:
+            seen.add(fspath(fp))
+            yield fp
+
+
+def _launch_jobs(
+    jobs,
+    jobs_in_progress,
+    max_concurrent_jobs,
+    admission,
+    finished_jobs,
+    executor=None,
+    records=None
+):
+    """Start the first jobs in the jobs list that are admitted until there
+    are max_concurrent_jobs in progress.
+
+    The start of each job is journaled in records.
+    """
+    while jobs and len(jobs_in_progress) < max_concurrent_jobs:
+        now = time.time()
+        for i, job in enumerate(jobs):
+            if job.not_before > now:
+                continue
+            if _admit(job, jobs_in_progress, admission):
+                break
+        else:
+            return
+        jobs.pop(i)
+        if records is not None:
+            records.journal(job, STARTED)
+        job.start(finished_jobs, executor)
+        jobs_in_progress[job.filepath] = job
+
+
+def _admit(job, jobs_in_progress, admission):
+    """Return a boolean indicating whether or not job can be started.
+
+    A job that is to be staged in a scratch directory falls back to being
+    deflated in place if there isn't enough space in the scratch directory.
+    """
+    if job.scratch_dir is None:
+        return admission.admits(job, jobs_in_progress)
+    if admission.admits(job, jobs_in_progress):
+        return True
+    scratch_dir, job.scratch_dir = job.scratch_dir, None
+    if admission.admits(job, jobs_in_progress):
+        logger.info(
+            'not enough space in {} for {.filepath}; deflating in place'.
+            format(scratch_dir, job)
+        )
+        return True
+    job.scratch_dir = scratch_dir
+    return False
+
+
+def _back_off(
+    jobs,
+    jobs_in_progress,
+    max_concurrent_jobs,
+    admission,
+    finished_jobs,
+    executor=None,
+    records=None
+):
+    """Wait with increasing intervals for enough free disk space and memory
+    to start a job when no jobs are in progress.
+
+    Give up on the remaining jobs after :py:data:`ADMISSION_TIMEOUT`
+    seconds.
+    """
+    delay, waited = 1, 0
+    while jobs and not jobs_in_progress:
+        if waited >= ADMISSION_TIMEOUT:
+            for job in jobs:
+                logger.error(
+                    'not enough free disk space or memory to deflate '
+                    '{.filepath}; file left undeflated'.format(job)
+                )
+            del jobs[:]
+            return
+        logger.warning(
+            'not enough free disk space or memory to deflate {.filepath}; '
+            'retrying in {} seconds'.format(jobs[0], delay)
+        )
+        time.sleep(delay)
+        waited += delay
+        delay = min(delay * 2, MAX_BACKOFF)
+        _launch_jobs(
+            jobs, jobs_in_progress, max_concurrent_jobs, admission,
+            finished_jobs, executor, records
+        )
+
+
+def _wait_time(jobs, jobs_in_progress, timeouts):
+    """Return the time in seconds until the next job in progress times
+    out or the next job that is waiting to be retried can be started;
+    :py:obj:`None` if there is nothing to wait for.
+    """
+    times = [job.not_before for job in jobs if job.not_before]
+    deadline = timeouts.next_deadline(jobs_in_progress)
+    if deadline is not None:
+        times.append(deadline)
+    if not times:
+        return None
+    return max(min(times) - time.time(), 0)
+
+
+def _retry(job, jobs):
+    """Put a failed job back at the front of the jobs list to be retried
+    after a delay that doubles with each attempt,
+    unless it has already been retried :py:data:`MAX_RETRIES` times.
+
+    Jobs that timed out or exited with an error are retried;
+    jobs whose deflated files failed verification are not,
+    because deflating the file again would give the same result.
+    """
+    if job.mismatches and not job.timed_out:
+        logger.error(
+            'not retrying deflation of {.filepath} because the deflated '
+            'file failed verification; file left undeflated'.format(job)
+        )
+        return
+    if job.attempts > MAX_RETRIES:
+        logger.error(
+            'giving up on deflating {0.filepath} after {0.attempts} attempts; '
+            'file left undeflated'.format(job)
+        )
+        return
+    delay = min(RETRY_DELAY * 2**(job.attempts - 1), MAX_BACKOFF)
+    logger.warning(
+        'retrying deflation of {0.filepath} in {1} seconds '
+        '(attempt {2} of {3})'.format(
+            job, delay, job.attempts + 1, MAX_RETRIES + 1
+        )
+    )
+    job.reset(not_before=time.time() + delay)
+    jobs.insert(0, job)
+
+
+def _finish_job(finished_job, jobs_in_progress, admission, records):
+    if finished_job.returncode == 0:
+        records.journal(finished_job, WRITTEN)
+    try:
+        finished_job.finish()
+    except (IOError, OSError) as exc:
+        # Fail the job so that the rest of the batch carries on
+        finished_job.output.append(
+            'storing deflated {}: {}\n'.format(finished_job.filepath, exc)
+        )
+        finished_job.returncode = 1
+        try:
+            finished_job.finish()
+        except (IOError, OSError):
+            pass
+    admission.record(finished_job)
+    if finished_job.returncode == 0:
+        records.add(
+            finished_job.target_filepath, finished_job.dfl_lvl,
+            finished_job.codec, finished_job.shuffle, finished_job.quantize
+        )
+    else:
+        records.journal(finished_job, FAILED)
+    result = ''.join(finished_job.output)
+    if result:
+        logger.error(result)
+    elif finished_job.returncode != 0:
+        logger.error(
+            'deflating {0.filepath} failed '
+            'with return code {0.returncode}'.format(finished_job)
+        )
+    else:
+        logger.info(
+            'netCDF4 deflated {0.filepath}: {in_mb:.1f} MB to {out_mb:.1f} MB '
+            'in {0.wall_time:.1f} s'.format(
+                finished_job,
+                in_mb=finished_job.size / 1e6,
+                out_mb=finished_job.deflated_size / 1e6
+            )
+        )
+    jobs_in_progress.pop(finished_job.filepath)
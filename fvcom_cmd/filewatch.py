@@ -0,0 +1,301 @@
+# Copyright 2013-2017 The Salish Sea MEOPAR Contributors
+# and The University of British Columbia
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Detection of the files in a directory that a running model has finished
+writing.
+
+FVCOM opens and closes its netCDF output files each time it writes a
+record,
+so a file having been closed doesn't mean that it is finished.
+A file is taken to be finished when it has been closed and left unchanged
+for a settling time,
+and the model has gone on to write a later file in the same numbered
+series,
+e.g. :file:`casename_0002.nc` after :file:`casename_0001.nc`.
+The last file of each series is only finished when the model exits.
+
+File activity is detected with Linux inotify,
+via ctypes,
+where it is available,
+and by polling the sizes and modification times of the files.
+inotify only reports the writes of the node that it runs on,
+so the files are polled in inotify mode too,
+to catch writes from the other nodes of a parallel or network file system
+like Lustre or NFS.
+"""
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import logging
+import os
+import re
+import select
+import struct
+import time
+
+import attr
+
+from fvcom_cmd.fspath import fspath
+
+logger = logging.getLogger(__name__)
+
+#: Seconds that a closed file has to be left unchanged before it is
+#: considered finished.
+SETTLE_TIME = 30
+#: Seconds between scans of the directory.
+POLL_INTERVAL = 10
+
+# inotify event masks from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+_IN_CLOEXEC = 0o2000000
+_IN_NONBLOCK = 0o4000
+_EVENT_HEADER = struct.Struct('iIII')
+
+#: Trailing sequence number of the files in a series.
+_SEQUENCE_NUMBER = re.compile(r'(\d+)(\.[^.]*)$')
+
+
+@attr.s
+class FileState(object):
+    """Activity state of a watched file.
+    """
+    #: Time of the most recent change to the file.
+    changed = attr.ib()
+    #: The file has been opened for writing and not yet closed,
+    #: as far as is known.
+    open = attr.ib(default=False)
+    #: Size and modification time at the most recent poll.
+    signature = attr.ib(default=None)
+    #: The file has been reported as finished and should not be reported
+    #: again.
+    done = attr.ib(default=False)
+
+
+@attr.s
+class FileWatcher(object):
+    """Watcher of the files in a directory that match a glob pattern.
+
+    Call :py:meth:`wait` repeatedly to collect file activity,
+    and :py:meth:`finished` to get the files that are finished.
+    Files are only reported as finished once.
+    """
+    #: Directory to watch.
+    dir_path = attr.ib()
+    #: Glob pattern of the names of the files to watch.
+    pattern = attr.ib(default='*.nc')
+    #: Seconds that a closed file has to be left unchanged before it is
+    #: considered finished.
+    settle_time = attr.ib(default=SETTLE_TIME)
+    #: Seconds between scans of the directory.
+    poll_interval = attr.ib(default=POLL_INTERVAL)
+    #: States of the watched files by name.
+    files = attr.ib(default=attr.Factory(dict))
+    #: inotify file descriptor; :py:obj:`None` when polling.
+    inotify_fd = attr.ib(default=None)
+    #: Time of the most recent scan of the directory.
+    last_scan = attr.ib(default=0)
+
+    def start(self, use_inotify=True):
+        """Start watching.
+
+        Files that already exist are treated as closed since their last
+        modification.
+
+        :param boolean use_inotify: Use inotify if it is available;
+                                    otherwise poll.
+        """
+        if use_inotify:
+            self.inotify_fd = _inotify_watch(self.dir_path)
+        logger.debug(
+            'watching {} for {} files {}'.format(
+                self.dir_path, self.pattern,
+                'via inotify' if self.inotify_fd is not None else 'by polling'
+            )
+        )
+        self._scan(initial=True)
+
+    def close(self):
+        """Stop watching.
+        """
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for file activity and record it.
+
+        The directory is scanned every :py:attr:`poll_interval` seconds,
+        whether or not inotify is used.
+
+        :param float timeout: Seconds to wait.
+        """
+        if self.inotify_fd is None:
+            time.sleep(timeout)
+        else:
+            self._read_events(timeout)
+        if time.time() - self.last_scan >= self.poll_interval:
+            self._scan()
+
+    def _read_events(self, timeout):
+        readable, _, _ = select.select([self.inotify_fd], [], [], timeout)
+        if not readable:
+            return
+        try:
+            data = os.read(self.inotify_fd, 64 * 1024)
+        except OSError as exc:
+            if exc.errno == errno.EAGAIN:
+                return
+            raise
+        now = time.time()
+        for mask, name in _inotify_events(data):
+            if mask & IN_Q_OVERFLOW:
+                logger.debug('inotify queue overflowed; rescanning')
+                self._scan()
+                continue
+            if not fnmatch.fnmatch(name, self.pattern):
+                continue
+            state = self.files.setdefault(name, FileState(now))
+            state.changed = now
+            state.open = not mask & (IN_CLOSE_WRITE | IN_MOVED_TO)
+
+    def finished(self, now=None):
+        """Return the watched files that are finished:
+        closed, unchanged for :py:attr:`settle_time` seconds,
+        and followed by a later file in their series.
+
+        :param float now: Time to judge settling against;
+                          defaults to the current time.
+
+        :returns: Paths of the finished files in series order.
+        :rtype: list
+        """
+        now = time.time() if now is None else now
+        series = {}
+        for name in self.files:
+            key, number = series_key(name)
+            series.setdefault(key, []).append((number, name))
+        finished = []
+        for members in series.values():
+            members.sort()
+            for number, name in members[:-1]:
+                state = self.files[name]
+                settled = now - state.changed >= self.settle_time
+                if not (state.done or state.open) and settled:
+                    state.done = True
+                    finished.append(self.dir_path / name)
+        return sorted(finished, key=lambda fp: series_key(fp.name))
+
+    def remaining(self):
+        """Return the watched files that have not been reported as
+        finished,
+        e.g. the last file of each series when the model has exited.
+
+        :returns: Paths of the files in series order.
+        :rtype: list
+        """
+        self._scan()
+        remaining = [
+            self.dir_path / name for name, state in self.files.items()
+            if not state.done
+        ]
+        for fp in remaining:
+            self.files[fp.name].done = True
+        return sorted(remaining, key=lambda fp: series_key(fp.name))
+
+    def _scan(self, initial=False):
+        now = self.last_scan = time.time()
+        try:
+            names = os.listdir(fspath(self.dir_path))
+        except OSError:
+            return
+        for name in fnmatch.filter(names, self.pattern):
+            try:
+                stat = os.stat(fspath(self.dir_path / name))
+            except OSError:
+                continue
+            signature = (stat.st_size, stat.st_mtime)
+            state = self.files.get(name)
+            if state is None:
+                self.files[name] = FileState(
+                    stat.st_mtime if initial else now, signature=signature
+                )
+            elif state.signature is None:
+                # First scan of a file found by inotify
+                state.signature = signature
+            elif state.signature != signature:
+                state.changed, state.signature = now, signature
+
+
+def series_key(name):
+    """Return the series that a file name belongs to,
+    and its sequence number in the series.
+
+    The series is the name with its trailing sequence number removed;
+    files without a sequence number are series of 1.
+
+    :param str name: File name.
+
+    :returns: Series name, sequence number.
+    :rtype: tuple
+    """
+    match = _SEQUENCE_NUMBER.search(name)
+    if match is None:
+        return name, 0
+    return name[:match.start()] + match.group(2), int(match.group(1))
+
+
+def _inotify_watch(dir_path):
+    """Return an inotify file descriptor watching dir_path,
+    or :py:obj:`None` if inotify is not available.
+    """
+    try:
+        libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True
+        )
+        inotify_init1 = libc.inotify_init1
+        inotify_add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    fd = inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    if fd < 0:
+        return None
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    if inotify_add_watch(fd, fspath(dir_path).encode('utf-8'), mask) < 0:
+        logger.debug(
+            'unable to watch {} via inotify: {}'.format(
+                dir_path, os.strerror(ctypes.get_errno())
+            )
+        )
+        os.close(fd)
+        return None
+    return fd
+
+
+def _inotify_events(data):
+    """Parse the inotify events in data.
+
+    :returns: Iterator of event mask, file name pairs.
+    """
+    offset = 0
+    while offset + _EVENT_HEADER.size <= len(data):
+        wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+        offset += _EVENT_HEADER.size
+        name = data[offset:offset + length].rstrip(b'\0').decode('utf-8')
+        offset += length
+        yield mask, name
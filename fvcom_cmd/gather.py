@@ -15,21 +15,141 @@
 """FVCOM-Cmd command plug-in for gather sub-command.
 
 Gather results files from a FVCOM run into a specified directory.
+
+The entries in the run directory are listed once with :func:`os.scandir`.
+Those on the same file system as the results directory are renamed into it,
+and the files of the others are copied on a pool of threads before the
+originals are deleted,
+so that gathering from scratch storage to project storage isn't limited to
+the throughput of a single stream.
+
+Each file is copied by the first of :py:data:`COPY_METHODS` that works for
+it:
+a hard link when the rename of an entry fails but source and destination
+are on the same file system,
+e.g. when the destination directory already exists;
+a reflink on file systems that share data blocks between files,
+e.g. Btrfs and XFS;
+kernel-side copying with :func:`os.copy_file_range` or :func:`os.sendfile`;
+and a buffered copy through user space.
+Methods that fail with an error that means they aren't supported between
+two file systems aren't tried again for that pair.
+
+With :kbd:`--deflate` the netCDF files are deflated straight into the
+results directory instead,
+so that each byte of them is read once from the run directory and only
+the compressed bytes are written;
+see :func:`_deflate_results`.
+
+With :kbd:`--pack` the small files,
+like namelists and logs,
+are packed into one indexed zip archive in the results directory instead
+of being moved one by one;
+see :py:mod:`fvcom_cmd.pack`.
+
+With :kbd:`--dedup` the gathered files are hard-linked to the objects
+with the same contents in a content-addressed store in the results root,
+the parent directory of the results directory,
+so that files that are identical across runs are stored once;
+see :py:mod:`fvcom_cmd.dedup`.
+
+With :kbd:`--manifest` a checksum manifest of the results directory is
+written for :command:`fvc verify`;
+see :py:mod:`fvcom_cmd.verify`.
+Files are then copied with the buffered copy so that they are hashed as
+they stream through it,
+without a separate read pass.
+Files that are renamed or hard-linked are read to hash them.
+
+Renames are atomic,
+but copies are not,
+so the files to be copied are journaled in the results directory before
+any of them is copied,
+and each copy is journaled once it has been flushed to disk,
+before its original is deleted;
+see :py:class:`GatherJournal`.
+Re-running a gather that was interrupted,
+e.g. by the wall time limit of the batch job running it,
+completes or rolls back the copies that were in progress and moves only
+the remaining entries.
+
+With :kbd:`--watch DIR` the output files in DIR are gathered in the
+background while the model runs,
+as it finishes writing each of them;
+see :func:`watch`.
+Copies can be limited to a bandwidth with :kbd:`--bwlimit` so that they
+don't compete with the model's own output for file system bandwidth.
 """
+from __future__ import division
+
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import fcntl
+import fnmatch
+import json
 import logging
-import shutil
+import os
+try:
+    from os import scandir
+except ImportError:
+    # Python 2.7
+    from scandir import scandir
 try:
     from pathlib import Path
 except ImportError:
     # Python 2.7
     from pathlib2 import Path
+import shutil
+import signal
+import threading
+import time
 
+import attr
 import cliff.command
 
+from fvcom_cmd import dedup as dedup_plugin
+from fvcom_cmd import deflate as deflate_plugin
+from fvcom_cmd import filewatch
+from fvcom_cmd import pack as pack_plugin
+from fvcom_cmd import verify as verify_plugin
 from fvcom_cmd.fspath import fspath
+from fvcom_cmd.process_priority import ProcessPriority, add_arguments
 
 logger = logging.getLogger(__name__)
 
+#: Default number of threads that copy files to a results directory on a
+#: different file system.
+GATHER_THREADS = 4
+#: Size in bytes of the buffer used to copy files.
+COPY_BUFSIZE = 16 * 1024**2
+#: Ways of copying a file into the results directory, in order of
+#: preference.
+COPY_METHODS = ('hardlink', 'reflink', 'copy_file_range', 'sendfile', 'copy')
+#: Maximum number of bytes to copy in each kernel-side copy call.
+KERNEL_COPY_BYTES = 1024**3
+#: ioctl request number of the Linux FICLONE operation, from <linux/fs.h>.
+FICLONE = 0x40049409
+#: Glob pattern of the names of the files that are deflated into the
+#: results directory by :kbd:`--deflate`.
+DEFLATE_PATTERN = '*.nc'
+#: Name of the journal of an unfinished gather in the results directory.
+GATHER_JOURNAL = '.fvc_gather'
+#: Seconds between checks for finished files and for the end of watching.
+WATCH_WAKE_INTERVAL = 1
+
+# States of the records in the gather journal
+PLANNED = 'planned'
+COPIED = 'copied'
+
+#: errno values that mean that a copy method isn't supported for a file.
+_UNSUPPORTED_ERRNOS = {
+    errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+    errno.EPERM, errno.EMLINK
+}
+#: Copy method, source device, destination device combinations that have
+#: failed as unsupported.
+_unsupported = set()
+
 
 class Gather(cliff.command.Command):
     """Gather results from a FVCOM run.
@@ -46,6 +166,13 @@ class Gather(cliff.command.Command):
             RESULTS_DIR.
 
             If RESULTS_DIR does not exist it will be created.
+
+            With --deflate, the netCDF files are deflated into RESULTS_DIR
+            as they are gathered instead of being deflated in a separate
+            pass afterwards.
+
+            With --watch, the output files that the model has finished
+            writing are gathered in the background while it runs.
         '''
         parser.add_argument(
             'results_dir',
@@ -53,6 +180,117 @@ class Gather(cliff.command.Command):
             metavar='RESULTS_DIR',
             help='directory to store results into'
         )
+        parser.add_argument(
+            '-j',
+            '--jobs',
+            type=int,
+            default=GATHER_THREADS,
+            help=(
+                'Maximum number of files to copy concurrently when '
+                'RESULTS_DIR is on a different file system from the run '
+                'directory. '
+                'Defaults to {}.'.format(GATHER_THREADS)
+            )
+        )
+        parser.add_argument(
+            '--deflate',
+            action='store_true',
+            help=(
+                'Write the {} files into RESULTS_DIR as deflated netCDF-4 '
+                'files while reading them from the run directory, '
+                'in a single pass. '
+                'Files that are already deflated, or that can\'t be '
+                'deflated, are gathered as they are.'.format(DEFLATE_PATTERN)
+            )
+        )
+        parser.add_argument(
+            '--watch',
+            dest='watch_dir',
+            type=Path,
+            default=None,
+            metavar='DIR',
+            help=(
+                'Instead of gathering the whole run directory, watch its '
+                'DIR sub-directory for netCDF files that the model has '
+                'finished writing, and gather each of them into the same '
+                'path in RESULTS_DIR while the model runs. '
+                'A file is finished when it has been closed for the '
+                '--settle time and a later file in its numbered series '
+                'exists. '
+                'Watching ends on SIGTERM or SIGINT, leaving the last file '
+                'of each series for the gather after the run; '
+                'e.g. "fvc gather RESULTS_DIR --watch output & WATCH=$!", '
+                'run the model, then "kill -TERM $WATCH; wait $WATCH; '
+                'fvc gather RESULTS_DIR". '
+                '--pack and --dedup can\'t be used with --watch.'
+            )
+        )
+        parser.add_argument(
+            '--settle',
+            dest='settle_time',
+            type=float,
+            default=filewatch.SETTLE_TIME,
+            metavar='SECONDS',
+            help=(
+                'Time that a file in the --watch directory has to be closed '
+                'and unchanged to be considered finished. '
+                'Defaults to {} seconds.'.format(filewatch.SETTLE_TIME)
+            )
+        )
+        parser.add_argument(
+            '--bwlimit',
+            type=float,
+            default=None,
+            metavar='MB/S',
+            help=(
+                'Limit the rate at which files are copied to RESULTS_DIR '
+                'on a different file system to MB/S megabytes per second, '
+                'in total. '
+                'Renames within a file system are not limited.'
+            )
+        )
+        parser.add_argument(
+            '--pack',
+            dest='pack_threshold',
+            type=int,
+            nargs='?',
+            const=pack_plugin.PACK_THRESHOLD,
+            default=None,
+            metavar='BYTES',
+            help=(
+                'Pack the files that are smaller than BYTES into a single '
+                'indexed zip archive, {}, in RESULTS_DIR instead of moving '
+                'them one by one. '
+                'BYTES defaults to {}.'.format(
+                    pack_plugin.PACK_ARCHIVE, pack_plugin.PACK_THRESHOLD
+                )
+            )
+        )
+        parser.add_argument(
+            '--dedup',
+            action='store_true',
+            help=(
+                'Hard-link the gathered files to the objects with the same '
+                'contents in the content-addressed store in the {} '
+                'directory of the parent directory of RESULTS_DIR, adding '
+                'objects for new contents. '
+                'Deduplicated files are made read-only. '
+                'Use fvc dedup to report the space saved and to delete '
+                'unreferenced objects.'.format(dedup_plugin.STORE_DIR)
+            )
+        )
+        parser.add_argument(
+            '--manifest',
+            action='store_true',
+            help=(
+                'Write a manifest of the size, modification time, and '
+                'checksum of each file in RESULTS_DIR to {} for fvc verify. '
+                'Checksums are computed as files are copied.'.format(
+                    verify_plugin.MANIFEST
+                )
+            )
+        )
+        add_arguments(parser)
         return parser
 
     def take_action(self, parsed_args):
@@ -65,10 +303,382 @@ class Gather(cliff.command.Command):
         and other files that define the run are also gathered into the
         directory given by `parsed_args.results_dir`.
         """
-        gather(parsed_args.results_dir)
+        process_priority = ProcessPriority.from_parsed_args(parsed_args)
+        bandwidth = (
+            None if parsed_args.bwlimit is None else parsed_args.bwlimit * 1e6
+        )
+        if parsed_args.watch_dir is not None:
+            if parsed_args.pack_threshold is not None or parsed_args.dedup:
+                logger.error(
+                    '--pack and --dedup apply to the whole results directory, '
+                    'so they can only be used in the gather after the run, '
+                    'not with --watch'
+                )
+                raise SystemExit(2)
+            try:
+                watch(
+                    parsed_args.results_dir,
+                    parsed_args.watch_dir,
+                    settle_time=parsed_args.settle_time,
+                    process_priority=process_priority,
+                    max_threads=parsed_args.jobs,
+                    bandwidth=bandwidth,
+                    deflate=parsed_args.deflate,
+                    manifest=parsed_args.manifest
+                )
+            except ValueError as exc:
+                logger.error(exc)
+                raise SystemExit(2)
+            return
+        gather(
+            parsed_args.results_dir,
+            process_priority=process_priority,
+            max_threads=parsed_args.jobs,
+            deflate=parsed_args.deflate,
+            manifest=parsed_args.manifest,
+            bandwidth=bandwidth,
+            pack_threshold=parsed_args.pack_threshold,
+            dedup=parsed_args.dedup
+        )
+
+
+@attr.s
+class MoveStats(object):
+    """Measurements of the move of a run directory entry into the results
+    directory.
+    """
+    #: Path/name of the entry relative to the run directory.
+    path = attr.ib()
+    #: Size in bytes of the file; 0 for directories.
+    nbytes = attr.ib()
+    #: How the entry was moved: :kbd:`rename`,
+    #: or one of :py:data:`COPY_METHODS`.
+    method = attr.ib()
+    #: Wall time in seconds that the move took.
+    wall_time = attr.ib()
+    #: Checksum of the file computed while it was copied;
+    #: :py:obj:`None` if it wasn't.
+    checksum = attr.ib(default=None)
+
+    @property
+    def throughput(self):
+        """Bytes moved per second.
+        """
+        return self.nbytes / self.wall_time if self.wall_time else 0
+
+
+@attr.s
+class GatherReport(object):
+    """Throughput statistics of a gather.
+
+    Returned by :func:`gather`.
+    """
+    #: :py:class:`MoveStats` of the entries that were renamed,
+    #: and of the files that were copied.
+    moves = attr.ib(default=attr.Factory(list))
+    #: Wall time in seconds of the whole gather.
+    wall_time = attr.ib(default=0)
+    #: Statistics of the files that were deflated into the results
+    #: directory;
+    #: :py:obj:`None` if the gather didn't deflate.
+    deflate_report = attr.ib(default=None)
+    #: Statistics of the files that were packed into the results directory
+    #: archive;
+    #: :py:obj:`None` if the gather didn't pack.
+    pack_report = attr.ib(default=None)
+    #: Statistics of the deduplication of the results directory;
+    #: :py:obj:`None` if the gather didn't deduplicate.
+    dedup_report = attr.ib(default=None)
+
+    @property
+    def renamed(self):
+        """:py:class:`MoveStats` of the entries that were renamed.
+        """
+        return [move for move in self.moves if move.method == 'rename']
 
+    @property
+    def copied(self):
+        """:py:class:`MoveStats` of the files that were copied.
+        """
+        return [move for move in self.moves if move.method != 'rename']
+
+    @property
+    def copied_bytes(self):
+        """Total size in bytes of the files that were copied.
+        """
+        return sum(move.nbytes for move in self.copied)
+
+    @property
+    def throughput(self):
+        """Bytes copied per second of gather wall time.
+        """
+        return self.copied_bytes / self.wall_time if self.wall_time else 0
+
+    def summary(self):
+        """Return a 1 line summary of the gather statistics.
 
-def gather(results_dir):
+        :rtype: str
+        """
+        summary = (
+            'Gathered {n_renamed} entries by renaming and {n_copied} files '
+            'by copying {mb:.1f} MB in {wall:.1f} s = {rate:.1f} MB/s'.format(
+                n_renamed=len(self.renamed),
+                n_copied=len(self.copied),
+                mb=self.copied_bytes / 1e6,
+                wall=self.wall_time,
+                rate=self.throughput / 1e6
+            )
+        )
+        methods = [move.method for move in self.copied]
+        if methods:
+            summary += '; ' + ', '.join(
+                '{} by {}'.format(methods.count(method), method)
+                for method in COPY_METHODS if method in methods
+            )
+        return summary
+
+
+@attr.s
+class Throttle(object):
+    """Limiter of the rate at which bytes are copied,
+    shared by the threads that copy files.
+
+    Each buffer is released no earlier than the time at which all of the
+    bytes released before it would have been copied at :py:attr:`rate`.
+    """
+    #: Maximum rate in bytes per second.
+    rate = attr.ib()
+    #: Time at which the next buffer may be released.
+    next_time = attr.ib(default=0)
+    #: Lock that serializes updates of :py:attr:`next_time`.
+    lock = attr.ib(default=attr.Factory(threading.Lock))
+
+    def consume(self, nbytes):
+        """Wait until nbytes may be copied.
+
+        :param int nbytes: Number of bytes about to be copied.
+        """
+        with self.lock:
+            now = time.time()
+            release = max(self.next_time, now)
+            self.next_time = release + nbytes / self.rate
+        if release > now:
+            time.sleep(release - now)
+
+
+@attr.s
+class GatherJournal(object):
+    """Journal of the file copies of a gather,
+    from which an interrupted gather is resumed.
+
+    A line of JSON is appended to the :py:data:`GATHER_JOURNAL` file in the
+    results directory,
+    and flushed to disk,
+    with the paths of the files to be copied,
+    and the sizes and modification times of any files already at their
+    destinations,
+    before any copying starts
+    (:py:data:`PLANNED`),
+    and with the size, modification time, and checksum of each copy after
+    it has been flushed to disk and before the original file is deleted
+    (:py:data:`COPIED`).
+    Paths are relative to the run directory,
+    and so to the results directory.
+    The journal is deleted when the gather finishes.
+    """
+    #: Path of the journal file.
+    path = attr.ib()
+    #: Lock that serializes appends to the journal file.
+    lock = attr.ib(default=attr.Factory(threading.Lock))
+
+    def plan(self, run_dir, paths):
+        """Record the paths of the files in run_dir that are to be copied
+        into the results directory that contains the journal file,
+        and the state of the files that already exist at their
+        destinations.
+
+        :param run_dir: Run directory.
+        :type run_dir: :py:class:`pathlib.Path`
+
+        :param list paths: Paths of the files relative to run_dir.
+        """
+        existing = {}
+        for path in paths:
+            try:
+                stat = os.lstat(fspath(self.path.parent / path))
+            except OSError:
+                continue
+            existing[fspath(path)] = [
+                stat.st_size, verify_plugin.mtime_ns(stat)
+            ]
+        self._append({
+            'state': PLANNED,
+            'run_dir': fspath(run_dir),
+            'paths': [fspath(path) for path in paths],
+            'existing': existing,
+        })
+
+    def copied(self, run_dir, path, dst, checksum=None, algorithm=None):
+        """Record that the file at path in run_dir has been copied to dst.
+
+        :param run_dir: Run directory.
+        :type run_dir: :py:class:`pathlib.Path`
+
+        :param path: Path of the file relative to run_dir.
+        :type path: :py:class:`pathlib.Path`
+
+        :param dst: Path of the copy.
+        :type dst: :py:class:`pathlib.Path`
+
+        :param str checksum: Checksum of the file computed while it was
+                             copied.
+
+        :param str algorithm: Hash algorithm of checksum.
+        """
+        stat = dst.stat()
+        self._append({
+            'state': COPIED,
+            'run_dir': fspath(run_dir),
+            'path': fspath(path),
+            'size': stat.st_size,
+            'mtime_ns': verify_plugin.mtime_ns(stat),
+            'checksum': checksum,
+            'algorithm': algorithm,
+        })
+
+    def recover(self, results_dir, algorithm=None):
+        """Complete or roll back the copies of an interrupted gather into
+        results_dir.
+
+        Planned copies that were journaled as copied,
+        and whose copies still match the journal,
+        are completed by deleting their original files if they still
+        exist;
+        they are not copied again.
+        The partial copies of the other planned files whose original files
+        still exist are deleted so that the files are copied afresh;
+        files at their destinations that are unchanged since the copies
+        were planned weren't written by the gather,
+        so they are left alone.
+
+        :param results_dir: Results directory.
+        :type results_dir: :py:class:`pathlib.Path`
+
+        :param str algorithm: Hash algorithm of the checksums to return.
+
+        :returns: Journaled checksums of the completed copies by path
+                  relative to results_dir.
+        :rtype: dict
+        """
+        planned, copied, existing = set(), {}, {}
+        for record in self._read():
+            if record['state'] == PLANNED:
+                planned.update(
+                    (record['run_dir'], path) for path in record['paths']
+                )
+                existing.update(
+                    ((record['run_dir'], path), state)
+                    for path, state in record.get('existing', {}).items()
+                )
+            elif record['state'] == COPIED:
+                copied[record['run_dir'], record['path']] = record
+        if planned:
+            logger.info(
+                'Resuming interrupted gather into {}'.format(results_dir)
+            )
+        checksums = {}
+        for run_dir, path in sorted(planned):
+            src, dst = Path(run_dir) / path, results_dir / path
+            record = copied.get((run_dir, path))
+            if record is not None and _copy_matches(dst, record):
+                if src.exists():
+                    src.unlink()
+                    logger.info(
+                        'completed interrupted copy of {} to {}'.format(
+                            src, dst
+                        )
+                    )
+                if record['checksum'] and record['algorithm'] == algorithm:
+                    checksums[Path(path)] = record['checksum']
+            elif src.exists() and _partial_copy(
+                dst, existing.get((run_dir, path))
+            ):
+                dst.unlink()
+                logger.info(
+                    'removed partial copy {} left by interrupted gather'.
+                    format(dst)
+                )
+        return checksums
+
+    def close(self):
+        """Delete the journal file because the gather has finished.
+        """
+        if self.path.exists():
+            self.path.unlink()
+
+    def _append(self, record):
+        with self.lock:
+            with self.path.open('ab') as f:
+                f.write(
+                    u'{}\n'.format(json.dumps(record, sort_keys=True)).
+                    encode('utf-8')
+                )
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _read(self):
+        records = []
+        try:
+            with self.path.open('rt') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # Partially written line
+                        continue
+        except (IOError, OSError):
+            pass
+        return records
+
+
+def _copy_matches(dst, record):
+    """Return a boolean indicating whether or not dst is the copy that was
+    journaled in record.
+    """
+    try:
+        stat = dst.stat()
+    except OSError:
+        return False
+    return (stat.st_size, verify_plugin.mtime_ns(stat)) == (
+        record['size'], record['mtime_ns']
+    )
+
+
+def _partial_copy(dst, planned_state):
+    """Return a boolean indicating whether or not dst exists,
+    and was written after its copy was planned,
+    when it was either absent,
+    or had the size and modification time in planned_state.
+    """
+    try:
+        stat = os.lstat(fspath(dst))
+    except OSError:
+        return False
+    return planned_state is None or (
+        [stat.st_size, verify_plugin.mtime_ns(stat)] != planned_state
+    )
+
+
+def gather(
+    results_dir,
+    process_priority=None,
+    max_threads=GATHER_THREADS,
+    deflate=False,
+    manifest=False,
+    bandwidth=None,
+    pack_threshold=None,
+    dedup=False
+):
     """Move all of the files and directories from the present working directory
     into results_dir.
 
@@ -76,36 +686,796 @@ def gather(results_dir):
 
     Delete any symbolic links so that the present working directory is empty.
 
+    Entries on the same file system as results_dir are renamed into it.
+    The files of the others are copied on up to max_threads threads by the
+    first of :py:data:`COPY_METHODS` that works for each,
+    and flushed to disk before the originals are deleted.
+
+    If pack_threshold is given,
+    the files that are smaller than it are first packed into the
+    :py:data:`fvcom_cmd.pack.PACK_ARCHIVE` in results_dir by
+    :func:`fvcom_cmd.pack.pack`.
+
+    If deflate is :py:obj:`True`, the :py:data:`DEFLATE_PATTERN` files are
+    then deflated into results_dir by :func:`_deflate_results`.
+
+    If dedup is :py:obj:`True`, the files in results_dir are then
+    hard-linked to the objects with the same contents in the store in its
+    parent directory by :func:`fvcom_cmd.dedup.dedup`.
+
+    If manifest is :py:obj:`True`, a checksum manifest of results_dir is
+    written by :func:`fvcom_cmd.verify.write_manifest`,
+    using the checksums of the files that were computed as they were
+    copied.
+
+    Copies are journaled in a :py:class:`GatherJournal` so that calling
+    this function again after it was interrupted completes or rolls back
+    the copies that were in progress,
+    and moves only the remaining entries.
+
     :param results_dir: Path of the directory into which to store the run
                         results.
     :type results_dir: :py:class:`pathlib.Path`
+
+    :param process_priority: CPU and I/O scheduling priority settings to
+                             apply to the process before the files are
+                             moved.
+    :type process_priority: :py:class:`ProcessPriority`
+
+    :param int max_threads: Maximum number of files to copy concurrently.
+
+    :param boolean deflate: Deflate the netCDF files into results_dir
+                            instead of moving them.
+
+    :param boolean manifest: Write a checksum manifest of results_dir.
+
+    :param float bandwidth: Maximum total rate in bytes per second at which
+                            to copy files;
+                            :py:obj:`None` means unlimited.
+
+    :param int pack_threshold: Size in bytes below which files are packed
+                               into an archive;
+                               :py:obj:`None` means don't pack.
+
+    :param boolean dedup: Deduplicate the files in results_dir against the
+                          content-addressed store in its parent directory.
+
+    :returns: Throughput statistics of the gather and of each move.
+    :rtype: :py:class:`GatherReport`
     """
+    if process_priority is not None:
+        process_priority.apply()
+    t_start = time.time()
     results_dir.mkdir(parents=True, exist_ok=True)
-    symlinks = {p for p in Path.cwd().glob('*') if p.is_symlink()}
-    try:
-        _move_results(results_dir, symlinks)
-    except Exception:
-        raise
+    algorithm = verify_plugin.checksum_algorithm() if manifest else None
+    journal = GatherJournal(results_dir.resolve() / GATHER_JOURNAL)
+    checksums = journal.recover(results_dir.resolve(), algorithm)
+    pack_report = None
+    if pack_threshold is not None:
+        pack_report = _pack_results(results_dir, pack_threshold)
+    deflate_report = _deflate_results(results_dir) if deflate else None
+    entries = list(scandir(fspath(Path.cwd())))
+    symlinks = {Path(entry.name) for entry in entries if entry.is_symlink()}
+    targets = [entry for entry in entries if not entry.is_symlink()]
+    moves = _move_results(
+        results_dir, targets, max_threads, algorithm, journal,
+        None if bandwidth is None else Throttle(bandwidth)
+    )
     _delete_symlinks(symlinks)
+    checksums.update(
+        (move.path, move.checksum)
+        for move in moves if move.checksum is not None
+    )
+    dedup_report = None
+    if dedup:
+        dedup_report = _dedup_results(
+            results_dir, algorithm, checksums, max_threads
+        )
+    if manifest:
+        verify_plugin.write_manifest(
+            results_dir,
+            algorithm,
+            checksums,
+            max_threads,
+            exclude={GATHER_JOURNAL}
+        )
+    journal.close()
+    report = GatherReport(
+        moves, time.time() - t_start, deflate_report, pack_report,
+        dedup_report
+    )
+    if moves:
+        logger.info(report.summary())
+    return report
+
 
+def watch(
+    results_dir,
+    dir_path,
+    settle_time=filewatch.SETTLE_TIME,
+    pattern='*.nc',
+    stop=None,
+    process_priority=None,
+    max_threads=GATHER_THREADS,
+    bandwidth=None,
+    deflate=False,
+    manifest=False
+):
+    """Gather the files in dir_path as a running model finishes writing
+    them,
+    until watching ends.
 
-def _move_results(results_dir, symlinks):
+    dir_path is a sub-directory of the run directory,
+    which is the present working directory,
+    and each file is gathered into the same path in results_dir,
+    so that the gather after the run only has to move the last file of
+    each series,
+    the logs,
+    and the files that define the run.
+    See :py:mod:`fvcom_cmd.filewatch` for how finished files are detected.
+
+    Watching ends when the stop event is set,
+    or, when called in the main thread without a stop event,
+    on SIGTERM or SIGINT.
+    The file that is being gathered at the time is finished first.
+
+    :param results_dir: Path of the directory into which to store the run
+                        results.
+    :type results_dir: :py:class:`pathlib.Path`
+
+    :param dir_path: Directory to watch.
+    :type dir_path: :py:class:`pathlib.Path`
+
+    :param float settle_time: Seconds that a file has to be closed and
+                              unchanged to be considered finished.
+
+    :param str pattern: Glob pattern of the names of the files to gather.
+
+    :param stop: Event to set to end watching.
+    :type stop: :py:class:`threading.Event`
+
+    :param process_priority: CPU and I/O scheduling priority settings to
+                             apply to the process before watching starts.
+    :type process_priority: :py:class:`ProcessPriority`
+
+    :param int max_threads: Maximum number of files to copy concurrently
+                            when results_dir is on a different file system
+                            from the run directory.
+
+    :param float bandwidth: Maximum rate in bytes per second at which to
+                            copy files;
+                            :py:obj:`None` means unlimited.
+
+    :param boolean deflate: Deflate the files into results_dir instead of
+                            moving them.
+
+    :param boolean manifest: Update the checksum manifest of results_dir
+                             after each batch of files.
+
+    :returns: Throughput statistics of the files that were gathered.
+    :rtype: :py:class:`GatherReport`
+
+    :raises: :py:exc:`ValueError` if dir_path is not an existing directory
+             in the run directory.
+    """
+    t_start = time.time()
+    dir_path = _run_dir_path(dir_path)
+    if stop is None:
+        stop = threading.Event()
+        try:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, lambda signum, frame: stop.set())
+        except ValueError:
+            # Signal handlers can only be installed in the main thread
+            pass
+    if process_priority is not None:
+        process_priority.apply()
+    results_dir.mkdir(parents=True, exist_ok=True)
+    algorithm = verify_plugin.checksum_algorithm() if manifest else None
+    journal = GatherJournal(results_dir.resolve() / GATHER_JOURNAL)
+    checksums = journal.recover(results_dir.resolve(), algorithm)
+    throttle = None if bandwidth is None else Throttle(bandwidth)
+    cwd = Path.cwd()
+    abs_results_dir = results_dir.resolve()
+    watcher = filewatch.FileWatcher(dir_path, pattern, settle_time)
+    watcher.start()
+    logger.info(
+        'Watching {} for finished {} files to gather into {}'.format(
+            dir_path, pattern, results_dir
+        )
+    )
+    moves, deflate_reports = [], []
+    try:
+        while not stop.is_set():
+            watcher.wait(WATCH_WAKE_INTERVAL)
+            finished = watcher.finished()
+            if not finished:
+                continue
+            if deflate:
+                destinations = {}
+                for filepath in finished:
+                    src = cwd / filepath
+                    destinations[src] = abs_results_dir / src.relative_to(cwd)
+                deflate_reports.append(
+                    _deflate_files(
+                        results_dir, destinations, max_concurrent_jobs=1
+                    )
+                )
+            # Files that were deflated are already in results_dir
+            batch = _gather_files(
+                results_dir, [fp for fp in finished if fp.exists()],
+                algorithm, journal, throttle, max_threads
+            )
+            moves.extend(batch)
+            if manifest:
+                checksums.update(
+                    (move.path, move.checksum)
+                    for move in batch if move.checksum is not None
+                )
+                verify_plugin.write_manifest(
+                    results_dir,
+                    algorithm,
+                    checksums,
+                    exclude={GATHER_JOURNAL}
+                )
+    finally:
+        watcher.close()
+    journal.close()
+    report = GatherReport(moves, time.time() - t_start)
+    if deflate_reports:
+        report.deflate_report = deflate_plugin.DeflateReport(
+            deflate_reports[-1].backend,
+            deflate_reports[-1].codec,
+            deflate_reports[-1].dfl_lvl,
+            jobs=[job for batch in deflate_reports for job in batch.jobs],
+            n_skipped=sum(batch.n_skipped for batch in deflate_reports),
+            wall_time=sum(batch.wall_time for batch in deflate_reports)
+        )
+    if moves:
+        logger.info(report.summary())
+    return report
+
+
+def _run_dir_path(dir_path):
+    """Return the path of dir_path relative to the run directory,
+    which is the present working directory.
+
+    :raises: :py:exc:`ValueError` if dir_path is not an existing directory
+             in the run directory.
+    """
+    dir_path = Path(dir_path)
+    if not dir_path.is_dir():
+        raise ValueError('{} is not a directory'.format(dir_path))
+    rel_path = os.path.relpath(
+        fspath(dir_path.resolve()), fspath(Path.cwd().resolve())
+    )
+    if rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep):
+        raise ValueError(
+            '{} is not in the run directory {}'.format(dir_path, Path.cwd())
+        )
+    return Path(rel_path)
+
+
+def _gather_files(
+    results_dir,
+    filepaths,
+    algorithm=None,
+    journal=None,
+    throttle=None,
+    max_threads=GATHER_THREADS
+):
+    """Move files in the run directory tree into the same paths in
+    results_dir.
+
+    Files on the same file system as results_dir are renamed,
+    and the others are copied by :func:`_copy_file` on up to max_threads
+    threads.
+
+    :returns: :py:class:`MoveStats` of the moves.
+    :rtype: list
+    """
+    cwd = Path.cwd()
+    abs_results_dir = results_dir.resolve()
+    moves, copies = [], []
+    for filepath in filepaths:
+        src = cwd / filepath
+        path = src.relative_to(cwd)
+        dst = abs_results_dir / path
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        stat = src.stat()
+        if stat.st_dev == os.stat(fspath(dst.parent)).st_dev:
+            t_start = time.time()
+            try:
+                os.rename(fspath(src), fspath(dst))
+            except OSError as exc:
+                if exc.errno != errno.EXDEV:
+                    raise
+            else:
+                logger.info('Moved {} to {}/'.format(path, dst.parent))
+                move = MoveStats(
+                    path, stat.st_size, 'rename', time.time() - t_start
+                )
+                if algorithm is not None:
+                    move.checksum = verify_plugin.file_checksum(
+                        dst, algorithm
+                    )
+                moves.append(move)
+                continue
+        copies.append((src, dst))
+    if copies:
+        if journal is not None:
+            journal.plan(cwd, [src.relative_to(cwd) for src, dst in copies])
+        with ThreadPoolExecutor(max_threads) as executor:
+            moves.extend(
+                executor.map(
+                    lambda copy: _copy_file(
+                        *copy,
+                        algorithm=algorithm,
+                        journal=journal,
+                        throttle=throttle
+                    ), copies
+                )
+            )
+    return moves
+
+
+def _dedup_results(results_dir, algorithm, checksums, max_threads):
+    """Deduplicate the files in results_dir against the store in its
+    parent directory.
+
+    The checksums of the files that weren't hashed as they were copied are
+    added to checksums if algorithm is given,
+    so that they aren't computed again for the manifest.
+
+    :returns: Deduplication statistics;
+              :py:obj:`None` if the store would be in the run directory.
+    :rtype: :py:class:`fvcom_cmd.dedup.DedupReport`
+    """
+    abs_results_dir = results_dir.resolve()
+    results_root = abs_results_dir.parent
+    if Path.cwd().samefile(results_root):
+        logger.warning(
+            'not deduplicating because the store would be in the run '
+            'directory'
+        )
+        return None
+    if algorithm is None:
+        algorithm, checksums = verify_plugin.checksum_algorithm(), {}
+    return dedup_plugin.dedup(
+        abs_results_dir,
+        dedup_plugin.store_dir(results_root),
+        algorithm,
+        checksums,
+        max_threads,
+        exclude={GATHER_JOURNAL}
+    )
+
+
+def _pack_results(results_dir, threshold):
+    """Pack the files in the run directory tree that are smaller than
+    threshold into the archive in results_dir.
+
+    :returns: Packing statistics;
+              :py:obj:`None` if results_dir is the present working
+              directory.
+    :rtype: :py:class:`fvcom_cmd.pack.PackReport`
+    """
+    cwd = Path.cwd()
+    abs_results_dir = results_dir.resolve()
+    if cwd.samefile(abs_results_dir):
+        return None
+    paths = pack_plugin.small_files(cwd, threshold, exclude={abs_results_dir})
+    return pack_plugin.pack(cwd, paths, abs_results_dir)
+
+
+def _deflate_results(results_dir, pattern=DEFLATE_PATTERN):
+    """Deflate the files in the run directory tree whose names match
+    pattern into the same relative paths in results_dir,
+    deleting each original file once its deflated file is stored.
+
+    Files that are already deflated,
+    or that fail to deflate,
+    are left in the run directory to be moved as they are.
+    The deflated file records of the run directory are merged into those of
+    results_dir so that they aren't overwritten when they are moved.
+
+    :returns: Deflation statistics;
+              :py:obj:`None` if results_dir is the present working
+              directory.
+    :rtype: :py:class:`fvcom_cmd.deflate.DeflateReport`
+    """
     cwd = Path.cwd()
     abs_results_dir = results_dir.resolve()
     if cwd.samefile(abs_results_dir):
+        return None
+    destinations = {}
+    for dirpath, dirnames, filenames in os.walk(fspath(cwd)):
+        dirnames[:] = [
+            name for name in dirnames
+            if (Path(dirpath) / name).resolve() != abs_results_dir
+        ]
+        for name in fnmatch.filter(filenames, pattern):
+            src = Path(dirpath) / name
+            if src.is_symlink():
+                continue
+            destinations[src] = abs_results_dir / src.relative_to(cwd)
+    if not destinations:
+        return None
+    logger.info(
+        'Deflating {} files into {}/...'.format(
+            len(destinations), abs_results_dir
+        )
+    )
+    return _deflate_files(abs_results_dir, destinations)
+
+
+def _deflate_files(results_dir, destinations, max_concurrent_jobs=None):
+    """Deflate files in the run directory tree into results_dir,
+    deleting each original file once its deflated file is stored,
+    and merge the deflated file records of their directories into those
+    of results_dir.
+
+    :param dict destinations: Absolute paths of the deflated files in
+                              results_dir keyed by the absolute paths of
+                              the files to deflate.
+
+    :param int max_concurrent_jobs: Maximum number of files to deflate at
+                                    once.
+
+    :returns: Deflation statistics.
+    :rtype: :py:class:`fvcom_cmd.deflate.DeflateReport`
+    """
+    cwd = Path.cwd()
+    abs_results_dir = results_dir.resolve()
+    for dst in destinations.values():
+        dst.parent.mkdir(parents=True, exist_ok=True)
+    report = deflate_plugin.deflate(
+        sorted(destinations),
+        max_concurrent_jobs,
+        destinations=destinations
+    )
+    if report.failed:
+        logger.warning(
+            '{} files could not be deflated and will be gathered as they '
+            'are: {}'.format(
+                len(report.failed),
+                ', '.join(fspath(job.filepath) for job in report.failed)
+            )
+        )
+    for src_dir in {src.parent for src in destinations}:
+        _merge_deflated_records(
+            src_dir, abs_results_dir / src_dir.relative_to(cwd)
+        )
+    return report
+
+
+def _merge_deflated_records(src_dir, dst_dir):
+    """Prepend the deflated file records in src_dir to those in dst_dir,
+    so that the later records of dst_dir take precedence,
+    and delete the src_dir records.
+    """
+    src_record = src_dir / deflate_plugin.DEFLATED_RECORD
+    dst_record = dst_dir / deflate_plugin.DEFLATED_RECORD
+    if not (src_record.exists() and dst_record.exists()):
         return
+    tmp_record = dst_dir / '{}.tmp'.format(deflate_plugin.DEFLATED_RECORD)
+    with tmp_record.open('wb') as f:
+        for record in (src_record, dst_record):
+            lines = record.read_bytes()
+            if lines and not lines.endswith(b'\n'):
+                lines += b'\n'
+            f.write(lines)
+    tmp_record.rename(dst_record)
+    src_record.unlink()
+
+
+def _move_results(
+    results_dir,
+    entries,
+    max_threads=GATHER_THREADS,
+    algorithm=None,
+    journal=None,
+    throttle=None
+):
+    """Move the run directory entries into results_dir.
+
+    The files that are copied are hashed with algorithm if it is given.
+    The copies are planned,
+    and each is recorded when it is done,
+    in journal if it is given.
+    The rate of the copies is limited by throttle if it is given.
+
+    :returns: :py:class:`MoveStats` of the moves.
+    :rtype: list
+    """
+    cwd = Path.cwd()
+    abs_results_dir = results_dir.resolve()
+    if cwd.samefile(abs_results_dir):
+        return []
     logger.info('Moving run definition and results files...')
-    for p in cwd.glob('*'):
-        if p not in symlinks:
-            src = p.relative_to(cwd)
-            suffix = '/' if src.is_dir() else ''
+    results_stat = os.stat(fspath(abs_results_dir))
+    moves, copies, copied_dirs = [], [], []
+    for entry in entries:
+        stat = entry.stat(follow_symlinks=False)
+        if os.path.samestat(stat, results_stat):
+            # results_dir is in the run directory
+            continue
+        src = Path(entry.name)
+        suffix = '/' if entry.is_dir(follow_symlinks=False) else ''
+        if stat.st_dev == results_stat.st_dev:
+            move = _rename(entry, abs_results_dir, stat)
+            if move is not None:
+                moves.append(move)
+                continue
+        if suffix:
             logger.info(
-                'Moving {}{} to {}/'.format(src, suffix, abs_results_dir)
+                'Copying {}{} to {}/'.format(src, suffix, abs_results_dir)
+            )
+            copies.extend(_tree_copies(cwd / src, abs_results_dir / src))
+            copied_dirs.append(src)
+        else:
+            copies.append((cwd / src, abs_results_dir / src))
+    if copies:
+        if journal is not None:
+            journal.plan(cwd, [src.relative_to(cwd) for src, dst in copies])
+        with ThreadPoolExecutor(max_threads) as executor:
+            moves.extend(
+                executor.map(
+                    lambda copy: _copy_file(
+                        *copy,
+                        algorithm=algorithm,
+                        journal=journal,
+                        throttle=throttle
+                    ), copies
+                )
+            )
+    for src in copied_dirs:
+        shutil.rmtree(fspath(src))
+    return moves
+
+
+def _rename(entry, abs_results_dir, stat):
+    """Rename a run directory entry into abs_results_dir.
+
+    :returns: Measurements of the move,
+              or :py:obj:`None` if the entry can't be renamed,
+              e.g. because it is a directory that already exists in
+              abs_results_dir,
+              or because the run directory is on a bind mount of the file
+              system.
+    :rtype: :py:class:`MoveStats`
+    """
+    src = Path(entry.name)
+    is_dir = entry.is_dir(follow_symlinks=False)
+    t_start = time.time()
+    try:
+        os.rename(entry.path, fspath(abs_results_dir / src))
+    except OSError as exc:
+        if exc.errno not in {errno.EXDEV, errno.ENOTEMPTY, errno.EEXIST}:
+            raise
+        logger.debug('unable to rename {}: {}'.format(src, exc))
+        return None
+    logger.info(
+        'Moving {}{} to {}/'.format(
+            src, '/' if is_dir else '', abs_results_dir
+        )
+    )
+    return MoveStats(
+        src, 0 if is_dir else stat.st_size, 'rename', time.time() - t_start
+    )
+
+
+def _tree_copies(src_dir, dst_dir):
+    """Create the directory tree of src_dir under dst_dir,
+    along with any symbolic links in it.
+
+    :returns: Source and destination paths of the files in the tree to be
+              copied.
+    :rtype: list
+    """
+    copies = []
+    for dirpath, dirnames, filenames in os.walk(fspath(src_dir)):
+        rel_dir = Path(dirpath).relative_to(src_dir)
+        (dst_dir / rel_dir).mkdir(parents=True, exist_ok=True)
+        for name in dirnames + filenames:
+            src = Path(dirpath) / name
+            dst = dst_dir / rel_dir / name
+            if src.is_symlink():
+                if dst.is_symlink():
+                    dst.unlink()
+                os.symlink(os.readlink(fspath(src)), fspath(dst))
+            elif name in filenames:
+                copies.append((src, dst))
+    return copies
+
+
+def _copy_file(
+    src,
+    dst,
+    methods=COPY_METHODS,
+    algorithm=None,
+    journal=None,
+    throttle=None
+):
+    """Copy src to dst by the first of methods that works for it,
+    flush dst to disk,
+    record the copy in journal if it is given,
+    then delete src.
+
+    If algorithm or throttle is given,
+    the methods are limited to hard-linking and the buffered copy,
+    because the data of the other methods doesn't pass through the
+    process.
+    The checksum of the file is then computed as it is copied,
+    or by reading it if it is hard-linked.
+
+    :param src: Path of the file to copy.
+    :type src: :py:class:`pathlib.Path`
+
+    :param dst: Path to copy the file to.
+    :type dst: :py:class:`pathlib.Path`
+
+    :param tuple methods: Copy methods to try, in order;
+                          a sub-sequence of :py:data:`COPY_METHODS`.
+
+    :param str algorithm: Name of the hash algorithm to compute the
+                          checksum of the file with;
+                          see :func:`fvcom_cmd.verify.checksum_algorithm`.
+
+    :param journal: Journal of the gather.
+    :type journal: :py:class:`GatherJournal`
+
+    :param throttle: Limiter of the rate of the buffered copy.
+    :type throttle: :py:class:`Throttle`
+
+    :returns: Measurements of the copy.
+    :rtype: :py:class:`MoveStats`
+
+    :raises: :py:exc:`OSError` if the last of methods to be tried fails,
+             or if a method fails for a reason other than not being
+             supported.
+    """
+    t_start = time.time()
+    hasher = None
+    if algorithm is not None:
+        hasher = verify_plugin.new_hash(algorithm)
+    if algorithm is not None or throttle is not None:
+        methods = tuple(
+            method for method in methods if method in ('hardlink', 'copy')
+        ) or ('copy', )
+    src_stat = src.stat()
+    devices = (src_stat.st_dev, os.stat(fspath(dst.parent)).st_dev)
+    candidates = [
+        method for method in methods
+        if (method, devices) not in _unsupported
+        and (method != 'hardlink' or devices[0] == devices[1])
+    ]
+    if not candidates:
+        raise OSError(
+            errno.ENOSYS,
+            'none of the copy methods {} are supported for {}'.format(
+                ', '.join(methods), src
             )
-            if src.is_dir():
-                shutil.move(fspath(src), fspath(abs_results_dir))
+        )
+    for method in candidates:
+        try:
+            if method == 'copy':
+                _buffered_copy(
+                    src, dst, src_stat.st_size, hasher, throttle
+                )
             else:
-                shutil.move(fspath(src), fspath(abs_results_dir / src))
+                _COPIERS[method](src, dst, src_stat.st_size)
+            break
+        except OSError as exc:
+            unsupported = exc.errno in _UNSUPPORTED_ERRNOS
+            if not unsupported or method == candidates[-1]:
+                raise
+            logger.debug(
+                'unable to copy {} by {}: {}'.format(src, method, exc)
+            )
+            _unsupported.add((method, devices))
+    if method != 'hardlink':
+        shutil.copystat(fspath(src), fspath(dst))
+    checksum = None
+    if hasher is not None:
+        checksum = (
+            hasher.hexdigest() if method == 'copy' else
+            verify_plugin.file_checksum(dst, algorithm)
+        )
+    cwd = Path.cwd()
+    if journal is not None:
+        journal.copied(cwd, src.relative_to(cwd), dst, checksum, algorithm)
+    src.unlink()
+    move = MoveStats(
+        src.relative_to(cwd), src_stat.st_size, method,
+        time.time() - t_start, checksum
+    )
+    logger.info(
+        'Copied {0.path} to {1} by {0.method}: {mb:.1f} MB in '
+        '{0.wall_time:.1f} s = {rate:.1f} MB/s'.format(
+            move, dst.parent, mb=move.nbytes / 1e6,
+            rate=move.throughput / 1e6
+        )
+    )
+    return move
+
+
+def _hardlink(src, dst, nbytes):
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+    os.link(fspath(src), fspath(dst))
+
+
+def _reflink(src, dst, nbytes):
+    with src.open('rb') as f_src, dst.open('wb') as f_dst:
+        fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+        os.fsync(f_dst.fileno())
+
+
+def _copy_file_range(src, dst, nbytes):
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range is None:
+        # Python < 3.8
+        raise OSError(errno.ENOSYS, 'os.copy_file_range is not available')
+    with src.open('rb') as f_src, dst.open('wb') as f_dst:
+        _kernel_copy(
+            lambda offset, count: copy_file_range(
+                f_src.fileno(), f_dst.fileno(), count, offset, offset
+            ), nbytes
+        )
+        os.fsync(f_dst.fileno())
+
+
+def _sendfile(src, dst, nbytes):
+    sendfile = getattr(os, 'sendfile', None)
+    if sendfile is None:
+        # Python 2.7
+        raise OSError(errno.ENOSYS, 'os.sendfile is not available')
+    with src.open('rb') as f_src, dst.open('wb') as f_dst:
+        _kernel_copy(
+            lambda offset, count: sendfile(
+                f_dst.fileno(), f_src.fileno(), offset, count
+            ), nbytes
+        )
+        os.fsync(f_dst.fileno())
+
+
+def _kernel_copy(copy, nbytes):
+    """Copy nbytes with repeated calls of copy(offset, count),
+    which returns the number of bytes that it copied.
+
+    The source offset is passed explicitly so that the copy doesn't depend
+    on the file position.
+    """
+    offset = 0
+    while offset < nbytes:
+        copied = copy(offset, min(nbytes - offset, KERNEL_COPY_BYTES))
+        if not copied:
+            raise OSError(
+                errno.EINVAL, 'kernel copy stopped at byte {}'.format(offset)
+            )
+        offset += copied
+
+
+def _buffered_copy(src, dst, nbytes, hasher=None, throttle=None):
+    with src.open('rb') as f_src, dst.open('wb') as f_dst:
+        for buf in iter(lambda: f_src.read(COPY_BUFSIZE), b''):
+            if hasher is not None:
+                hasher.update(buf)
+            if throttle is not None:
+                throttle.consume(len(buf))
+            f_dst.write(buf)
+        f_dst.flush()
+        os.fsync(f_dst.fileno())
+
+
+_COPIERS = {
+    'hardlink': _hardlink,
+    'reflink': _reflink,
+    'copy_file_range': _copy_file_range,
+    'sendfile': _sendfile,
+    'copy': _buffered_copy,
+}
 
 
 def _delete_symlinks(symlinks):
@@ -0,0 +1,1254 @@
+# Copyright 2013-2017 The Salish Sea MEOPAR Contributors
+# and The University of British Columbia
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""In-process netCDF deflation engine.
+
+Copies the dimensions, variables, and attributes of a netCDF file into a
+new netCDF-4 file with compressed variables without spawning
+:program:`nccopy`.
+
+The structure of the new file is defined with netCDF4.
+The variables are then streamed from the source file in bounded-size
+hyperslabs,
+their chunks are shuffled and compressed on a thread pool,
+and the compressed chunks are written directly into the HDF5 datasets of
+the new file with h5py.
+Reading runs ahead of writing by up to :py:data:`PIPELINE_BYTES` of
+chunks,
+so that the chunks of successive hyperslabs,
+e.g. of successive time steps of a variable that is chunked one record at
+a time,
+are compressed in parallel,
+and a single large file can keep all of the pool's threads busy.
+Codecs other than zlib are applied by the HDF5 filter plugins that the
+netCDF-C library loads,
+so variables compressed with them are written through netCDF4,
+still one bounded-size hyperslab at a time.
+
+The netCDF-C and HDF5 libraries are not thread-safe,
+so all calls into them are serialized by a module-level lock;
+only the shuffling and compression,
+which release the GIL,
+run concurrently.
+"""
+from __future__ import division
+
+import collections
+from concurrent.futures import Future
+import fnmatch
+import functools
+import hashlib
+import itertools
+import logging
+import math
+import operator
+import random
+import threading
+import time
+import zlib
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import yaml
+
+from fvcom_cmd.fspath import expanded_path, fspath
+
+logger = logging.getLogger(__name__)
+
+#: Lock that serializes all calls into the netCDF-C and HDF5 libraries.
+NC_LOCK = threading.Lock()
+
+#: Maximum size in bytes of the chunks of the deflated variables.
+MAX_CHUNK_BYTES = 4 * 1024**2
+#: Minimum number of values in a chunk of a record variable;
+#: records are grouped together in chunks up to this size.
+MIN_CHUNK_ELEMS = 4096
+#: Upper limit in bytes of the uncompressed chunks of a variable that are
+#: queued for compression on the thread pool at a time.
+PIPELINE_BYTES = 64 * 1024**2
+
+#: Signature at the start of HDF5 (and so netCDF-4) files.
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+#: Compression codecs;
+#: codecs other than zlib require the corresponding HDF5 filter plugin.
+CODECS = (
+    'zlib', 'zstd', 'bzip2', 'blosc_lz', 'blosc_lz4', 'blosc_lz4hc',
+    'blosc_zlib', 'blosc_zstd'
+)
+#: HDF5 filter ids of the codecs other than zlib and Blosc.
+FILTER_IDS = {'zstd': 32015, 'bzip2': 307}
+#: HDF5 filter id of Blosc.
+BLOSC_FILTER_ID = 32001
+#: HDF5 filter ids of Lempel-Ziv compression and byte shuffling.
+DEFLATE_FILTER_ID, SHUFFLE_FILTER_ID = 1, 2
+#: Blosc compressor codes of the blosc codecs.
+BLOSC_COMPRESSORS = {
+    'blosc_lz': 0,
+    'blosc_lz4': 1,
+    'blosc_lz4hc': 2,
+    'blosc_zlib': 4,
+    'blosc_zstd': 5,
+}
+
+#: Default number of randomly chosen hyperslabs of each variable that
+#: :func:`verify_sample` compares.
+VERIFY_SAMPLES = 4
+#: Attributes that deflation adds to quantized variables.
+QUANTIZATION_ATTRS = ('quantization', 'quantization_nsb')
+
+#: Name of the container variable that describes the quantization applied
+#: to the variables that have a :kbd:`quantization` attribute;
+#: see the CF conventions section on lossy compression by coordinate
+#: sampling and quantization.
+QUANTIZATION_VAR = 'quantization_info'
+
+#: Default directory in which per-variable deflation profiles are stored.
+PROFILE_DIR = '~/.fvcom-cmd/deflate-profiles'
+#: Lempel-Ziv compression levels tried by :func:`tune`;
+#: 0 stands for no compression.
+TUNE_LEVELS = range(0, 10)
+
+
+def deflate_file(
+    src,
+    dst,
+    dfl_lvl=4,
+    shuffle=True,
+    executor=None,
+    profile_dir=None,
+    codec='zlib',
+    quantize=None
+):
+    """Copy the netCDF file src to the netCDF-4 file dst with its variables
+    compressed with codec;
+    Lempel-Ziv compression by default.
+
+    Only the root group of src is copied.
+
+    Floating point variables can be quantized before compression by
+    rounding their mantissas to a number of significant bits with
+    :func:`bit_round`.
+    Quantized variables get :kbd:`quantization` and
+    :kbd:`quantization_nsb` attributes that refer to a
+    :py:data:`QUANTIZATION_VAR` container variable that describes the
+    algorithm.
+
+    :param src: Path/name of the netCDF file to deflate.
+    :type src: :py:class:`pathlib.Path`
+
+    :param dst: Path/name of the netCDF-4 file to create.
+    :type dst: :py:class:`pathlib.Path`
+
+    :param int dfl_lvl: Compression level to use;
+                        0 means no compression.
+
+    :param boolean shuffle: Shuffle the bytes of the values before
+                            compression;
+                            the HDF5 shuffle filter for zlib,
+                            and Blosc's own byte shuffle for the blosc codecs.
+                            netCDF4 can't combine the HDF5 shuffle filter
+                            with the zstd or bzip2 codecs,
+                            so it is ignored for them.
+
+    :param executor: Executor on which to shuffle and compress the chunks of
+                     the variables;
+                     the chunks are processed in the calling thread if it is
+                     :py:obj:`None`.
+    :type executor: :py:class:`concurrent.futures.Executor`
+
+    :param profile_dir: Directory of per-variable deflation profiles
+                        created by :func:`tune`.
+                        If it contains a profile for the configuration that
+                        produced src,
+                        the compression level and shuffle setting of each
+                        variable in the profile override dfl_lvl and shuffle.
+                        Profiles are only applied with the zlib codec.
+    :type profile_dir: :py:class:`pathlib.Path`
+
+    :param str codec: Compression codec to use;
+                      one of :py:data:`CODECS`.
+
+    :param dict quantize: Mapping of glob patterns of variable names to the
+                          number of mantissa bits to keep in the floating
+                          point variables whose names match them;
+                          the largest number of bits of the matching
+                          patterns applies.
+                          Variables that match no pattern are not quantized.
+
+    :returns: CPU time in seconds used by the deflation,
+              including the compression of chunks on executor's threads.
+    :rtype: float
+
+    :raises: :py:exc:`ImportError` if netCDF4, h5py or numpy is not
+             installed.
+    """
+    if not available():
+        raise ImportError(
+            'in-process deflation requires the netCDF4, h5py, and numpy '
+            'packages'
+        )
+    cpu_start = thread_time()
+    pool_cpu_time = 0
+    with NC_LOCK:
+        src_ds = netCDF4.Dataset(fspath(src))
+    try:
+        profile = None
+        if profile_dir is not None and codec == 'zlib':
+            with NC_LOCK:
+                profile = load_profile(profile_dir, signature(src_ds))
+            if profile is not None:
+                logger.debug(
+                    'deflating {} with profile tuned on {}'.format(
+                        src, profile['source']
+                    )
+                )
+        with NC_LOCK:
+            chunked_vars = _define_dataset(
+                src_ds, dst, dfl_lvl, shuffle, profile, codec, quantize
+            )
+            if not chunked_vars:
+                return thread_time() - cpu_start
+            dst_h5 = h5py.File(fspath(dst), 'r+')
+        try:
+            for name in chunked_vars:
+                pool_cpu_time += _copy_chunks(
+                    src_ds.variables[name], dst_h5[name], executor
+                )
+        finally:
+            with NC_LOCK:
+                dst_h5.close()
+    finally:
+        with NC_LOCK:
+            src_ds.close()
+    return thread_time() - cpu_start + pool_cpu_time
+
+
+def available():
+    """Return :py:obj:`True` if the packages that the in-process engine
+    requires are installed.
+    """
+    return not (netCDF4 is None or h5py is None or numpy is None)
+
+
+def thread_time():
+    """Return the CPU time in seconds of the calling thread.
+
+    Falls back to the CPU time of the process on Pythons that can't
+    measure the CPU time of a thread.
+
+    :rtype: float
+    """
+    try:
+        return time.thread_time()
+    except AttributeError:
+        # Python < 3.7
+        return time.process_time()
+
+
+def is_deflated(
+    filepath,
+    dfl_lvl=4,
+    codec='zlib',
+    shuffle=True,
+    profile_dir=None,
+    quantize=None
+):
+    """Return a boolean indicating whether or not filepath is a netCDF-4 file
+    in which all of the variables are already compressed with codec at
+    dfl_lvl, and shuffled if shuffle is :py:obj:`True`.
+
+    If quantize is given,
+    the floating point variables that :func:`deflate_file` would quantize
+    must also have been quantized to the same number of mantissa bits.
+
+    If profile_dir contains a zlib deflation profile for the configuration
+    that produced filepath,
+    the variables in the profile are checked against its compression level
+    and shuffle setting instead,
+    as they are applied by :func:`deflate_file`.
+
+    Only the file signature and the file header are read.
+    netCDF-3 files are recognized from their signature alone;
+    checking the variable filters of netCDF-4 files requires netCDF4,
+    and if it is not installed the file is assumed not to be deflated.
+
+    :param filepath: Path/name of the netCDF file to check.
+    :type filepath: :py:class:`pathlib.Path`
+
+    :param int dfl_lvl: Compression level to check for.
+
+    :param str codec: Compression codec to check for;
+                      one of :py:data:`CODECS`.
+
+    :param boolean shuffle: Shuffle setting to check for;
+                            see :func:`deflate_file`.
+
+    :param profile_dir: Directory of per-variable deflation profiles
+                        created by :func:`tune`.
+    :type profile_dir: :py:class:`pathlib.Path`
+
+    :param dict quantize: Quantization to check for;
+                          see :func:`deflate_file`.
+
+    :rtype: boolean
+    """
+    try:
+        with open(fspath(filepath), 'rb') as f:
+            if f.read(len(HDF5_SIGNATURE)) != HDF5_SIGNATURE:
+                return False
+    except (IOError, OSError):
+        return False
+    if netCDF4 is None or numpy is None:
+        return False
+    try:
+        with NC_LOCK:
+            with netCDF4.Dataset(fspath(filepath)) as ds:
+                profile = None
+                if profile_dir is not None and codec == 'zlib':
+                    profile = load_profile(profile_dir, signature(ds))
+                filters = {
+                    name: var.filters()
+                    for name, var in ds.variables.items()
+                    if var.ndim > 0 and isinstance(var.datatype, numpy.dtype)
+                }
+                if any(
+                    _quantization(var)[0] != _keep_bits(var, quantize)
+                    for var in ds.variables.values()
+                    if isinstance(var.datatype, numpy.dtype)
+                    and _keep_bits(var, quantize) is not None
+                ):
+                    return False
+    except (IOError, OSError, RuntimeError):
+        return False
+    for name, var_filters in filters.items():
+        settings = (profile or {}).get('variables', {}).get(name, {})
+        var_dfl_lvl = settings.get('dfl_lvl', dfl_lvl)
+        if var_dfl_lvl == 0:
+            if filter_codec(var_filters) is not None:
+                return False
+        elif not (
+            filter_codec(var_filters) == codec
+            and var_filters['complevel'] == var_dfl_lvl and _shuffle_matches(
+                var_filters, codec, settings.get('shuffle', shuffle)
+            )
+        ):
+            return False
+    return True
+
+
+def filter_codec(var_filters):
+    """Return the compression codec in the filters of a netCDF variable.
+
+    :param dict var_filters: Variable filters returned by
+                             :py:meth:`netCDF4.Variable.filters`.
+
+    :returns: Codec name from :py:data:`CODECS`,
+              or :py:obj:`None` if the variable isn't compressed.
+    :rtype: str
+    """
+    for codec in ('zlib', 'zstd', 'bzip2'):
+        if var_filters.get(codec):
+            return codec
+    if var_filters.get('blosc'):
+        return var_filters['blosc']['compressor']
+    return None
+
+
+def _shuffle_matches(var_filters, codec, shuffle):
+    if codec in BLOSC_COMPRESSORS:
+        return bool(var_filters['blosc']['shuffle']) == shuffle
+    if codec == 'zlib':
+        return var_filters['shuffle'] == shuffle
+    # netCDF4 doesn't apply the shuffle filter with the other codecs
+    return True
+
+
+def codec_available(codec):
+    """Return a boolean indicating whether or not the HDF5 filter for codec
+    is available to the netCDF-C library that netCDF4 is linked with.
+
+    zlib is always available.
+
+    :param str codec: Compression codec; one of :py:data:`CODECS`.
+
+    :rtype: boolean
+    """
+    if codec == 'zlib':
+        return True
+    if codec not in CODECS or netCDF4 is None:
+        return False
+    with NC_LOCK:
+        with netCDF4.Dataset(
+            'fvc-codec-probe.nc', 'w', diskless=True, persist=False
+        ) as ds:
+            has_filter = {
+                'zstd': getattr(ds, 'has_zstd_filter', None),
+                'bzip2': getattr(ds, 'has_bzip2_filter', None),
+            }.get(codec, getattr(ds, 'has_blosc_filter', None))
+            return has_filter is not None and has_filter()
+
+
+def check_readable(filepath, codec, dfl_lvl=4):
+    """Confirm that the variables in the netCDF-4 file filepath are
+    compressed with codec and that they can be decompressed.
+
+    The first chunk of each compressed variable is read back,
+    which fails if the HDF5 filter for codec can't be loaded.
+
+    :param filepath: Path/name of the netCDF-4 file to check.
+    :type filepath: :py:class:`pathlib.Path`
+
+    :param str codec: Compression codec that the file should be compressed
+                      with; one of :py:data:`CODECS`.
+
+    :param int dfl_lvl: Compression level that the file was written with;
+                        0 means that it is not compressed.
+
+    :raises: :py:exc:`ValueError` if a variable isn't compressed with codec
+             or can't be read back.
+    """
+    with NC_LOCK:
+        with netCDF4.Dataset(fspath(filepath)) as ds:
+            for name, var in ds.variables.items():
+                if not _is_chunkable(var) or not var.size:
+                    continue
+                var_codec = filter_codec(var.filters())
+                if dfl_lvl and var_codec != codec:
+                    raise ValueError(
+                        '{name} in {filepath} is compressed with {var_codec} '
+                        'instead of {codec}'.format(
+                            name=name,
+                            filepath=filepath,
+                            var_codec=var_codec,
+                            codec=codec
+                        )
+                    )
+                chunks = var.chunking()
+                if chunks == 'contiguous':
+                    continue
+                var.set_auto_maskandscale(False)
+                try:
+                    var[tuple(slice(0, chunk) for chunk in chunks)]
+                except (IOError, OSError, RuntimeError) as exc:
+                    raise ValueError(
+                        'unable to read {} back from {}: {}'.format(
+                            name, filepath, exc
+                        )
+                    )
+
+
+def verify_sample(src, dst, n_samples=VERIFY_SAMPLES, rng=None):
+    """Compare the dimensions, attributes, and variable metadata of the
+    netCDF file src with those of its deflated copy dst,
+    and the values in n_samples randomly chosen hyperslabs of each
+    variable.
+
+    Each hyperslab is at most one chunk of up to
+    :py:data:`MAX_CHUNK_BYTES`,
+    so the cost of the comparison is bounded by the number of variables
+    rather than the size of the file.
+    The values of quantized variables in dst are compared with the
+    quantized values of src.
+
+    :param src: Path/name of the original netCDF file.
+    :type src: :py:class:`pathlib.Path`
+
+    :param dst: Path/name of the deflated netCDF-4 file.
+    :type dst: :py:class:`pathlib.Path`
+
+    :param int n_samples: Number of hyperslabs of each variable to compare.
+
+    :param rng: Random number generator to choose the hyperslabs with.
+    :type rng: :py:class:`random.Random`
+
+    :returns: Descriptions of the differences found; empty if there are
+              none.
+    :rtype: list
+    """
+    rng = rng or random.Random()
+    with NC_LOCK:
+        src_ds = netCDF4.Dataset(fspath(src))
+        try:
+            dst_ds = netCDF4.Dataset(fspath(dst))
+        except Exception:
+            src_ds.close()
+            raise
+    try:
+        with NC_LOCK:
+            mismatches = _compare_metadata(src_ds, dst_ds)
+            names = [
+                name for name in src_ds.variables if name in dst_ds.variables
+            ]
+        for name in names:
+            mismatch = _compare_samples(
+                src_ds.variables[name], dst_ds.variables[name], n_samples,
+                rng
+            )
+            if mismatch is not None:
+                mismatches.append(mismatch)
+    finally:
+        with NC_LOCK:
+            dst_ds.close()
+            src_ds.close()
+    return mismatches
+
+
+def _compare_metadata(src_ds, dst_ds):
+    """Return descriptions of the differences between the dimensions,
+    global attributes, and variable definitions of src_ds and dst_ds.
+    """
+    mismatches = []
+    for name, dim in src_ds.dimensions.items():
+        if name not in dst_ds.dimensions:
+            mismatches.append('dimension {} is missing'.format(name))
+            continue
+        dst_dim = dst_ds.dimensions[name]
+        if (len(dst_dim), dst_dim.isunlimited()) != (
+            len(dim), dim.isunlimited()
+        ):
+            mismatches.append('dimension {} differs'.format(name))
+    mismatches.extend(
+        'global {}'.format(mismatch)
+        for mismatch in _compare_attrs(src_ds, dst_ds)
+    )
+    for name, var in src_ds.variables.items():
+        if name not in dst_ds.variables:
+            mismatches.append('variable {} is missing'.format(name))
+            continue
+        dst_var = dst_ds.variables[name]
+        if dst_var.datatype != var.datatype:
+            mismatches.append('type of {} differs'.format(name))
+        if dst_var.dimensions != var.dimensions:
+            mismatches.append('dimensions of {} differ'.format(name))
+        mismatches.extend(
+            '{} {}'.format(name, mismatch)
+            for mismatch in _compare_attrs(var, dst_var, QUANTIZATION_ATTRS)
+        )
+    extra = set(dst_ds.variables) - set(src_ds.variables) - {QUANTIZATION_VAR}
+    mismatches.extend(
+        'unexpected variable {}'.format(name) for name in sorted(extra)
+    )
+    return mismatches
+
+
+def _compare_attrs(src, dst, ignore=()):
+    """Return descriptions of the differences between the attributes of
+    the netCDF datasets or variables src and dst,
+    other than those in ignore.
+    """
+    src_attrs = set(src.ncattrs())
+    dst_attrs = set(dst.ncattrs()) - set(ignore)
+    mismatches = [
+        'attribute {} is missing'.format(attr)
+        for attr in sorted(src_attrs - dst_attrs)
+    ]
+    mismatches.extend(
+        'attribute {} is unexpected'.format(attr)
+        for attr in sorted(dst_attrs - src_attrs)
+    )
+    mismatches.extend(
+        'attribute {} differs'.format(attr)
+        for attr in sorted(src_attrs & dst_attrs) if not numpy.array_equal(
+            numpy.asarray(src.getncattr(attr)),
+            numpy.asarray(dst.getncattr(attr))
+        )
+    )
+    return mismatches
+
+
+def _compare_samples(src_var, dst_var, n_samples, rng):
+    """Compare the values of n_samples randomly chosen hyperslabs of
+    src_var and dst_var.
+
+    :returns: Description of the first difference found;
+              :py:obj:`None` if there is none.
+    :rtype: str
+    """
+    with NC_LOCK:
+        if src_var.shape != dst_var.shape or not src_var.size:
+            return None
+        for var in (src_var, dst_var):
+            var.set_auto_maskandscale(False)
+            var.set_auto_chartostring(False)
+        keep_bits, fill_value = _quantization(dst_var)
+    # Variable-length string variables have dtype str
+    itemsize = getattr(src_var.dtype, 'itemsize', 1)
+    extents = chunk_shape(src_var.shape, [False] * src_var.ndim, itemsize)
+    for _ in range(n_samples if src_var.ndim else 1):
+        slab = tuple(
+            slice(start, start + extent) for start, extent in
+            ((rng.randrange(size - extent + 1), extent)
+             for size, extent in zip(src_var.shape, extents))
+        )
+        with NC_LOCK:
+            expected = src_var[slab]
+            actual = dst_var[slab]
+        if keep_bits is not None:
+            expected = bit_round(expected, keep_bits, fill_value)
+        if not _same_values(expected, actual):
+            return 'values of {} differ in hyperslab [{}]'.format(
+                src_var.name, ', '.join(
+                    '{0.start}:{0.stop}'.format(s) for s in slab
+                )
+            )
+    return None
+
+
+def _same_values(expected, actual):
+    """Return :py:obj:`True` if the arrays expected and actual are equal,
+    treating NaNs in the same places as equal.
+    """
+    expected, actual = numpy.asarray(expected), numpy.asarray(actual)
+    if expected.shape != actual.shape:
+        return False
+    if expected.dtype.kind == 'f':
+        both_nan = numpy.isnan(expected) & numpy.isnan(actual)
+        return bool(((expected == actual) | both_nan).all())
+    return bool((expected == actual).all())
+
+
+def bit_round(values, keep_bits, fill_value=None):
+    """Round the mantissas of floating point values to keep_bits
+    significant bits.
+
+    The bits below keep_bits are rounded to nearest,
+    with ties to even,
+    and set to zero so that they compress to almost nothing.
+    The maximum relative error is 2**-(keep_bits + 1).
+    Values that are not finite, equal to fill_value,
+    or so close to the largest value of their type that they would round
+    up to infinity are left unchanged.
+
+    :param values: Floating point values to round.
+    :type values: :py:class:`numpy.ndarray`
+
+    :param int keep_bits: Number of mantissa bits to keep.
+
+    :param fill_value: Fill value of the variable that values are from.
+
+    :returns: Rounded values; values itself if there are no bits to drop.
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    values = numpy.asarray(values)
+    if values.dtype.kind != 'f':
+        return values
+    drop_bits = numpy.finfo(values.dtype).nmant - keep_bits
+    if drop_bits <= 0:
+        return values
+    uint = numpy.dtype('u{}'.format(values.dtype.itemsize)).type
+    bits = numpy.ascontiguousarray(values).view(uint)
+    half = uint(1 << (drop_bits - 1))
+    mask = ~uint((1 << drop_bits) - 1)
+    odd = (bits >> uint(drop_bits)) & uint(1)
+    rounded = ((bits + (half - uint(1)) + odd) & mask).view(values.dtype)
+    keep = numpy.isfinite(values) & numpy.isfinite(rounded)
+    if fill_value is not None:
+        keep &= values != fill_value
+    return numpy.where(keep, rounded, values)
+
+
+def digits_to_bits(digits):
+    """Return the number of mantissa bits that preserve digits significant
+    decimal digits.
+
+    :param int digits: Number of significant decimal digits.
+
+    :rtype: int
+    """
+    return int(math.ceil(digits * math.log(10, 2)))
+
+
+def hdf5_filter_spec(codec, dfl_lvl, shuffle=True):
+    """Return the HDF5 filter id and parameters of a codec other than zlib
+    in the form used by the :kbd:`-F` option of :program:`nccopy`.
+
+    :param str codec: Compression codec; one of :py:data:`CODECS` except
+                      zlib.
+
+    :param int dfl_lvl: Compression level.
+
+    :param boolean shuffle: Use Blosc's byte shuffle;
+                            only applies to the blosc codecs.
+
+    :returns: Comma-separated filter id and parameters.
+    :rtype: str
+    """
+    if codec in BLOSC_COMPRESSORS:
+        # The first 4 Blosc parameters are filled in by the filter
+        params = [
+            BLOSC_FILTER_ID, 0, 0, 0, 0, dfl_lvl,
+            int(shuffle), BLOSC_COMPRESSORS[codec]
+        ]
+    else:
+        params = [FILTER_IDS[codec], dfl_lvl]
+    return ','.join(str(param) for param in params)
+
+
+def signature(ds):
+    """Return a digest that identifies the model configuration that
+    produced a netCDF dataset.
+
+    The digest is calculated from the names and sizes of the fixed
+    dimensions, and the names, dimensions, and types of the variables,
+    so it doesn't depend on the number of records in the dataset.
+
+    :param ds: netCDF dataset.
+    :type ds: :py:class:`netCDF4.Dataset`
+
+    :rtype: str
+    """
+    sha1 = hashlib.sha1()
+    for name, dim in sorted(ds.dimensions.items()):
+        size = 'unlimited' if dim.isunlimited() else len(dim)
+        sha1.update(u'{}={}\n'.format(name, size).encode('utf-8'))
+    for name, var in sorted(ds.variables.items()):
+        sha1.update(
+            u'{}{}{}\n'.format(name, var.dimensions, var.dtype).encode('utf-8')
+        )
+    return sha1.hexdigest()
+
+
+def tune(filepath, n_samples=8, tolerance=0.05):
+    """Calculate a per-variable deflation profile for a netCDF file.
+
+    A sample of n_samples chunks of each variable is compressed at each
+    of the levels in :py:data:`TUNE_LEVELS`,
+    with and without shuffling,
+    and the compressed size and CPU time are measured.
+    The setting chosen for each variable is the one with the least CPU time
+    among those whose compressed size is within tolerance of the smallest.
+
+    :param filepath: Path/name of the netCDF file to tune on.
+    :type filepath: :py:class:`pathlib.Path`
+
+    :param int n_samples: Number of chunks of each variable to sample.
+
+    :param float tolerance: Fraction by which the compressed size of the
+                            chosen setting may exceed the smallest.
+
+    :returns: Profile with the file's configuration signature,
+              and the compression level, shuffle setting,
+              sampled compression ratio,
+              and sampled CPU seconds per MB for each variable.
+    :rtype: dict
+    """
+    with NC_LOCK:
+        ds = netCDF4.Dataset(fspath(filepath))
+        try:
+            variables = {}
+            for name, var in ds.variables.items():
+                if not _is_chunkable(var) or not var.size:
+                    continue
+                var.set_auto_maskandscale(False)
+                var.set_auto_chartostring(False)
+                chunks = _var_chunk_shape(ds, var)
+                blocks = _sample_chunks(var, chunks, n_samples)
+                variables[name] = _tune_variable(
+                    blocks, chunks, var.dtype, tolerance
+                )
+            return {
+                'signature': signature(ds),
+                'source': fspath(filepath.resolve()),
+                'variables': variables,
+            }
+        finally:
+            ds.close()
+
+
+def _sample_chunks(var, chunks, n_samples):
+    """Read n_samples chunks evenly spaced through the chunk grid of var.
+    """
+    grid = [-(-size // chunk) for size, chunk in zip(var.shape, chunks)]
+    n_chunks = _product(grid)
+    indices = sorted({
+        i * n_chunks // n_samples
+        for i in range(min(n_samples, n_chunks))
+    })
+    blocks = []
+    for index in indices:
+        offsets = numpy.unravel_index(index, grid)
+        blocks.append(
+            var[tuple(
+                slice(offset * chunk, (offset + 1) * chunk)
+                for offset, chunk in zip(offsets, chunks)
+            )]
+        )
+    return blocks
+
+
+def _tune_variable(blocks, chunks, dtype, tolerance):
+    raw_bytes = len(blocks) * _product(chunks) * dtype.itemsize
+    results = []
+    for shuffle in (False, True):
+        for level in TUNE_LEVELS:
+            if shuffle and level == 0:
+                continue
+            t_start = time.process_time()
+            size = sum(
+                len(_encode_chunk(block, chunks, dtype, shuffle, level))
+                for block in blocks
+            )
+            cpu_time = time.process_time() - t_start
+            results.append((size, cpu_time, level, shuffle))
+    smallest = min(size for size, _, _, _ in results)
+    size, cpu_time, level, shuffle = min(
+        (result for result in results
+         if result[0] <= smallest * (1 + tolerance)),
+        key=lambda result: result[1]
+    )
+    return {
+        'dfl_lvl': level,
+        'shuffle': shuffle,
+        'ratio': round(raw_bytes / size, 3),
+        'cpu_s_per_mb': round(cpu_time / (raw_bytes / 1e6), 4),
+    }
+
+
+def save_profile(profile, profile_dir=PROFILE_DIR):
+    """Write a deflation profile created by :func:`tune` into profile_dir
+    as a YAML file named for the profile's configuration signature.
+
+    :param dict profile: Deflation profile.
+
+    :param profile_dir: Directory in which to store the profile;
+                        it is created if it doesn't exist.
+    :type profile_dir: :py:class:`pathlib.Path` or str
+
+    :returns: Path/name of the profile file.
+    :rtype: :py:class:`pathlib.Path`
+    """
+    profile_dir = expanded_path(profile_dir)
+    if not profile_dir.exists():
+        profile_dir.mkdir(parents=True)
+    profile_file = profile_dir / '{}.yaml'.format(profile['signature'])
+    with profile_file.open('wt') as f:
+        yaml.safe_dump(profile, f, default_flow_style=False)
+    return profile_file
+
+
+def file_profile(filepath, profile_dir):
+    """Read the deflation profile for the model configuration that
+    produced a netCDF file from profile_dir.
+
+    Only the file header is read.
+
+    :param filepath: Path/name of the netCDF file.
+    :type filepath: :py:class:`pathlib.Path`
+
+    :param profile_dir: Directory in which profiles are stored.
+    :type profile_dir: :py:class:`pathlib.Path` or str
+
+    :returns: Deflation profile,
+              or :py:obj:`None` if there isn't one for the file,
+              or netCDF4 isn't installed.
+    :rtype: dict
+    """
+    if netCDF4 is None:
+        return None
+    try:
+        with NC_LOCK:
+            with netCDF4.Dataset(fspath(filepath)) as ds:
+                config_signature = signature(ds)
+    except (IOError, OSError, RuntimeError):
+        return None
+    return load_profile(profile_dir, config_signature)
+
+
+def nccopy_filter_spec(dfl_lvl, shuffle):
+    """Return the HDF5 filter chain for Lempel-Ziv compression at dfl_lvl
+    in the form used by the :kbd:`-F` option of :program:`nccopy`.
+
+    :param int dfl_lvl: Compression level;
+                        0 removes the filters.
+
+    :param boolean shuffle: Shuffle the bytes of the values before
+                            compressing them.
+
+    :returns: :kbd:`|` separated filter ids and parameters.
+    :rtype: str
+    """
+    if dfl_lvl == 0:
+        return 'none'
+    spec = '{},{}'.format(DEFLATE_FILTER_ID, dfl_lvl)
+    return '{}|{}'.format(SHUFFLE_FILTER_ID, spec) if shuffle else spec
+
+
+def load_profile(profile_dir, config_signature):
+    """Read the deflation profile for a configuration signature from
+    profile_dir.
+
+    :param profile_dir: Directory in which profiles are stored.
+    :type profile_dir: :py:class:`pathlib.Path` or str
+
+    :param str config_signature: Configuration signature calculated by
+                                 :func:`signature`.
+
+    :returns: Deflation profile,
+              or :py:obj:`None` if there isn't one for config_signature.
+    :rtype: dict
+    """
+    profile_file = expanded_path(profile_dir) / '{}.yaml'.format(
+        config_signature
+    )
+    try:
+        with profile_file.open('rt') as f:
+            return yaml.safe_load(f)
+    except (IOError, OSError):
+        return None
+
+
+def chunk_shape(shape, unlimited, itemsize):
+    """Calculate the chunk shape for a deflated variable.
+
+    Chunks hold at most :py:data:`MAX_CHUNK_BYTES` bytes.
+    Record dimensions are chunked in blocks of records that hold up to
+    :py:data:`MIN_CHUNK_ELEMS` values so that small record variables like
+    :kbd:`time` aren't split into a chunk per record.
+
+    :param sequence shape: Shape of the variable.
+
+    :param sequence unlimited: Booleans indicating which of the dimensions
+                               of the variable are unlimited.
+
+    :param int itemsize: Size in bytes of the variable's elements.
+
+    :returns: Chunk shape.
+    :rtype: list
+    """
+    chunks = [max(size, 1) for size in shape]
+    for i, is_unlimited in enumerate(unlimited):
+        if is_unlimited:
+            trailing = _product(chunks[i + 1:])
+            chunks[i] = max(min(chunks[i], MIN_CHUNK_ELEMS // trailing), 1)
+    max_elems = max(MAX_CHUNK_BYTES // itemsize, 1)
+    for i in range(len(chunks)):
+        total = _product(chunks)
+        if total <= max_elems:
+            break
+        chunks[i] = max(max_elems // (total // chunks[i]), 1)
+    return chunks
+
+
+def _product(sizes):
+    return functools.reduce(operator.mul, sizes, 1)
+
+
+def _is_chunkable(var):
+    return (
+        var.ndim > 0 and isinstance(var.datatype, numpy.dtype)
+        and var.datatype.kind in 'biufS'
+    )
+
+
+def _var_chunk_shape(ds, var):
+    return chunk_shape(
+        var.shape,
+        [ds.dimensions[dim].isunlimited() for dim in var.dimensions],
+        var.datatype.itemsize,
+    )
+
+
+def _define_dataset(
+    src_ds, dst, dfl_lvl, shuffle, profile=None, codec='zlib', quantize=None
+):
+    """Create dst with the dimensions, variables, and attributes of src_ds.
+
+    Variables that can't be written as HDF5 chunks (scalars, and
+    variable-length types) are copied via the netCDF-C library.
+    So are all of the variables when codec isn't zlib;
+    the chunkable ones one slab at a time.
+
+    The compression level and shuffle setting of the variables in profile
+    override dfl_lvl and shuffle.
+
+    The floating point variables whose names match the patterns in quantize
+    get the attributes that record their quantization.
+
+    :returns: Names of the variables whose data are to be copied chunk by
+              chunk.
+    :rtype: list
+    """
+    if src_ds.groups:
+        raise ValueError(
+            '{} contains groups; only flat netCDF files can be deflated '
+            'in-process'.format(src_ds.filepath())
+        )
+    chunked_vars = []
+    quantized = False
+    with netCDF4.Dataset(fspath(dst), 'w', format='NETCDF4') as dst_ds:
+        for name, dim in src_ds.dimensions.items():
+            dst_ds.createDimension(
+                name, None if dim.isunlimited() else len(dim)
+            )
+        dst_ds.setncatts(
+            {attr: src_ds.getncattr(attr)
+             for attr in src_ds.ncattrs()}
+        )
+        for name, src_var in src_ds.variables.items():
+            src_var.set_auto_maskandscale(False)
+            src_var.set_auto_chartostring(False)
+            chunked = _is_chunkable(src_var)
+            var_kwargs = {}
+            if chunked:
+                settings = (profile or {}).get('variables', {}).get(name, {})
+                var_dfl_lvl = settings.get('dfl_lvl', dfl_lvl)
+                var_kwargs = _compression_kwargs(
+                    codec, var_dfl_lvl, settings.get('shuffle', shuffle)
+                )
+                var_kwargs['chunksizes'] = _var_chunk_shape(src_ds, src_var)
+            attrs = {
+                attr: src_var.getncattr(attr)
+                for attr in src_var.ncattrs()
+            }
+            dst_var = dst_ds.createVariable(
+                name,
+                src_var.datatype,
+                src_var.dimensions,
+                fill_value=attrs.pop('_FillValue', None),
+                **var_kwargs
+            )
+            keep_bits = _keep_bits(src_var, quantize)
+            if keep_bits is not None:
+                attrs.update(
+                    zip(
+                        QUANTIZATION_ATTRS,
+                        (QUANTIZATION_VAR, numpy.int32(keep_bits))
+                    )
+                )
+                quantized = True
+            dst_var.setncatts(attrs)
+            if chunked and codec != 'zlib':
+                if src_var.size:
+                    _copy_slabs(src_var, dst_var)
+            elif chunked:
+                if src_var.size:
+                    chunked_vars.append(name)
+            else:
+                dst_var.set_auto_maskandscale(False)
+                dst_var.set_auto_chartostring(False)
+                dst_var[...] = src_var[...]
+        if quantized and QUANTIZATION_VAR not in dst_ds.variables:
+            _define_quantization_var(dst_ds)
+    return chunked_vars
+
+
+def _keep_bits(var, quantize):
+    """Return the number of mantissa bits to keep in var,
+    or :py:obj:`None` if it is not to be quantized.
+    """
+    if not quantize or var.dtype.kind != 'f' or var.ndim == 0:
+        return None
+    matches = [
+        keep_bits for pattern, keep_bits in quantize.items()
+        if fnmatch.fnmatch(var.name, pattern)
+    ]
+    return max(matches) if matches else None
+
+
+def _define_quantization_var(ds):
+    container = ds.createVariable(QUANTIZATION_VAR, 'i4', ())
+    container.setncatts({
+        'algorithm': 'bitround',
+        'implementation': 'fvcom_cmd.ncdeflate.bit_round',
+    })
+
+
+def _quantization(var):
+    """Return the number of mantissa bits to keep in netCDF variable or
+    HDF5 dataset var and its fill value,
+    or :py:obj:`None` and :py:obj:`None` if it is not quantized.
+    """
+    attrs = dict(var.attrs) if hasattr(var, 'attrs') else {
+        attr: var.getncattr(attr)
+        for attr in var.ncattrs()
+    }
+    if 'quantization_nsb' not in attrs:
+        return None, None
+    if '_FillValue' in attrs:
+        fill_value = numpy.asarray(attrs['_FillValue']).item()
+    else:
+        fill_value = netCDF4.default_fillvals[var.dtype.str[1:]]
+    return numpy.asarray(attrs['quantization_nsb']).item(), fill_value
+
+
+def _compression_kwargs(codec, dfl_lvl, shuffle):
+    """Return the netCDF4 createVariable() keyword arguments that apply
+    codec at dfl_lvl.
+    """
+    if dfl_lvl == 0:
+        return {'compression': None, 'shuffle': False}
+    return {
+        'compression': codec,
+        'complevel': dfl_lvl,
+        'shuffle': shuffle and codec == 'zlib',
+        'blosc_shuffle': int(shuffle),
+    }
+
+
+def _copy_slabs(src_var, dst_var):
+    """Copy the data of src_var into dst_var via the netCDF-C library one
+    slab of chunks at a time.
+
+    Each slab is one chunk thick along the first dimension of the variable.
+    """
+    dst_var.set_auto_maskandscale(False)
+    dst_var.set_auto_chartostring(False)
+    keep_bits, fill_value = _quantization(dst_var)
+    thickness = dst_var.chunking()[0]
+    for start in range(0, src_var.shape[0], thickness):
+        slab = src_var[start:start + thickness]
+        if keep_bits is not None:
+            slab = bit_round(slab, keep_bits, fill_value)
+        dst_var[start:start + thickness] = slab
+
+
+def _copy_chunks(src_var, dst_dset, executor):
+    """Stream the data of src_var into dst_dset one slab of chunks at a
+    time.
+
+    Each slab is one chunk thick along the first dimension of the variable.
+    The chunks are shuffled and compressed on executor,
+    with up to :py:data:`PIPELINE_BYTES` of them in flight,
+    across slabs,
+    and written in order as they become available.
+
+    :returns: CPU time in seconds used to compress the chunks on executor's
+              threads; 0 if executor is :py:obj:`None`.
+    :rtype: float
+    """
+    shape = src_var.shape
+    chunks = dst_dset.chunks
+    level = dst_dset.compression_opts if dst_dset.compression else 0
+    with NC_LOCK:
+        keep_bits, fill_value = _quantization(dst_dset)
+    encode = functools.partial(
+        _encode_chunk,
+        chunks=chunks,
+        dtype=dst_dset.dtype,
+        shuffle=dst_dset.shuffle,
+        level=level,
+        keep_bits=keep_bits,
+        fill_value=fill_value
+    )
+    if executor is not None:
+        encode = functools.partial(_timed, encode)
+        submit = executor.submit
+    else:
+        encode = functools.partial(_untimed, encode)
+        submit = _call_now
+    chunk_bytes = _product(chunks) * dst_dset.dtype.itemsize
+    window = max(2, PIPELINE_BYTES // chunk_bytes)
+    cpu_time = 0
+    in_flight = collections.deque()
+
+    def write_oldest():
+        offsets, future = in_flight.popleft()
+        data, encode_time = future.result()
+        with NC_LOCK:
+            dst_dset.id.write_direct_chunk(offsets, data)
+        return encode_time
+
+    with NC_LOCK:
+        if dst_dset.shape != shape:
+            dst_dset.resize(shape)
+    for offsets, block in _chunk_blocks(src_var, chunks):
+        in_flight.append((offsets, submit(encode, block)))
+        if len(in_flight) >= window:
+            cpu_time += write_oldest()
+    while in_flight:
+        cpu_time += write_oldest()
+    return cpu_time
+
+
+def _chunk_blocks(src_var, chunks):
+    """Read src_var one slab of chunks at a time.
+
+    :returns: Iterator of the offsets and data of each chunk of src_var,
+              in storage order.
+    """
+    shape = src_var.shape
+    chunk_offsets = list(
+        itertools.product(
+            *[
+                range(0, size, chunk)
+                for size, chunk in zip(shape[1:], chunks[1:])
+            ]
+        )
+    )
+    for start in range(0, shape[0], chunks[0]):
+        with NC_LOCK:
+            slab = src_var[start:start + chunks[0]]
+        for offsets in chunk_offsets:
+            block = slab[(slice(0, chunks[0]), ) + tuple(
+                slice(offset, offset + chunk)
+                for offset, chunk in zip(offsets, chunks[1:])
+            )]
+            yield (start, ) + offsets, block
+
+
+def _call_now(func, *args):
+    """Call func in the calling thread.
+
+    :returns: Completed future of the result of the call.
+    :rtype: :py:class:`concurrent.futures.Future`
+    """
+    future = Future()
+    future.set_result(func(*args))
+    return future
+
+
+def _timed(func, *args):
+    cpu_start = thread_time()
+    result = func(*args)
+    return result, thread_time() - cpu_start
+
+
+def _untimed(func, *args):
+    return func(*args), 0
+
+
+def _encode_chunk(
+    block, chunks, dtype, shuffle, level, keep_bits=None, fill_value=None
+):
+    """Apply the HDF5 shuffle and deflate filters to a chunk of data,
+    after rounding it to keep_bits mantissa bits if keep_bits isn't
+    :py:obj:`None`.
+
+    Edge chunks are padded to the full chunk shape because HDF5 always
+    stores complete chunks.
+    """
+    block = numpy.ascontiguousarray(block, dtype=dtype)
+    if keep_bits is not None:
+        block = bit_round(block, keep_bits, fill_value)
+    if block.shape != tuple(chunks):
+        padded = numpy.zeros(chunks, dtype=dtype)
+        padded[tuple(slice(0, size) for size in block.shape)] = block
+        block = padded
+    if shuffle and dtype.itemsize > 1:
+        data = block.view(numpy.uint8).reshape(-1, dtype.itemsize).T.tobytes()
+    else:
+        data = block.tobytes()
+    return zlib.compress(data, level) if level else data
@@ -0,0 +1,318 @@
+# Copyright 2013-2017 The Salish Sea MEOPAR Contributors
+# and The University of British Columbia
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Packing of the small files of a run into one archive in its results
+directory.
+
+A run leaves many small files in its run directory:
+namelists,
+:file:`*_rev.txt` files,
+logs,
+and station time series.
+On parallel file systems like Lustre the metadata operations on each file
+dominate the time to gather them,
+and each file uses an inode of the quota.
+:command:`fvc gather --pack` stores the files that are smaller than a size
+threshold as members of a single zip archive,
+:py:data:`PACK_ARCHIVE`,
+whose central directory is an index of the members by path,
+so that a member can be read without unpacking the others;
+see :py:class:`PackedFiles`.
+
+Text files and netCDF-3 files are compressed with Lempel-Ziv,
+and files whose contents are compressed already,
+like netCDF-4 files,
+are stored as they are.
+"""
+from __future__ import division
+
+import fnmatch
+import logging
+import os
+try:
+    from pathlib import Path
+except ImportError:
+    # Python 2.7
+    from pathlib2 import Path
+import shutil
+import stat
+import time
+import zipfile
+import zlib
+
+import attr
+
+from fvcom_cmd import ncdeflate
+from fvcom_cmd.fspath import fspath
+
+logger = logging.getLogger(__name__)
+
+#: Name of the archive of the small files in a results directory.
+PACK_ARCHIVE = 'fvc_packed.zip'
+#: Default size in bytes below which files are packed.
+PACK_THRESHOLD = 1024**2
+#: Suffixes of the names of files whose contents are compressed already,
+#: which are stored in the archive without compressing them again.
+STORED_SUFFIXES = {'.bz2', '.gz', '.nc4', '.png', '.xz', '.zip'}
+#: Suffix of the names of netCDF files,
+#: which are stored if they are netCDF-4 (HDF5) files,
+#: and compressed if they are netCDF-3 files.
+NETCDF_SUFFIX = '.nc'
+#: Patterns of the names of files that are never packed because they are
+#: looked up by name,
+#: e.g. the deflated file records.
+UNPACKED_PATTERNS = ('.fvc_*', 'fvc_*')
+#: Size in bytes of the buffer used to read files to check their CRCs.
+CRC_BUFSIZE = 1024**2
+
+
+@attr.s
+class PackReport(object):
+    """Statistics of the files that were packed into an archive.
+
+    Returned by :func:`pack`.
+    """
+    #: Path of the archive.
+    archive = attr.ib()
+    #: Run directory relative paths of the files that were packed.
+    paths = attr.ib(default=attr.Factory(list))
+    #: Total size in bytes of the files that were packed.
+    nbytes = attr.ib(default=0)
+    #: Wall time in seconds of the packing.
+    wall_time = attr.ib(default=0)
+
+    def summary(self):
+        """Return a one line summary of the packing.
+
+        :rtype: str
+        """
+        return 'Packed {} files of {:.1f} MB into {} in {:.1f} s'.format(
+            len(self.paths), self.nbytes / 1e6, self.archive, self.wall_time
+        )
+
+
+class PackedFiles(object):
+    """Read-only access to the members of the :py:data:`PACK_ARCHIVE` in a
+    results directory.
+
+    Members are looked up in the central directory of the archive,
+    which is read once when it is opened,
+    so reading a member only reads that member's data.
+    Use it as a context manager::
+
+      with PackedFiles(results_dir) as packed:
+          namelist = packed.read_text('namelist')
+
+    :param results_dir: Path of the results directory.
+    :type results_dir: :py:class:`pathlib.Path`
+
+    :raises: :py:exc:`IOError` if the archive doesn't exist,
+             or :py:exc:`zipfile.BadZipfile` if it isn't a zip archive.
+    """
+
+    def __init__(self, results_dir):
+        self.archive = Path(results_dir) / PACK_ARCHIVE
+        self._zip = zipfile.ZipFile(fspath(self.archive))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __contains__(self, path):
+        return _member_name(path) in self._zip.NameToInfo
+
+    def close(self):
+        """Close the archive.
+        """
+        self._zip.close()
+
+    def paths(self):
+        """Return the run directory relative paths of the members.
+
+        :rtype: list
+        """
+        return [Path(name) for name in self._zip.namelist()]
+
+    def open(self, path):
+        """Return a binary file object from which to read a member.
+
+        :param path: Run directory relative path of the member.
+        :type path: :py:class:`pathlib.Path` or str
+
+        :raises: :py:exc:`KeyError` if there is no such member.
+        """
+        return self._zip.open(_member_name(path))
+
+    def read(self, path):
+        """Return the contents of a member.
+
+        :param path: Run directory relative path of the member.
+        :type path: :py:class:`pathlib.Path` or str
+
+        :rtype: bytes
+
+        :raises: :py:exc:`KeyError` if there is no such member.
+        """
+        return self._zip.read(_member_name(path))
+
+    def read_text(self, path, encoding='utf-8'):
+        """Return the contents of a text member.
+
+        :param path: Run directory relative path of the member.
+        :type path: :py:class:`pathlib.Path` or str
+
+        :param str encoding: Encoding of the member's text.
+
+        :rtype: str
+
+        :raises: :py:exc:`KeyError` if there is no such member.
+        """
+        return self.read(path).decode(encoding)
+
+
+def small_files(run_dir, threshold=PACK_THRESHOLD, exclude=()):
+    """Return the files in the run_dir tree that are smaller than threshold.
+
+    Symbolic links are not followed,
+    and they aren't included,
+    nor are files whose names match :py:data:`UNPACKED_PATTERNS`.
+    Each file is stat-ed once.
+
+    :param run_dir: Directory to search.
+    :type run_dir: :py:class:`pathlib.Path`
+
+    :param int threshold: Size in bytes below which files are included.
+
+    :param exclude: Paths of directories to skip,
+                    under run_dir.
+    :type exclude: set
+
+    :returns: run_dir relative paths of the files in sorted order.
+    :rtype: list
+    """
+    run_dir = Path(run_dir)
+    exclude = {fspath(path) for path in exclude}
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(fspath(run_dir)):
+        dirnames[:] = [
+            name for name in dirnames
+            if os.path.join(dirpath, name) not in exclude
+        ]
+        for name in filenames:
+            if any(fnmatch.fnmatch(name, pat) for pat in UNPACKED_PATTERNS):
+                continue
+            st = os.lstat(os.path.join(dirpath, name))
+            if stat.S_ISREG(st.st_mode) and st.st_size < threshold:
+                paths.append(Path(dirpath, name).relative_to(run_dir))
+    return sorted(paths)
+
+
+def pack(run_dir, paths, results_dir):
+    """Pack files in run_dir into the :py:data:`PACK_ARCHIVE` in results_dir,
+    then delete them.
+
+    The files are added to a copy of the archive,
+    or to a new archive,
+    that replaces the archive once it is flushed to disk,
+    so an interrupted packing leaves the files and the archive as they were.
+    Files that are already members of the archive with the same size and
+    CRC,
+    e.g. because a packing was interrupted before they were deleted,
+    are deleted without being packed again.
+    Files that are members with different contents are not packed.
+
+    :param run_dir: Directory of the files to pack.
+    :type run_dir: :py:class:`pathlib.Path`
+
+    :param list paths: run_dir relative paths of the files to pack.
+
+    :param results_dir: Directory of the archive.
+    :type results_dir: :py:class:`pathlib.Path`
+
+    :returns: Statistics of the files that were packed.
+    :rtype: :py:class:`PackReport`
+    """
+    t_start = time.time()
+    archive = results_dir / PACK_ARCHIVE
+    report = PackReport(archive)
+    members = {}
+    if archive.exists():
+        with zipfile.ZipFile(fspath(archive)) as zf:
+            members = {info.filename: info for info in zf.infolist()}
+    to_pack, packed = [], []
+    for path in paths:
+        src = run_dir / path
+        info = members.get(_member_name(path))
+        if info is None:
+            to_pack.append(path)
+        elif info.file_size == src.stat().st_size and info.CRC == _crc(src):
+            packed.append(path)
+        else:
+            logger.warning(
+                '{} differs from the file of the same name in {}, so it will '
+                'be gathered as it is'.format(path, archive)
+            )
+    if to_pack:
+        tmp_archive = results_dir / '{}.tmp'.format(PACK_ARCHIVE)
+        if archive.exists():
+            shutil.copyfile(fspath(archive), fspath(tmp_archive))
+        with zipfile.ZipFile(
+            fspath(tmp_archive), 'a' if archive.exists() else 'w'
+        ) as zf:
+            for path in to_pack:
+                zf.write(
+                    fspath(run_dir / path), _member_name(path),
+                    _compression(run_dir / path)
+                )
+        with tmp_archive.open('rb') as f:
+            os.fsync(f.fileno())
+        tmp_archive.rename(archive)
+    for path in to_pack + packed:
+        src = run_dir / path
+        report.nbytes += src.stat().st_size
+        src.unlink()
+        report.paths.append(path)
+    report.wall_time = time.time() - t_start
+    if report.paths:
+        logger.info(report.summary())
+    return report
+
+
+def _member_name(path):
+    """Return the archive member name of a run directory relative path.
+    """
+    return Path(path).as_posix()
+
+
+def _compression(filepath):
+    """Return the zip compression method for a file.
+    """
+    if filepath.suffix in STORED_SUFFIXES:
+        return zipfile.ZIP_STORED
+    if filepath.suffix == NETCDF_SUFFIX:
+        with filepath.open('rb') as f:
+            signature = f.read(len(ncdeflate.HDF5_SIGNATURE))
+            if signature == ncdeflate.HDF5_SIGNATURE:
+                return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def _crc(filepath):
+    crc = 0
+    with filepath.open('rb') as f:
+        for buf in iter(lambda: f.read(CRC_BUFSIZE), b''):
+            crc = zlib.crc32(buf, crc)
+    return crc & 0xffffffff
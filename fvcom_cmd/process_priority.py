@@ -0,0 +1,272 @@
+# Copyright 2013-2017 The Salish Sea MEOPAR Contributors
+# and The University of British Columbia
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""CPU and I/O scheduling priority of post-processing commands.
+
+Lets the deflate and gather sub-commands run beside a FVCOM run on the same
+nodes without slowing its time steps:
+a higher niceness and the idle I/O scheduling class give the model's MPI
+ranks precedence for CPU time and file system bandwidth,
+and CPU pinning confines post-processing to cores reserved for it.
+
+The settings are applied to the fvc process before it starts any threads
+or sub-processes,
+all of which inherit them.
+They can be given on the command-line,
+or in the :kbd:`post-processing` section of the run description YAML file
+from which :command:`fvc run` writes them into the deflate and gather
+commands of the run script:
+
+.. code-block:: yaml
+
+    post-processing:
+      nice: 10
+      ionice: idle
+      cpus: 36-39
+"""
+import argparse
+import logging
+import os
+import subprocess
+
+import attr
+
+logger = logging.getLogger(__name__)
+
+#: I/O scheduling classes of :program:`ionice`.
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+#: Run description key of the post-processing priority settings.
+RUN_DESC_KEY = 'post-processing'
+
+
+@attr.s
+class ProcessPriority(object):
+    """CPU and I/O scheduling priority settings of a process.
+
+    Settings that are :py:obj:`None` are left unchanged.
+    """
+    #: Niceness of the process; higher is lower CPU priority.
+    nice = attr.ib(default=None)
+    #: I/O scheduling class; one of :py:data:`IONICE_CLASSES`.
+    ionice = attr.ib(default=None)
+    #: Priority level within the realtime and best-effort I/O scheduling
+    #: classes, from 0 (highest) to 7.
+    ionice_level = attr.ib(default=None)
+    #: Numbers of the CPUs that the process is pinned to.
+    cpus = attr.ib(default=None)
+
+    @classmethod
+    def from_parsed_args(cls, parsed_args):
+        """Return the settings given by the command-line options added by
+        :func:`add_arguments`.
+        """
+        ionice, ionice_level = parsed_args.ionice or (None, None)
+        return cls(parsed_args.nice, ionice, ionice_level, parsed_args.cpus)
+
+    @classmethod
+    def from_run_desc(cls, run_desc):
+        """Return the settings in the :py:data:`RUN_DESC_KEY` section of
+        run_desc.
+
+        :param dict run_desc: Run description dictionary.
+
+        :raises: :py:exc:`ValueError` if a setting is invalid.
+        """
+        settings = run_desc.get(RUN_DESC_KEY) or {}
+        ionice, ionice_level = (
+            ionice_arg(settings['ionice']) if 'ionice' in settings else
+            (None, None)
+        )
+        cpus = settings.get('cpus')
+        return cls(
+            settings.get('nice'), ionice, ionice_level,
+            None if cpus is None else cpu_list_arg(cpus)
+        )
+
+    def apply(self):
+        """Apply the settings to the calling process.
+
+        Settings that the process isn't permitted to apply,
+        e.g. lowering its niceness,
+        or CPUs that aren't in its cgroup,
+        are logged as warnings and skipped.
+        """
+        if self.nice is not None:
+            self._apply_nice()
+        if self.ionice is not None:
+            self._apply_ionice()
+        if self.cpus is not None:
+            self._apply_cpus()
+
+    def cli_args(self):
+        """Return the command-line options that apply the settings.
+
+        :rtype: list
+        """
+        args = []
+        if self.nice is not None:
+            args.extend(['--nice', str(self.nice)])
+        if self.ionice is not None:
+            ionice = self.ionice
+            if self.ionice_level is not None:
+                ionice += ':{}'.format(self.ionice_level)
+            args.extend(['--ionice', ionice])
+        if self.cpus is not None:
+            cpus = ','.join(str(cpu) for cpu in sorted(self.cpus))
+            args.extend(['--cpus', cpus])
+        return args
+
+    def _apply_nice(self):
+        increment = self.nice - os.nice(0)
+        if not increment:
+            return
+        try:
+            os.nice(increment)
+        except OSError as exc:
+            logger.warning(
+                'unable to set niceness to {}: {}'.format(self.nice, exc)
+            )
+
+    def _apply_ionice(self):
+        cmd = ['ionice', '-c', str(IONICE_CLASSES[self.ionice])]
+        if self.ionice_level is not None and self.ionice != 'idle':
+            cmd.extend(['-n', str(self.ionice_level)])
+        cmd.extend(['-p', str(os.getpid())])
+        try:
+            subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError) as exc:
+            logger.warning(
+                'unable to set I/O scheduling class to {}: {}'.format(
+                    self.ionice, exc
+                )
+            )
+
+    def _apply_cpus(self):
+        try:
+            os.sched_setaffinity(0, self.cpus)
+        except AttributeError:
+            logger.warning('CPU pinning is not supported on this platform')
+        except OSError as exc:
+            logger.warning(
+                'unable to pin process to CPUs {}: {}'.format(
+                    ','.join(str(cpu) for cpu in sorted(self.cpus)), exc
+                )
+            )
+
+
+def add_arguments(parser):
+    """Add the --nice, --ionice, and --cpus options to parser.
+
+    :param parser: Sub-command command-line parser.
+    :type parser: :py:class:`argparse.ArgumentParser`
+    """
+    parser.add_argument(
+        '--nice',
+        type=int,
+        default=None,
+        metavar='NICENESS',
+        help=(
+            'Run with the given niceness, e.g. 10, so that a model running '
+            'on the same node has precedence for CPU time.'
+        )
+    )
+    parser.add_argument(
+        '--ionice',
+        type=_ionice_arg,
+        default=None,
+        metavar='CLASS[:LEVEL]',
+        help=(
+            'Run in the given I/O scheduling class: {}, '
+            'with an optional priority LEVEL from 0 to 7 for realtime and '
+            'best-effort; e.g. idle, or best-effort:7. '
+            'Requires the ionice command.'.format(
+                ', '.join(sorted(IONICE_CLASSES))
+            )
+        )
+    )
+    parser.add_argument(
+        '--cpus',
+        type=_cpu_list_arg,
+        default=None,
+        metavar='LIST',
+        help=(
+            'Pin the process and its sub-processes to the CPUs in LIST, '
+            'e.g. 36-39 or 0,2,4, reserving the other cores for the model.'
+        )
+    )
+
+
+def ionice_arg(arg):
+    """Parse a CLASS[:LEVEL] I/O scheduling class setting.
+
+    :param str arg: Setting.
+
+    :returns: I/O scheduling class, priority level or :py:obj:`None`.
+    :rtype: tuple
+
+    :raises: :py:exc:`ValueError` if the setting is invalid.
+    """
+    ionice, sep, level = str(arg).partition(':')
+    if ionice not in IONICE_CLASSES:
+        raise ValueError('unknown I/O scheduling class: {}'.format(ionice))
+    if not sep:
+        return ionice, None
+    level = int(level)
+    if not 0 <= level <= 7:
+        raise ValueError(
+            'I/O scheduling priority level must be from 0 to 7: {}'.format(
+                level
+            )
+        )
+    return ionice, level
+
+
+def cpu_list_arg(arg):
+    """Parse a list of CPU numbers and ranges,
+    e.g. :kbd:`0-3,8`,
+    or a sequence of CPU numbers.
+
+    :returns: CPU numbers.
+    :rtype: set
+
+    :raises: :py:exc:`ValueError` if the list is invalid.
+    """
+    if isinstance(arg, int):
+        return {arg}
+    if not isinstance(arg, str):
+        return {int(cpu) for cpu in arg}
+    cpus = set()
+    for item in arg.split(','):
+        first, sep, last = item.strip().partition('-')
+        cpus.update(range(int(first), int(last if sep else first) + 1))
+    if not cpus:
+        raise ValueError('empty CPU list: {}'.format(arg))
+    return cpus
+
+
+def _ionice_arg(arg):
+    try:
+        return ionice_arg(arg)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(str(exc))
+
+
+def _cpu_list_arg(arg):
+    try:
+        return cpu_list_arg(arg)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected a list of CPU numbers and ranges, e.g. 0-3,8: {}'.
+            format(arg)
+        )
@@ -27,12 +27,18 @@ try:
 except ImportError:
     # Python 2.7
     from pathlib2 import Path
+try:
+    from shlex import quote
+except ImportError:
+    # Python 2.7
+    from pipes import quote
 import subprocess
 
 import cliff.command
 
 from fvcom_cmd import api, lib
 from fvcom_cmd.fspath import fspath
+from fvcom_cmd.process_priority import ProcessPriority, RUN_DESC_KEY
 #from fvcom_cmd.prepare import get_run_desc_value
 
 logger = logging.getLogger(__name__)
@@ -266,20 +272,43 @@ def _build_batch_script(desc_file, results_dir, run_dir):
                 u'#$ -l {resource}\n'.format(resource=resource)
             )
 
+    # Post-processing CPU and I/O priority
+    try:
+        process_priority = ProcessPriority.from_run_desc(run_desc)
+    except ValueError as exc:
+        logger.error(
+            'invalid "{}" setting in run description YAML file: {}'.format(
+                RUN_DESC_KEY, exc
+            )
+        )
+        raise SystemExit(2)
+    priority_args = u''.join(
+        u' {}'.format(arg) for arg in process_priority.cli_args()
+    )
+    # Gathering of the finished output files while FVCOM runs
+    post_processing = run_desc.get(RUN_DESC_KEY) or {}
+    watch_dir = post_processing.get('gather during run')
+    gather_args = u''
+    if post_processing.get('gather bandwidth') is not None:
+        gather_args = u' --bwlimit {}'.format(
+            post_processing['gather bandwidth']
+        )
+
     script += (
         u'\n'
         u'RUN_ID="{run_id}"\n'
         u'RUN_DESC="{run_desc_file}"\n'
         u'WORK_DIR="{run_dir}"\n'
         u'RESULTS_DIR="{results_dir}"\n'
-        u'DEFLATE="{fvcom_cmd} deflate"\n'
-        u'GATHER="{fvcom_cmd} gather"\n\n'
+        u'DEFLATE="{fvcom_cmd} deflate{priority_args}"\n'
+        u'GATHER="{fvcom_cmd} gather{priority_args}"\n\n'
     ).format(
     run_id=run_desc['run_id'],
     run_desc_file=desc_file,
     run_dir=run_dir,
     results_dir=results_dir,
-    fvcom_cmd=Path('${HOME}/.local/bin/fvc')
+    fvcom_cmd=Path('${HOME}/.local/bin/fvc'),
+    priority_args=priority_args
     )
 
 
@@ -301,6 +330,14 @@ def _build_batch_script(desc_file, results_dir, run_dir):
         u'mkdir -p ${RESULTS_DIR}\n'
         u'\n'
     )
+    if watch_dir is not None:
+        script += (
+            u'mkdir -p {watch_dir}\n'
+            u'${{GATHER}} ${{RESULTS_DIR}} --watch {watch_dir}{gather_args} '
+            u'--debug &\n'
+            u'GATHER_PID=$!\n'
+            u'\n'
+        ).format(watch_dir=quote(watch_dir), gather_args=gather_args)
 
     # mpirun
     script += (
@@ -311,10 +348,17 @@ def _build_batch_script(desc_file, results_dir, run_dir):
         u'MPIRUN_EXIT_CODE=$?\n'
         u'echo "Ended run at $(date)"\n'
         u'\n'
+    )
+    if watch_dir is not None:
+        script += (
+            u'kill -TERM ${GATHER_PID}\n'
+            u'wait ${GATHER_PID}\n'
+        )
+    script += (
         u'echo "Results gathering started at $(date)"\n'
-        u'${GATHER} ${RESULTS_DIR} --debug\n'
+        u'${{GATHER}} ${{RESULTS_DIR}}{gather_args} --debug\n'
         u'echo "Results gathering ended at $(date)"\n'
-    )
+    ).format(gather_args=gather_args)
 
     # Fix permissions
     script += (
@@ -0,0 +1,452 @@
+# Copyright 2013-2017 The Salish Sea MEOPAR Contributors
+# and The University of British Columbia
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""FVCOM-Cmd command plug-in for verify sub-command.
+
+Check the files in a results directory against the checksum manifest
+written by :command:`fvc gather --manifest`.
+
+The manifest lists the path, size, modification time, and checksum of each
+file in the results directory.
+Checksums are computed with xxHash (XXH3 128-bit) if the :kbd:`xxhash`
+package is installed,
+and with BLAKE2b from :py:mod:`hashlib` otherwise;
+the algorithm is recorded in the manifest.
+Files are read on a pool of threads because both hash implementations
+release the GIL while they hash large buffers.
+"""
+from __future__ import division
+
+from concurrent.futures import ThreadPoolExecutor
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+try:
+    from pathlib import Path
+except ImportError:
+    # Python 2.7
+    from pathlib2 import Path
+import time
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+import attr
+import cliff.command
+
+from fvcom_cmd.fspath import fspath
+
+logger = logging.getLogger(__name__)
+
+#: Name of the checksum manifest file in a results directory.
+MANIFEST = 'fvc_manifest.json'
+#: Patterns of the names of bookkeeping files that later deflate and
+#: gather runs update,
+#: e.g. the deflated file records,
+#: which are left out of the manifest.
+UNLISTED_PATTERNS = ('.fvc_*', )
+#: Default number of threads that read files to check their checksums.
+VERIFY_THREADS = 4
+#: Size in bytes of the buffer used to read files to hash them.
+HASH_BUFSIZE = 16 * 1024**2
+
+
+class Verify(cliff.command.Command):
+    """Verify gathered results files against their checksum manifest.
+    """
+
+    def get_parser(self, prog_name):
+        parser = super(Verify, self).get_parser(prog_name)
+        parser.description = '''
+            Check the size and checksum of each of the files listed in the
+            {} checksum manifest in RESULTS_DIR,
+            which is written by fvc gather --manifest.
+            Exits with status 1 if any file is missing or has changed.
+        '''.format(MANIFEST)
+        parser.add_argument(
+            'results_dir',
+            type=Path,
+            metavar='RESULTS_DIR',
+            help='directory of gathered results to verify'
+        )
+        parser.add_argument(
+            '-j',
+            '--jobs',
+            type=int,
+            default=VERIFY_THREADS,
+            help=(
+                'Maximum number of files to read concurrently. '
+                'Defaults to {}.'.format(VERIFY_THREADS)
+            )
+        )
+        return parser
+
+    def take_action(self, parsed_args):
+        """Execute the `fvc verify` sub-command.
+
+        Check the files in a results directory against its checksum
+        manifest.
+
+        Exits with status 1 if any of the files is missing or has changed,
+        and with status 2 if the manifest can't be read.
+        """
+        try:
+            report = verify(parsed_args.results_dir, parsed_args.jobs)
+        except (IOError, OSError, ValueError) as exc:
+            logger.error(
+                'unable to read checksum manifest in {}: {}'.format(
+                    parsed_args.results_dir, exc
+                )
+            )
+            raise SystemExit(2)
+        if report.failed:
+            raise SystemExit(1)
+
+
+@attr.s
+class ManifestEntry(object):
+    """Identity of a file in a results directory.
+    """
+    #: Path/name of the file relative to the results directory.
+    path = attr.ib()
+    #: Size of the file in bytes.
+    size = attr.ib()
+    #: Modification time of the file in nanoseconds since the epoch.
+    mtime_ns = attr.ib()
+    #: Hex digest of the contents of the file.
+    checksum = attr.ib()
+
+
+@attr.s
+class Manifest(object):
+    """Checksum manifest of the files in a results directory.
+    """
+    #: Name of the hash algorithm of the checksums;
+    #: see :func:`checksum_algorithm`.
+    algorithm = attr.ib()
+    #: :py:class:`ManifestEntry` of each file.
+    entries = attr.ib(default=attr.Factory(list))
+
+    @classmethod
+    def read(cls, results_dir):
+        """Read the :py:data:`MANIFEST` file in results_dir.
+
+        :param results_dir: Results directory.
+        :type results_dir: :py:class:`pathlib.Path`
+
+        :raises: :py:exc:`IOError` if the manifest doesn't exist,
+                 or :py:exc:`ValueError` if it is not a valid manifest.
+        """
+        with (results_dir / MANIFEST).open('rt') as f:
+            manifest = json.load(f)
+        try:
+            return cls(
+                manifest['algorithm'], [
+                    ManifestEntry(**entry) for entry in manifest['files']
+                ]
+            )
+        except (KeyError, TypeError) as exc:
+            raise ValueError('invalid manifest: {}'.format(exc))
+
+    def write(self, results_dir):
+        """Write the manifest to the :py:data:`MANIFEST` file in
+        results_dir,
+        replacing it atomically if it exists.
+
+        :param results_dir: Results directory.
+        :type results_dir: :py:class:`pathlib.Path`
+        """
+        manifest = {
+            'algorithm': self.algorithm,
+            'files': [
+                attr.asdict(entry)
+                for entry in sorted(self.entries, key=lambda e: e.path)
+            ],
+        }
+        tmp_manifest = results_dir / '{}.tmp'.format(MANIFEST)
+        with tmp_manifest.open('wb') as f:
+            f.write(
+                json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8')
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        tmp_manifest.rename(results_dir / MANIFEST)
+
+
+@attr.s
+class VerifyReport(object):
+    """Results of checking a results directory against its manifest.
+
+    Returned by :func:`verify`.
+    """
+    #: Number of files listed in the manifest.
+    n_files = attr.ib(default=0)
+    #: Total size in bytes of the files that were read.
+    nbytes = attr.ib(default=0)
+    #: Descriptions of the problems found, by file path.
+    problems = attr.ib(default=attr.Factory(dict))
+    #: Paths of the files in the results directory that aren't listed in
+    #: the manifest.
+    unlisted = attr.ib(default=attr.Factory(list))
+    #: Wall time in seconds of the verification.
+    wall_time = attr.ib(default=0)
+
+    @property
+    def failed(self):
+        """Paths of the files that are missing or have changed.
+        """
+        return sorted(self.problems)
+
+    def summary(self):
+        """Return a 1 line summary of the verification.
+
+        :rtype: str
+        """
+        return (
+            'Verified {n_ok} of {n} files: {mb:.1f} MB in {wall:.1f} s = '
+            '{rate:.1f} MB/s; {n_failed} missing or changed, '
+            '{n_unlisted} not in manifest'.format(
+                n_ok=self.n_files - len(self.problems),
+                n=self.n_files,
+                mb=self.nbytes / 1e6,
+                wall=self.wall_time,
+                rate=(
+                    self.nbytes / self.wall_time / 1e6
+                    if self.wall_time else 0
+                ),
+                n_failed=len(self.problems),
+                n_unlisted=len(self.unlisted)
+            )
+        )
+
+
+def checksum_algorithm():
+    """Return the name of the fastest available hash algorithm:
+    :kbd:`xxh3_128` if the :kbd:`xxhash` package is installed,
+    otherwise :kbd:`blake2b`,
+    or :kbd:`sha256` on Python 2.7.
+
+    :rtype: str
+    """
+    if xxhash is not None and hasattr(xxhash, 'xxh3_128'):
+        return 'xxh3_128'
+    if hasattr(hashlib, 'blake2b'):
+        return 'blake2b'
+    # Python 2.7
+    return 'sha256'
+
+
+def new_hash(algorithm):
+    """Return a new hash object for algorithm.
+
+    :param str algorithm: Name of a hash algorithm returned by
+                          :func:`checksum_algorithm`.
+
+    :raises: :py:exc:`ValueError` if the algorithm is not available.
+    """
+    if algorithm.startswith('xxh'):
+        if xxhash is None:
+            raise ValueError(
+                '{} checksums require the xxhash package'.format(algorithm)
+            )
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+def file_checksum(filepath, algorithm):
+    """Return the hex digest of the contents of filepath.
+
+    :param filepath: File to hash.
+    :type filepath: :py:class:`pathlib.Path`
+
+    :param str algorithm: Name of the hash algorithm to use.
+
+    :rtype: str
+    """
+    hasher = new_hash(algorithm)
+    with filepath.open('rb') as f:
+        for buf in iter(lambda: f.read(HASH_BUFSIZE), b''):
+            hasher.update(buf)
+    return hasher.hexdigest()
+
+
+def write_manifest(
+    results_dir,
+    algorithm,
+    checksums=None,
+    max_threads=VERIFY_THREADS,
+    exclude=()
+):
+    """Write a :py:data:`MANIFEST` of the files in results_dir.
+
+    :param results_dir: Results directory.
+    :type results_dir: :py:class:`pathlib.Path`
+
+    :param str algorithm: Name of the hash algorithm to use.
+
+    :param dict checksums: Checksums that have already been computed,
+                           e.g. while the files were copied,
+                           by path relative to results_dir;
+                           the checksums of files whose size and
+                           modification time match an existing manifest
+                           are taken from it,
+                           and the other files are read to compute theirs.
+
+    :param int max_threads: Maximum number of files to read concurrently.
+
+    :param exclude: Names of files at the top of results_dir to leave out
+                    of the manifest,
+                    e.g. the journal of a gather that is finishing.
+    :type exclude: set
+
+    :returns: The manifest.
+    :rtype: :py:class:`Manifest`
+    """
+    checksums = checksums or {}
+    try:
+        previous = Manifest.read(results_dir)
+    except (IOError, OSError, ValueError):
+        previous = Manifest(algorithm)
+    previous_entries = (
+        {entry.path: entry
+         for entry in previous.entries}
+        if previous.algorithm == algorithm else {}
+    )
+    filepaths = [
+        filepath for filepath in _results_files(results_dir)
+        if filepath.parent != results_dir or filepath.name not in exclude
+    ]
+
+    def entry(filepath):
+        path = filepath.relative_to(results_dir)
+        stat = filepath.stat()
+        new_entry = ManifestEntry(
+            fspath(path), stat.st_size, mtime_ns(stat), checksums.get(path)
+        )
+        previous_entry = previous_entries.get(new_entry.path)
+        if new_entry.checksum is None and previous_entry is not None:
+            if (previous_entry.size, previous_entry.mtime_ns) == (
+                new_entry.size, new_entry.mtime_ns
+            ):
+                new_entry.checksum = previous_entry.checksum
+        if new_entry.checksum is None:
+            new_entry.checksum = file_checksum(filepath, algorithm)
+        return new_entry
+
+    with ThreadPoolExecutor(max_threads) as executor:
+        manifest = Manifest(algorithm, list(executor.map(entry, filepaths)))
+    manifest.write(results_dir)
+    logger.info(
+        'Wrote {} checksum manifest of {} files to {}'.format(
+            algorithm, len(manifest.entries), results_dir / MANIFEST
+        )
+    )
+    return manifest
+
+
+def verify(results_dir, max_threads=VERIFY_THREADS):
+    """Check the files in results_dir against its :py:data:`MANIFEST`.
+
+    Files that are missing,
+    or whose size or checksum differs from the manifest,
+    are logged as errors.
+    Files that aren't listed in the manifest are logged as warnings.
+    A changed modification time alone is not a problem.
+
+    :param results_dir: Results directory.
+    :type results_dir: :py:class:`pathlib.Path`
+
+    :param int max_threads: Maximum number of files to read concurrently.
+
+    :returns: Problems found.
+    :rtype: :py:class:`VerifyReport`
+
+    :raises: :py:exc:`IOError` if the manifest can't be read,
+             or :py:exc:`ValueError` if it is not a valid manifest,
+             or its algorithm is not available.
+    """
+    t_start = time.time()
+    manifest = Manifest.read(results_dir)
+    new_hash(manifest.algorithm)
+    logger.info(
+        'Verifying {} files in {} against their {} checksums...'.format(
+            len(manifest.entries), results_dir, manifest.algorithm
+        )
+    )
+
+    def check(entry):
+        filepath = results_dir / entry.path
+        try:
+            size = filepath.stat().st_size
+        except OSError:
+            return 0, 'missing'
+        if size != entry.size:
+            return 0, 'size {} does not match {}'.format(size, entry.size)
+        if file_checksum(filepath, manifest.algorithm) != entry.checksum:
+            return size, 'checksum does not match'
+        return size, None
+
+    report = VerifyReport(n_files=len(manifest.entries))
+    with ThreadPoolExecutor(max_threads) as executor:
+        results = executor.map(check, manifest.entries)
+        for entry, (nbytes, problem) in zip(manifest.entries, results):
+            report.nbytes += nbytes
+            if problem is not None:
+                report.problems[entry.path] = problem
+                logger.error('{}: {}'.format(entry.path, problem))
+    listed = {entry.path for entry in manifest.entries}
+    for filepath in _results_files(results_dir):
+        path = fspath(filepath.relative_to(results_dir))
+        if path not in listed:
+            report.unlisted.append(path)
+            logger.warning('{}: not in manifest'.format(path))
+    report.wall_time = time.time() - t_start
+    logger.info(report.summary())
+    return report
+
+
+def _results_files(results_dir):
+    """Return the paths of the regular files in the results_dir tree,
+    other than the manifest and the files whose names match
+    :py:data:`UNLISTED_PATTERNS`.
+    """
+    filepaths = []
+    for dirpath, dirnames, filenames in os.walk(fspath(results_dir)):
+        for name in filenames:
+            filepath = Path(dirpath) / name
+            if filepath.is_symlink():
+                continue
+            if any(fnmatch.fnmatch(name, pat) for pat in UNLISTED_PATTERNS):
+                continue
+            if Path(dirpath) == results_dir and name.startswith(MANIFEST):
+                continue
+            filepaths.append(filepath)
+    return sorted(filepaths)
+
+
+def mtime_ns(stat):
+    """Return the modification time in nanoseconds since the epoch from a
+    :py:func:`os.stat` result.
+
+    :rtype: int
+    """
+    try:
+        return stat.st_mtime_ns
+    except AttributeError:
+        # Python 2.7
+        return int(stat.st_mtime * 1e9)
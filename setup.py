@@ -71,10 +71,12 @@ setup(
         # Sub-command plug-ins:
         'fvcom.app': [
             'combine = fvcom_cmd.combine:Combine',
+            'dedup = fvcom_cmd.dedup:Dedup',
             'deflate = fvcom_cmd.deflate:Deflate',
             'gather = fvcom_cmd.gather:Gather',
             'prepare = fvcom_cmd.prepare:Prepare',
             'run = fvcom_cmd.run:Run',
+            'verify = fvcom_cmd.verify:Verify',
         ],
     },
 )
@@ -0,0 +1,168 @@
+# Copyright 2013-2017 The Salish Sea MEOPAR Contributors
+# and The University of British Columbia
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""FVCOM-Cmd dedup sub-command plug-in unit tests
+"""
+import errno
+import hashlib
+import os
+import shutil
+try:
+    from pathlib import Path
+except ImportError:
+    # Python 2.7
+    from pathlib2 import Path
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    # Python 2.7
+    from mock import Mock, patch
+
+import cliff.app
+import pytest
+
+import fvcom_cmd.dedup
+
+
+@pytest.fixture
+def dedup_cmd():
+    return fvcom_cmd.dedup.Dedup(Mock(spec=cliff.app.App), [])
+
+
+@pytest.fixture
+def results_root(tmp_path):
+    for run in ('run1', 'run2'):
+        results_dir = tmp_path / run
+        (results_dir / 'output').mkdir(parents=True)
+        (results_dir / 'output' / 'grid.nc').write_bytes(b'g' * 1000)
+        (results_dir / 'namelist').write_bytes(b'&NML_CASE /')
+        (results_dir / '.fvc_deflated').write_bytes(b'{}\n')
+        (results_dir / 'fvc_packed.zip').write_bytes(b'PK' * 100)
+        (results_dir / 'empty.txt').write_bytes(b'')
+    (tmp_path / 'run1' / 'output' / 'results_0001.nc').write_bytes(b'1' * 10)
+    (tmp_path / 'run2' / 'output' / 'results_0001.nc').write_bytes(b'2' * 10)
+    return tmp_path
+
+
+def _dedup(results_dir, checksums=None):
+    return fvcom_cmd.dedup.dedup(
+        results_dir,
+        fvcom_cmd.dedup.store_dir(results_dir.parent),
+        'sha256',
+        checksums,
+        exclude={'namelist'}
+    )
+
+
+class TestParser:
+    """Unit tests for `fvc dedup` sub-command command-line parser.
+    """
+
+    def test_parsed_args_defaults(self, dedup_cmd):
+        parser = dedup_cmd.get_parser('fvc dedup')
+        parsed_args = parser.parse_args(['results/'])
+        assert parsed_args.results_root == Path('results/')
+        assert parsed_args.results_dirs == []
+        assert not parsed_args.gc
+        assert parsed_args.jobs == fvcom_cmd.dedup.DEDUP_THREADS
+
+
+class TestDedup:
+    """Unit tests for dedup() function.
+    """
+
+    def test_first_run_stored(self, results_root):
+        report = _dedup(results_root / 'run1')
+        assert (report.n_files, report.n_added, report.n_linked) == (2, 2, 0)
+        grid = results_root / 'run1' / 'output' / 'grid.nc'
+        obj = fvcom_cmd.dedup.object_path(
+            results_root / '.fvc_store', 'sha256',
+            hashlib.sha256(b'g' * 1000).hexdigest()
+        )
+        assert os.path.samefile(str(grid), str(obj))
+        assert grid.stat().st_mode & 0o222 == 0
+
+    def test_identical_files_linked(self, results_root):
+        _dedup(results_root / 'run1')
+        report = _dedup(results_root / 'run2')
+        assert (report.n_files, report.n_added, report.n_linked) == (2, 1, 1)
+        assert report.saved_bytes == 1000
+        assert os.path.samefile(
+            str(results_root / 'run1' / 'output' / 'grid.nc'),
+            str(results_root / 'run2' / 'output' / 'grid.nc')
+        )
+        assert (results_root / 'run2' / 'output' / 'results_0001.nc'
+                ).read_bytes() == b'2' * 10
+
+    def test_skipped_files(self, results_root):
+        _dedup(results_root / 'run1')
+        _dedup(results_root / 'run2')
+        for name in (
+            'namelist', '.fvc_deflated', 'fvc_packed.zip', 'empty.txt'
+        ):
+            assert (results_root / 'run2' / name).stat().st_nlink == 1
+
+    def test_dedup_again(self, results_root):
+        _dedup(results_root / 'run1')
+        report = _dedup(results_root / 'run1')
+        assert (report.n_added, report.n_linked) == (0, 0)
+
+    def test_checksums_used_and_added(self, results_root):
+        digest = hashlib.sha256(b'g' * 1000).hexdigest()
+        checksums = {Path('output/grid.nc'): digest}
+        with patch.object(
+            fvcom_cmd.dedup.verify_plugin, 'file_checksum',
+            Mock(return_value='ab' * 32)
+        ) as m_checksum:
+            _dedup(results_root / 'run1', checksums)
+        m_checksum.assert_called_once_with(
+            results_root / 'run1' / 'output' / 'results_0001.nc', 'sha256'
+        )
+        assert checksums[Path('output/results_0001.nc')] == 'ab' * 32
+
+    def test_different_file_system(self, results_root, monkeypatch):
+        monkeypatch.setattr(
+            fvcom_cmd.dedup.os, 'link',
+            Mock(side_effect=OSError(errno.EXDEV, 'cross-device link'))
+        )
+        report = _dedup(results_root / 'run1')
+        assert (report.n_added, report.n_linked) == (0, 0)
+
+
+class TestStore:
+    """Unit tests for store_report() and collect_garbage() functions.
+    """
+
+    def test_store_report(self, results_root):
+        _dedup(results_root / 'run1')
+        _dedup(results_root / 'run2')
+        report = fvcom_cmd.dedup.store_report(results_root / '.fvc_store')
+        assert report.n_objects == 3
+        assert report.n_references == 4
+        assert report.stored_bytes == 1020
+        assert report.referenced_bytes == 2020
+        assert report.saved_bytes == 1000
+        assert report.n_unreferenced == 0
+
+    def test_collect_garbage(self, results_root):
+        _dedup(results_root / 'run1')
+        _dedup(results_root / 'run2')
+        shutil.rmtree(str(results_root / 'run1'))
+        store = results_root / '.fvc_store'
+        report = fvcom_cmd.dedup.collect_garbage(store)
+        assert (report.n_objects, report.nbytes) == (1, 10)
+        store_report = fvcom_cmd.dedup.store_report(store)
+        assert (store_report.n_objects, store_report.n_references) == (2, 2)
+        assert store_report.saved_bytes == 0
+        assert sum(1 for _ in (store / 'sha256').iterdir()) == 2
@@ -14,6 +14,14 @@
 # limitations under the License.
 """SalishSeaCmd deflate sub-command plug-in unit tests
 """
+import errno
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
 try:
     from pathlib import Path
 except ImportError:
@@ -37,6 +45,9 @@ except ImportError:
 import cliff.app
 import pytest
 
+import fvcom_cmd.deflate
+import fvcom_cmd.verify
+from fvcom_cmd.fspath import fspath
 import nemo_cmd.deflate
 
 
@@ -45,6 +56,11 @@ def deflate_cmd():
     return nemo_cmd.deflate.Deflate(Mock(spec=cliff.app.App), [])
 
 
+@pytest.fixture
+def fvc_deflate_cmd():
+    return fvcom_cmd.deflate.Deflate(Mock(spec=cliff.app.App), [])
+
+
 class TestParser:
     """Unit tests for `nemo deflate` sub-command command-line parser.
     """
@@ -71,3 +87,1034 @@ class TestTakeAction:
         )
         deflate_cmd.take_action(parsed_args)
         m_deflate.assert_called_once_with([Path('foo.nc'), Path('bar.nc')], 6)
+
+
+class TestFVCOMParser:
+    """Unit tests for `fvc deflate` sub-command command-line parser.
+    """
+
+    def test_parsed_args_defaults(self, fvc_deflate_cmd):
+        parser = fvc_deflate_cmd.get_parser('fvc deflate')
+        parsed_args = parser.parse_args(['foo.nc', '-j6'])
+        assert parsed_args.backend == 'nccopy'
+        assert not parsed_args.split_large
+
+    def test_split_large(self, fvc_deflate_cmd):
+        parser = fvc_deflate_cmd.get_parser('fvc deflate')
+        parsed_args = parser.parse_args(['foo.nc', '--split-large'])
+        assert parsed_args.split_large
+
+    def test_backend(self, fvc_deflate_cmd):
+        parser = fvc_deflate_cmd.get_parser('fvc deflate')
+        parsed_args = parser.parse_args(['foo.nc', '--backend', 'netcdf4'])
+        assert parsed_args.backend == 'netcdf4'
+
+    def test_priorities(self, fvc_deflate_cmd):
+        parser = fvc_deflate_cmd.get_parser('fvc deflate')
+        parsed_args = parser.parse_args([
+            'foo.nc', '--priority', '*restart*.nc=2', '--priority', 'a=b=-1'
+        ])
+        assert parsed_args.priorities == [('*restart*.nc', 2), ('a=b', -1)]
+
+    def test_tune(self, fvc_deflate_cmd):
+        parser = fvc_deflate_cmd.get_parser('fvc deflate')
+        parsed_args = parser.parse_args(
+            ['foo.nc', '--tune', '--profile-dir', '/profiles']
+        )
+        assert parsed_args.tune
+        assert parsed_args.profile_dir == Path('/profiles')
+
+    def test_bad_priority(self, fvc_deflate_cmd):
+        parser = fvc_deflate_cmd.get_parser('fvc deflate')
+        with pytest.raises(SystemExit):
+            parser.parse_args(['foo.nc', '--priority', '*restart*.nc'])
+
+    def test_codec_defaults(self, fvc_deflate_cmd):
+        parser = fvc_deflate_cmd.get_parser('fvc deflate')
+        parsed_args = parser.parse_args(['foo.nc'])
+        assert parsed_args.codec == 'zlib'
+        assert parsed_args.dfl_lvl == 4
+        assert parsed_args.shuffle
+
+    def test_keep_bits_and_digits(self, fvc_deflate_cmd):
+        parser = fvc_deflate_cmd.get_parser('fvc deflate')
+        parsed_args = parser.parse_args([
+            'foo.nc', '--keep-bits', 'temp=8', '--keep-digits', 'salinity=3'
+        ])
+        assert parsed_args.keep_bits == [('temp', 8)]
+        assert parsed_args.keep_digits == [('salinity', 3)]
+
+    def test_bad_keep_bits(self, fvc_deflate_cmd):
+        parser = fvc_deflate_cmd.get_parser('fvc deflate')
+        with pytest.raises(SystemExit):
+            parser.parse_args(['foo.nc', '--keep-bits', 'temp=0'])
+
+    def test_watch(self, fvc_deflate_cmd):
+        parser = fvc_deflate_cmd.get_parser('fvc deflate')
+        parsed_args = parser.parse_args(['--watch', 'output', '--settle', '5'])
+        assert parsed_args.filepaths == []
+        assert parsed_args.watch_dir == Path('output')
+        assert parsed_args.settle_time == 5
+
+    def test_codec(self, fvc_deflate_cmd):
+        parser = fvc_deflate_cmd.get_parser('fvc deflate')
+        parsed_args = parser.parse_args(
+            ['foo.nc', '--codec', 'zstd', '-d', '9', '--no-shuffle']
+        )
+        assert parsed_args.codec == 'zstd'
+        assert parsed_args.dfl_lvl == 9
+        assert not parsed_args.shuffle
+
+
+class TestQuantizeSettings:
+    """Unit tests for fvcom_cmd.deflate.quantize_settings() function.
+    """
+
+    def test_quantize_settings(self):
+        quantize = fvcom_cmd.deflate.quantize_settings(
+            [('temp', 8), ('salinity', 12)], [('temp', 3), ('zeta', 2)]
+        )
+        assert quantize == {'temp': 10, 'salinity': 12, 'zeta': 7}
+
+
+class TestDeflateJob:
+    """Unit tests for fvcom_cmd.deflate.DeflateJob class.
+    """
+
+    def test_finish_replaces_original(self, tmp_path):
+        filepath = tmp_path / 'foo.nc'
+        filepath.write_text(u'original')
+        Path('{}.nccopy.tmp'.format(filepath)).write_text(u'deflated')
+        job = fvcom_cmd.deflate.DeflateJob(filepath, returncode=0)
+        job.finish()
+        assert filepath.read_text() == u'deflated'
+        assert not Path('{}.nccopy.tmp'.format(filepath)).exists()
+
+    def test_finish_stores_at_destination(self, tmp_path):
+        filepath = tmp_path / 'run' / 'foo.nc'
+        filepath.parent.mkdir()
+        filepath.write_text(u'original')
+        dest_filepath = tmp_path / 'results' / 'foo.nc'
+        dest_filepath.parent.mkdir()
+        job = fvcom_cmd.deflate.DeflateJob(
+            filepath, returncode=0, dest_filepath=dest_filepath
+        )
+        assert job.replacement_filepath == Path(
+            '{}.nccopy.tmp'.format(dest_filepath)
+        )
+        job.replacement_filepath.write_text(u'deflated')
+        job.finish()
+        assert dest_filepath.read_text() == u'deflated'
+        assert not filepath.exists()
+        assert not job.replacement_filepath.exists()
+
+    def test_failed_job_leaves_original(self, tmp_path):
+        filepath = tmp_path / 'foo.nc'
+        filepath.write_text(u'original')
+        job = fvcom_cmd.deflate.DeflateJob(filepath, returncode=1)
+        job.finish()
+        assert filepath.read_text() == u'original'
+
+    def test_kill(self):
+        job = fvcom_cmd.deflate.DeflateJob(
+            Path('foo.nc'), process=Mock(name='process')
+        )
+        job.kill(300)
+        assert job.timed_out
+        job.process.kill.assert_called_once_with()
+
+    @patch('fvcom_cmd.deflate.logger')
+    def test_kill_running_job(self, m_logger, tmp_path):
+        job = fvcom_cmd.deflate.DeflateJob(tmp_path / 'foo.nc')
+        finished_jobs = fvcom_cmd.deflate.queue.Queue()
+        with patch.object(
+            job, 'nccopy_cmd', return_value=['sleep', '60']
+        ):
+            job.start(finished_jobs)
+        job.kill(0)
+        assert finished_jobs.get(timeout=10) is job
+        assert job.returncode != 0
+        assert job.timed_out
+
+    @patch(
+        'fvcom_cmd.deflate.os.wait4',
+        side_effect=OSError(errno.ECHILD, 'No child processes')
+    )
+    def test_wait_process_already_reaped(self, m_wait4):
+        job = fvcom_cmd.deflate.DeflateJob(
+            Path('foo.nc'), process=Mock(name='process'), pid=42
+        )
+        job.process.wait.return_value = -9
+        assert job._wait() == -9
+
+    @patch(
+        'fvcom_cmd.deflate.ncdeflate.verify_sample',
+        return_value=['dimension node differs']
+    )
+    def test_verify_mismatch_fails_job(self, m_verify_sample):
+        job = fvcom_cmd.deflate.DeflateJob(
+            Path('foo.nc'), returncode=0, verify_samples=2
+        )
+        job._verify()
+        m_verify_sample.assert_called_once_with(
+            Path('foo.nc'), Path('foo.nc.nccopy.tmp'), 2
+        )
+        assert job.returncode == 1
+        assert job.mismatches == ['dimension node differs']
+        assert job.verify_time is not None
+
+    @patch('fvcom_cmd.deflate.ncdeflate.verify_sample')
+    def test_no_verification_by_default(self, m_verify_sample):
+        job = fvcom_cmd.deflate.DeflateJob(Path('foo.nc'), returncode=0)
+        job._verify()
+        assert not m_verify_sample.called
+        assert job.verify_time is None
+
+    def test_reset(self):
+        job = fvcom_cmd.deflate.DeflateJob(
+            Path('foo.nc'), returncode=-9, attempts=1, timed_out=True
+        )
+        job.reset(not_before=42)
+        assert job.returncode is None
+        assert not job.timed_out
+        assert job.attempts == 1
+        assert job.not_before == 42
+
+    def test_tmp_filepath_in_place(self):
+        job = fvcom_cmd.deflate.DeflateJob(Path('results/foo.nc'))
+        assert job.tmp_filepath == Path('results/foo.nc.nccopy.tmp')
+        assert job.written_filepaths == [job.tmp_filepath]
+
+    def test_tmp_filepath_staged(self, tmp_path):
+        job = fvcom_cmd.deflate.DeflateJob(
+            Path('results/foo.nc'), scratch_dir=tmp_path
+        )
+        assert job.tmp_filepath.parent == tmp_path
+        assert job.tmp_filepath.name.endswith('-foo.nc.nccopy.tmp')
+        assert job.written_filepaths == [
+            job.tmp_filepath, Path('results/foo.nc.nccopy.tmp')
+        ]
+
+    def test_stage_out(self, tmp_path):
+        scratch_dir = tmp_path / 'scratch'
+        scratch_dir.mkdir()
+        filepath = tmp_path / 'foo.nc'
+        filepath.write_bytes(b'original')
+        job = fvcom_cmd.deflate.DeflateJob(
+            filepath, scratch_dir=scratch_dir, returncode=0
+        )
+        job.tmp_filepath.write_bytes(b'deflated')
+        job._stage_out()
+        job.finish()
+        assert filepath.read_bytes() == b'deflated'
+        assert list(scratch_dir.iterdir()) == []
+
+    def test_wait_collects_rusage(self):
+        job = fvcom_cmd.deflate.DeflateJob(Path('foo.nc'))
+        job.process = subprocess.Popen(
+            [sys.executable, '-c', 'import sys; sys.exit(3)']
+        )
+        job.pid = job.process.pid
+        assert job._wait() == 3
+        assert job.process.returncode == 3
+        assert job.cpu_time > 0
+        assert job.max_rss > 0
+
+    def test_done(self):
+        job = fvcom_cmd.deflate.DeflateJob(Path('foo.nc'))
+        assert not job.done
+        job.returncode = 0
+        assert job.done
+
+    @pytest.mark.parametrize(
+        'codec, shuffle, expected', [
+            ('zlib', True, ['-s', '-4', '-d4']),
+            ('zlib', False, ['-4', '-d4']),
+            ('zstd', True, ['-s', '-4', '-F', '*,32015,4']),
+            ('blosc_lz4', True, ['-4', '-F', '*,32001,0,0,0,0,4,1,1']),
+        ]
+    )
+    def test_nccopy_cmd(self, codec, shuffle, expected):
+        job = fvcom_cmd.deflate.DeflateJob(
+            Path('foo.nc'), codec=codec, shuffle=shuffle
+        )
+        assert job.nccopy_cmd() == (
+            ['nccopy'] + expected + ['foo.nc', 'foo.nc.nccopy.tmp']
+        )
+
+    @patch('fvcom_cmd.deflate.ncdeflate.file_profile')
+    def test_nccopy_cmd_profile(self, m_file_profile):
+        m_file_profile.return_value = {
+            'variables': {
+                'temp': {'dfl_lvl': 1, 'shuffle': True},
+                'time': {'dfl_lvl': 0, 'shuffle': False},
+            }
+        }
+        job = fvcom_cmd.deflate.DeflateJob(
+            Path('foo.nc'), profile_dir=Path('profiles')
+        )
+        assert job.nccopy_cmd() == [
+            'nccopy', '-s', '-4', '-d4', '-F', 'temp,2|1,1', '-F',
+            'time,none', 'foo.nc', 'foo.nc.nccopy.tmp'
+        ]
+        m_file_profile.assert_called_once_with(
+            Path('foo.nc'), Path('profiles')
+        )
+
+    def test_nccopy_cmd_path_with_spaces(self):
+        job = fvcom_cmd.deflate.DeflateJob(
+            Path('my results/foo.nc'), codec='zstd'
+        )
+        assert job.nccopy_cmd() == [
+            'nccopy', '-s', '-4', '-F', '*,32015,4', 'my results/foo.nc',
+            'my results/foo.nc.nccopy.tmp'
+        ]
+
+    @pytest.mark.skipif(
+        shutil.which('nccopy') is None, reason='nccopy is not installed'
+    )
+    @patch('fvcom_cmd.deflate.ncdeflate.file_profile')
+    def test_nccopy_profile_filters(self, m_file_profile, tmp_path):
+        netCDF4 = pytest.importorskip('netCDF4')
+        numpy = pytest.importorskip('numpy')
+        m_file_profile.return_value = {
+            'variables': {
+                'temp': {'dfl_lvl': 1, 'shuffle': True},
+            }
+        }
+        filepath = tmp_path / 'my results' / 'results.nc'
+        filepath.parent.mkdir()
+        with netCDF4.Dataset(
+            fspath(filepath), 'w', format='NETCDF3_64BIT_OFFSET'
+        ) as ds:
+            ds.createDimension('node', 50)
+            temp = ds.createVariable('temp', 'f4', ('node', ))
+            temp[:] = numpy.arange(50, dtype='f4')
+        job = fvcom_cmd.deflate.DeflateJob(
+            filepath, shuffle=False, profile_dir=tmp_path
+        )
+        subprocess.check_call(job.nccopy_cmd())
+        with netCDF4.Dataset(fspath(job.tmp_filepath)) as ds:
+            filters = ds.variables['temp'].filters()
+        assert filters['zlib'] and filters['complevel'] == 1
+        assert filters['shuffle']
+
+    @patch('fvcom_cmd.deflate.ncdeflate.check_readable')
+    def test_read_back_failure(self, m_check_readable, tmp_path):
+        m_check_readable.side_effect = ValueError('HDF error')
+        filepath = tmp_path / 'foo.nc'
+        filepath.write_text(u'original')
+        job = fvcom_cmd.deflate.DeflateJob(
+            filepath, codec='zstd', returncode=0
+        )
+        job.tmp_filepath.write_text(u'unreadable')
+        job._check_read_back()
+        job.finish()
+        assert job.returncode == 1
+        assert filepath.read_text() == u'original'
+        assert not job.tmp_filepath.exists()
+
+
+class TestDeflate:
+    """Unit tests for fvcom_cmd.deflate.deflate() function.
+    """
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            fvcom_cmd.deflate.deflate([Path('foo.nc')], 1, backend='ncks')
+
+    def test_quantize_requires_netcdf4_backend(self):
+        with pytest.raises(ValueError):
+            fvcom_cmd.deflate.deflate(
+                [Path('foo.nc')], 1, backend='nccopy', quantize={'temp': 8}
+            )
+
+    def test_largest_first(self, tmp_path):
+        sizes = (('small.nc', 10), ('big.nc', 1000), ('mid.nc', 100))
+        for name, size in sizes:
+            (tmp_path / name).write_bytes(b'x' * size)
+        jobs = fvcom_cmd.deflate._schedule(
+            [tmp_path / name for name in ('small.nc', 'big.nc', 'mid.nc')],
+            'nccopy', {}, fvcom_cmd.deflate.DeflatedRecords()
+        )
+        assert [job.filepath.name for job in jobs] == [
+            'big.nc', 'mid.nc', 'small.nc'
+        ]
+
+    def test_priority_first(self, tmp_path):
+        for name, size in (('restart.nc', 10), ('results.nc', 1000)):
+            (tmp_path / name).write_bytes(b'x' * size)
+        jobs = fvcom_cmd.deflate._schedule(
+            [tmp_path / 'results.nc', tmp_path / 'restart.nc'],
+            'nccopy', {'*restart*': 1}, fvcom_cmd.deflate.DeflatedRecords()
+        )
+        assert [job.filepath.name for job in jobs] == [
+            'restart.nc', 'results.nc'
+        ]
+
+    def test_missing_file_skipped(self, tmp_path):
+        jobs = fvcom_cmd.deflate._schedule(
+            [tmp_path / 'missing.nc'], 'nccopy', {},
+            fvcom_cmd.deflate.DeflatedRecords()
+        )
+        assert jobs == []
+
+    def test_recorded_file_skipped(self, tmp_path):
+        filepath = tmp_path / 'foo.nc'
+        filepath.write_bytes(b'CDF\x02')
+        records = fvcom_cmd.deflate.DeflatedRecords()
+        records.add(filepath, 4)
+        jobs = fvcom_cmd.deflate._schedule([filepath], 'nccopy', {}, records)
+        assert jobs == []
+
+    def test_force(self, tmp_path):
+        filepath = tmp_path / 'foo.nc'
+        filepath.write_bytes(b'CDF\x02')
+        records = fvcom_cmd.deflate.DeflatedRecords()
+        records.add(filepath, 4)
+        jobs = fvcom_cmd.deflate._schedule(
+            [filepath], 'nccopy', {}, records, force=True
+        )
+        assert [job.filepath for job in jobs] == [filepath]
+
+    def test_rerun_with_keep_bits(self, tmp_path):
+        netCDF4 = pytest.importorskip('netCDF4')
+        numpy = pytest.importorskip('numpy')
+        filepath = tmp_path / 'results.nc'
+        with netCDF4.Dataset(
+            fspath(filepath), 'w', format='NETCDF3_64BIT_OFFSET'
+        ) as ds:
+            ds.createDimension('node', 50)
+            temp = ds.createVariable('temp', 'f4', ('node', ))
+            temp[:] = numpy.arange(50, dtype='f4') / 3
+        fvcom_cmd.deflate.deflate([filepath], 1, backend='netcdf4')
+        quantize = fvcom_cmd.deflate.quantize_settings(keep_bits=[('temp', 8)])
+        report = fvcom_cmd.deflate.deflate(
+            [filepath], 1, backend='netcdf4', quantize=quantize
+        )
+        assert [job.filepath for job in report.jobs] == [filepath]
+        with netCDF4.Dataset(fspath(filepath)) as ds:
+            assert ds.variables['temp'].quantization_nsb == 8
+        report = fvcom_cmd.deflate.deflate(
+            [filepath], 1, backend='netcdf4', quantize=quantize
+        )
+        assert report.n_skipped == 1
+
+
+class TestCheckProfiles:
+    """Unit tests for fvcom_cmd.deflate._check_profiles() function.
+    """
+
+    @pytest.mark.parametrize(
+        'codec, profiles, warned', [
+            ('zlib', True, False),
+            ('zstd', True, True),
+            ('zstd', False, False),
+        ]
+    )
+    @patch('fvcom_cmd.deflate.logger')
+    def test_check_profiles(self, m_logger, codec, profiles, warned, tmp_path):
+        if profiles:
+            (tmp_path / 'abc123.yaml').write_text(u'variables: {}')
+        fvcom_cmd.deflate._check_profiles(tmp_path, codec)
+        assert m_logger.warning.called is warned
+
+
+class TestSplitInProcess:
+    """Unit tests for fvcom_cmd.deflate._split_in_process() function.
+    """
+
+    @pytest.mark.parametrize(
+        'backend, codec, size, max_workers, expected', [
+            ('nccopy', 'zlib', fvcom_cmd.deflate.LARGE_FILE_SIZE, 4, True),
+            ('nccopy', 'zlib', fvcom_cmd.deflate.LARGE_FILE_SIZE - 1, 4,
+             False),
+            ('nccopy', 'zlib', fvcom_cmd.deflate.LARGE_FILE_SIZE, 1, False),
+            ('nccopy', 'zstd', fvcom_cmd.deflate.LARGE_FILE_SIZE, 4, False),
+            ('netcdf4', 'zlib', fvcom_cmd.deflate.LARGE_FILE_SIZE, 4, False),
+        ]
+    )
+    @patch('fvcom_cmd.deflate.ncdeflate.available', return_value=True)
+    def test_split_in_process(
+        self, m_available, backend, codec, size, max_workers, expected
+    ):
+        job = fvcom_cmd.deflate.DeflateJob(
+            Path('foo.nc'), backend=backend, size=size, codec=codec
+        )
+        assert fvcom_cmd.deflate._split_in_process(job, max_workers) is (
+            expected
+        )
+
+
+class TestWatch:
+    """Unit tests for fvcom_cmd.deflate.watch() function.
+    """
+
+    @patch('fvcom_cmd.deflate.os.nice', return_value=0)
+    @patch('fvcom_cmd.deflate.deflate')
+    def test_remaining_files_on_stop(self, m_deflate, m_nice, tmp_path):
+        for name in ('run_0001.nc', 'run_0002.nc'):
+            (tmp_path / name).write_bytes(b'x')
+        m_deflate.return_value = fvcom_cmd.deflate.DeflateReport(
+            'nccopy', 'zlib', 4
+        )
+        stop = Mock(is_set=Mock(side_effect=[False, True]))
+        report = fvcom_cmd.deflate.watch(
+            tmp_path, 4, settle_time=0, stop=stop, backend='nccopy'
+        )
+        assert m_deflate.call_args_list == [
+            call([tmp_path / 'run_0001.nc'], 1, backend='nccopy'),
+            call([tmp_path / 'run_0002.nc'], 4, backend='nccopy'),
+        ]
+        m_nice.assert_called_with(fvcom_cmd.deflate.WATCH_NICENESS)
+        assert report.backend == 'nccopy'
+
+    @patch('fvcom_cmd.deflate.os.nice', return_value=5)
+    @patch('fvcom_cmd.deflate.deflate')
+    def test_nice_option_not_overridden(self, m_deflate, m_nice, tmp_path):
+        m_deflate.return_value = fvcom_cmd.deflate.DeflateReport(
+            'nccopy', 'zlib', 4
+        )
+        stop = Mock(is_set=Mock(return_value=True))
+        fvcom_cmd.deflate.watch(
+            tmp_path,
+            settle_time=0,
+            stop=stop,
+            process_priority=fvcom_cmd.deflate.ProcessPriority(nice=5)
+        )
+        assert call(fvcom_cmd.deflate.WATCH_NICENESS - 5) not in (
+            m_nice.call_args_list
+        )
+
+    @patch('fvcom_cmd.deflate.os.nice', return_value=0)
+    @patch('fvcom_cmd.deflate.deflate')
+    def test_signal_handlers_restored(self, m_deflate, m_nice, tmp_path):
+        m_deflate.return_value = fvcom_cmd.deflate.DeflateReport(
+            'nccopy', 'zlib', 4
+        )
+        handlers = {
+            signum: signal.getsignal(signum)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        with patch(
+            'fvcom_cmd.deflate.filewatch.FileWatcher.wait',
+            side_effect=lambda timeout: os.kill(os.getpid(), signal.SIGTERM)
+        ):
+            fvcom_cmd.deflate.watch(tmp_path, settle_time=0)
+        for signum, handler in handlers.items():
+            assert signal.getsignal(signum) is handler
+
+
+class TestDeflateReport:
+    """Unit tests for fvcom_cmd.deflate.DeflateReport class.
+    """
+
+    def _report(self):
+        return fvcom_cmd.deflate.DeflateReport(
+            'nccopy',
+            'zlib',
+            4,
+            jobs=[
+                fvcom_cmd.deflate.JobStats(
+                    Path('foo.nc'), 0, 3000000, 1000000, 2, 1.5, 10000000
+                ),
+                fvcom_cmd.deflate.JobStats(
+                    Path('bar.nc'), 1, 1000000, None, 1, 0.5, 20000000
+                ),
+            ],
+            n_skipped=2,
+            wall_time=2,
+        )
+
+    def test_totals(self):
+        report = self._report()
+        assert len(report.deflated) == 1
+        assert len(report.failed) == 1
+        assert report.compression_ratio == 3
+        assert report.throughput == 1500000
+        assert report.cpu_time == 2
+        assert report.max_rss == 20000000
+
+    def test_summary(self):
+        summary = self._report().summary()
+        assert summary == (
+            'Deflated 1 of 2 files: 3.0 MB to 1.0 MB '
+            '(compression ratio 3.00) in 2.0 s = 1.5 MB/s; '
+            'CPU time 2.0 s (1.0 CPUs busy), peak RSS 20 MB; '
+            '1 failed; 2 skipped'
+        )
+
+    def test_summary_with_verification(self):
+        report = self._report()
+        report.jobs[0].verify_time = 0.25
+        report.jobs[1].verify_time = 0.5
+        report.jobs[1].mismatches = ['dimension node differs']
+        assert report.verify_time == 0.75
+        assert report.summary().endswith(
+            'verification 0.8 s; 1 failed (1 mismatched); 2 skipped'
+        )
+
+    def test_write_json(self, tmp_path):
+        report_file = tmp_path / fvcom_cmd.deflate.DEFLATE_REPORT
+        self._report().write_json(report_file)
+        with report_file.open('rt') as f:
+            report = json.load(f)
+        assert report['n_deflated'] == 1
+        assert report['compression_ratio'] == 3
+        assert report['jobs'][0]['filepath'] == 'foo.nc'
+
+    def test_no_files_deflated(self):
+        report = fvcom_cmd.deflate.DeflateReport('nccopy', 'zlib', 4)
+        assert report.compression_ratio is None
+        assert report.max_rss == 0
+
+
+class TestAdmissionControl:
+    """Unit tests for fvcom_cmd.deflate.AdmissionControl class.
+    """
+
+    def test_initial_compression_ratio(self):
+        admission = fvcom_cmd.deflate.AdmissionControl()
+        assert admission.compression_ratio == 1
+
+    def test_record(self):
+        admission = fvcom_cmd.deflate.AdmissionControl()
+        job = fvcom_cmd.deflate.DeflateJob(
+            Path('foo.nc'), size=1000, deflated_size=250
+        )
+        admission.record(job)
+        assert admission.compression_ratio == 0.25
+        assert admission.disk_needed(job) == 312
+
+    @patch('fvcom_cmd.deflate._available_memory', return_value=None)
+    @patch('fvcom_cmd.deflate._free_disk_space', return_value=1000)
+    def test_admits(self, m_free_disk_space, m_avail_mem, tmp_path):
+        admission = fvcom_cmd.deflate.AdmissionControl()
+        job = fvcom_cmd.deflate.DeflateJob(tmp_path / 'foo.nc', size=800)
+        assert admission.admits(job, {})
+
+    @patch('fvcom_cmd.deflate._available_memory', return_value=None)
+    @patch('fvcom_cmd.deflate._free_disk_space', return_value=1000)
+    def test_reserved_disk_space(
+        self, m_free_disk_space, m_avail_mem, tmp_path
+    ):
+        admission = fvcom_cmd.deflate.AdmissionControl()
+        running_job = fvcom_cmd.deflate.DeflateJob(
+            tmp_path / 'bar.nc', size=480
+        )
+        job = fvcom_cmd.deflate.DeflateJob(tmp_path / 'foo.nc', size=480)
+        assert not admission.admits(job, {running_job.filepath: running_job})
+
+    @patch('fvcom_cmd.deflate._available_memory', return_value=500)
+    @patch('fvcom_cmd.deflate._free_disk_space', return_value=10000)
+    def test_not_enough_memory(self, m_free_disk_space, m_avail_mem, tmp_path):
+        admission = fvcom_cmd.deflate.AdmissionControl()
+        job = fvcom_cmd.deflate.DeflateJob(tmp_path / 'foo.nc', size=800)
+        assert not admission.admits(job, {})
+
+
+class TestAdmit:
+    """Unit tests for fvcom_cmd.deflate._admit() function.
+    """
+
+    def test_staged(self, tmp_path):
+        admission = Mock(name='admission')
+        admission.admits.return_value = True
+        job = fvcom_cmd.deflate.DeflateJob(
+            tmp_path / 'foo.nc', scratch_dir=tmp_path / 'scratch'
+        )
+        assert fvcom_cmd.deflate._admit(job, {}, admission)
+        assert job.scratch_dir == tmp_path / 'scratch'
+
+    def test_fall_back_to_in_place(self, tmp_path):
+        admission = Mock(name='admission')
+        admission.admits.side_effect = [False, True]
+        job = fvcom_cmd.deflate.DeflateJob(
+            tmp_path / 'foo.nc', scratch_dir=tmp_path / 'scratch'
+        )
+        assert fvcom_cmd.deflate._admit(job, {}, admission)
+        assert job.scratch_dir is None
+
+    def test_not_admitted(self, tmp_path):
+        admission = Mock(name='admission')
+        admission.admits.return_value = False
+        job = fvcom_cmd.deflate.DeflateJob(
+            tmp_path / 'foo.nc', scratch_dir=tmp_path / 'scratch'
+        )
+        assert not fvcom_cmd.deflate._admit(job, {}, admission)
+        assert job.scratch_dir == tmp_path / 'scratch'
+
+
+class TestCopyVerified:
+    """Unit tests for fvcom_cmd.deflate._copy_verified() function.
+    """
+
+    def test_copy_verified(self, tmp_path):
+        src, dst = tmp_path / 'src', tmp_path / 'dst'
+        src.write_bytes(b'deflated' * 1000)
+        fvcom_cmd.deflate._copy_verified(src, dst)
+        assert dst.read_bytes() == src.read_bytes()
+
+
+class TestConcurrencyController:
+    """Unit tests for fvcom_cmd.deflate.ConcurrencyController class.
+    """
+
+    def _finish(self, controller, n_jobs, seconds):
+        now = controller.window_start + seconds
+        for _ in range(n_jobs):
+            job = fvcom_cmd.deflate.DeflateJob(
+                Path('foo.nc'), size=100, deflated_size=50
+            )
+            controller.record(job, now)
+
+    def test_fixed(self):
+        controller = fvcom_cmd.deflate.ConcurrencyController.fixed(4)
+        self._finish(controller, 8, 1)
+        assert controller.jobs == 4
+
+    def test_adaptive_starts_low(self):
+        controller = (
+            fvcom_cmd.deflate.ConcurrencyController.adaptive_up_to(16)
+        )
+        assert controller.jobs == fvcom_cmd.deflate.ADAPTIVE_START_JOBS
+
+    def test_hill_climb(self):
+        controller = fvcom_cmd.deflate.ConcurrencyController.adaptive_up_to(8)
+        self._finish(controller, 2, 1)
+        assert controller.jobs == 3
+        self._finish(controller, 3, 1)
+        assert controller.jobs == 4
+        self._finish(controller, 4, 2)
+        assert controller.jobs == 3
+
+    def test_upper_limit(self):
+        controller = fvcom_cmd.deflate.ConcurrencyController.adaptive_up_to(2)
+        self._finish(controller, 2, 1)
+        assert controller.jobs == 2
+        assert controller.step == -1
+
+    def test_failed_job_not_measured(self):
+        controller = fvcom_cmd.deflate.ConcurrencyController.adaptive_up_to(8)
+        job = fvcom_cmd.deflate.DeflateJob(Path('foo.nc'), size=100)
+        controller.record(job)
+        assert controller.window_jobs == 0
+
+
+class TestJobTimeouts:
+    """Unit tests for fvcom_cmd.deflate.JobTimeouts class.
+    """
+
+    def test_minimum_timeout(self):
+        timeouts = fvcom_cmd.deflate.JobTimeouts()
+        job = fvcom_cmd.deflate.DeflateJob(Path('foo.nc'), size=1)
+        assert timeouts.timeout(job) == fvcom_cmd.deflate.MIN_JOB_TIMEOUT
+
+    def test_timeout_from_observed_throughput(self):
+        timeouts = fvcom_cmd.deflate.JobTimeouts()
+        timeouts.record(
+            fvcom_cmd.deflate.DeflateJob(
+                Path('foo.nc'), size=10 * 1024**3, returncode=0, wall_time=10
+            )
+        )
+        job = fvcom_cmd.deflate.DeflateJob(Path('bar.nc'), size=100 * 1024**3)
+        assert timeouts.timeout(job) == fvcom_cmd.deflate.TIMEOUT_FACTOR * 100
+
+    def test_failed_jobs_not_recorded(self):
+        timeouts = fvcom_cmd.deflate.JobTimeouts()
+        timeouts.record(
+            fvcom_cmd.deflate.DeflateJob(
+                Path('foo.nc'), size=100, returncode=1, wall_time=1000
+            )
+        )
+        assert timeouts.job_throughput == (
+            fvcom_cmd.deflate.EXPECTED_JOB_THROUGHPUT
+        )
+
+    def test_overdue(self):
+        timeouts = fvcom_cmd.deflate.JobTimeouts()
+        timeout = fvcom_cmd.deflate.MIN_JOB_TIMEOUT
+        hung = fvcom_cmd.deflate.DeflateJob(Path('hung.nc'), start_time=0)
+        killed = fvcom_cmd.deflate.DeflateJob(
+            Path('killed.nc'), start_time=0, timed_out=True
+        )
+        running = fvcom_cmd.deflate.DeflateJob(
+            Path('running.nc'), start_time=timeout
+        )
+        jobs_in_progress = {
+            job.filepath: job
+            for job in (hung, killed, running)
+        }
+        assert timeouts.overdue(jobs_in_progress, now=timeout + 1) == [
+            (hung, timeout)
+        ]
+        assert timeouts.next_deadline(jobs_in_progress) == timeout
+
+
+class TestRetry:
+    """Unit tests for fvcom_cmd.deflate._retry() function.
+    """
+
+    def test_retry_with_backoff(self):
+        job = fvcom_cmd.deflate.DeflateJob(
+            Path('foo.nc'), returncode=1, attempts=2
+        )
+        jobs = [fvcom_cmd.deflate.DeflateJob(Path('bar.nc'))]
+        fvcom_cmd.deflate._retry(job, jobs)
+        assert jobs[0] is job
+        assert job.returncode is None
+        assert job.not_before > time.time() + fvcom_cmd.deflate.RETRY_DELAY
+
+    def test_permanent_failure(self):
+        job = fvcom_cmd.deflate.DeflateJob(
+            Path('foo.nc'),
+            returncode=1,
+            attempts=fvcom_cmd.deflate.MAX_RETRIES + 1
+        )
+        jobs = []
+        fvcom_cmd.deflate._retry(job, jobs)
+        assert jobs == []
+        assert job.returncode == 1
+
+    @patch('fvcom_cmd.deflate.logger')
+    def test_verification_mismatch_not_retried(self, m_logger):
+        job = fvcom_cmd.deflate.DeflateJob(
+            Path('foo.nc'),
+            returncode=1,
+            mismatches=['dimension node differs']
+        )
+        jobs = []
+        fvcom_cmd.deflate._retry(job, jobs)
+        assert jobs == []
+        assert job.returncode == 1
+
+    @patch('fvcom_cmd.deflate.logger')
+    def test_timeout_retried(self, m_logger):
+        job = fvcom_cmd.deflate.DeflateJob(
+            Path('foo.nc'), returncode=-9, timed_out=True
+        )
+        jobs = []
+        fvcom_cmd.deflate._retry(job, jobs)
+        assert jobs == [job]
+        assert not job.timed_out
+
+
+class TestAvailableCPUs:
+    """Unit tests for fvcom_cmd.deflate.available_cpus() function.
+    """
+
+    @patch('fvcom_cmd.deflate._cgroup_cpu_quota', return_value=None)
+    def test_affinity(self, m_quota):
+        with patch.object(
+            fvcom_cmd.deflate.os,
+            'sched_getaffinity',
+            return_value={0, 1, 2},
+            create=True
+        ):
+            assert fvcom_cmd.deflate.available_cpus() == 3
+
+    @patch('fvcom_cmd.deflate._cgroup_cpu_quota', return_value=1.5)
+    def test_cgroup_quota(self, m_quota):
+        with patch.object(
+            fvcom_cmd.deflate.os,
+            'sched_getaffinity',
+            return_value={0, 1, 2},
+            create=True
+        ):
+            assert fvcom_cmd.deflate.available_cpus() == 2
+
+
+class TestFinishJob:
+    """Unit tests for fvcom_cmd.deflate._finish_job() function.
+    """
+
+    @patch('fvcom_cmd.deflate.logger')
+    def test_storage_error_fails_job(self, m_logger, tmp_path):
+        filepath = tmp_path / 'foo.nc'
+        filepath.write_bytes(b'original')
+        # A non-empty directory in the way of the deflated file
+        dest_filepath = tmp_path / 'results' / 'foo.nc'
+        (dest_filepath / 'bar').mkdir(parents=True)
+        job = fvcom_cmd.deflate.DeflateJob(
+            filepath, returncode=0, dest_filepath=dest_filepath
+        )
+        job.replacement_filepath.write_bytes(b'deflated')
+        jobs_in_progress = {filepath: job}
+        records = fvcom_cmd.deflate.DeflatedRecords()
+        fvcom_cmd.deflate._finish_job(
+            job, jobs_in_progress, Mock(name='admission'), records
+        )
+        assert job.returncode == 1
+        assert jobs_in_progress == {}
+        assert filepath.read_bytes() == b'original'
+        assert not job.replacement_filepath.exists()
+        assert not records.contains(job.target_filepath, 4)
+        assert records.unfinished(tmp_path) == {}
+
+
+class TestRecover:
+    """Unit tests for fvcom_cmd.deflate.recover() function.
+    """
+
+    def _interrupt(self, tmp_path, state, tmp_contents):
+        filepath = tmp_path / 'foo.nc'
+        filepath.write_bytes(b'original')
+        job = fvcom_cmd.deflate.DeflateJob(filepath)
+        fvcom_cmd.deflate.DeflatedRecords().journal(job, state)
+        job.replacement_filepath.write_bytes(tmp_contents)
+        return job
+
+    def test_written_job_completed(self, tmp_path):
+        job = self._interrupt(
+            tmp_path, fvcom_cmd.deflate.WRITTEN,
+            fvcom_cmd.ncdeflate.HDF5_SIGNATURE + b'deflated'
+        )
+        records = fvcom_cmd.deflate.DeflatedRecords()
+        completed = fvcom_cmd.deflate.recover([job.filepath], records)
+        assert completed == [job.filepath]
+        assert job.filepath.read_bytes().endswith(b'deflated')
+        assert not job.replacement_filepath.exists()
+        assert records.contains(job.filepath, 4)
+        assert records.unfinished(tmp_path) == {}
+
+    def test_written_job_completed_at_destination(self, tmp_path):
+        filepath = tmp_path / 'foo.nc'
+        filepath.write_bytes(b'original')
+        dest_filepath = tmp_path / 'results' / 'foo.nc'
+        dest_filepath.parent.mkdir()
+        job = fvcom_cmd.deflate.DeflateJob(
+            filepath, dest_filepath=dest_filepath
+        )
+        fvcom_cmd.deflate.DeflatedRecords().journal(
+            job, fvcom_cmd.deflate.WRITTEN
+        )
+        job.replacement_filepath.write_bytes(
+            fvcom_cmd.ncdeflate.HDF5_SIGNATURE + b'deflated'
+        )
+        records = fvcom_cmd.deflate.DeflatedRecords()
+        completed = fvcom_cmd.deflate.recover([filepath], records)
+        assert completed == [filepath]
+        assert not filepath.exists()
+        assert dest_filepath.read_bytes().endswith(b'deflated')
+        assert records.contains(dest_filepath, 4)
+
+    def test_started_job_cleaned_up(self, tmp_path):
+        job = self._interrupt(
+            tmp_path, fvcom_cmd.deflate.STARTED,
+            fvcom_cmd.ncdeflate.HDF5_SIGNATURE + b'partial'
+        )
+        records = fvcom_cmd.deflate.DeflatedRecords()
+        completed = fvcom_cmd.deflate.recover([job.filepath], records)
+        assert completed == []
+        assert job.filepath.read_bytes() == b'original'
+        assert not job.replacement_filepath.exists()
+        assert records.unfinished(tmp_path) == {}
+
+    def test_changed_original_not_replaced(self, tmp_path):
+        job = self._interrupt(
+            tmp_path, fvcom_cmd.deflate.WRITTEN,
+            fvcom_cmd.ncdeflate.HDF5_SIGNATURE + b'deflated'
+        )
+        job.filepath.write_bytes(b'rewritten by a new run')
+        fvcom_cmd.deflate.recover(
+            [job.filepath], fvcom_cmd.deflate.DeflatedRecords()
+        )
+        assert job.filepath.read_bytes() == b'rewritten by a new run'
+        assert not job.replacement_filepath.exists()
+
+    def test_orphaned_tmp_file_removed(self, tmp_path):
+        filepath = tmp_path / 'foo.nc'
+        filepath.write_bytes(b'original')
+        tmp_filepath = tmp_path / 'foo.nc.nccopy.tmp'
+        tmp_filepath.write_bytes(b'partial')
+        fvcom_cmd.deflate.recover(
+            [filepath], fvcom_cmd.deflate.DeflatedRecords()
+        )
+        assert not tmp_filepath.exists()
+
+
+class TestDeflatedRecords:
+    """Unit tests for fvcom_cmd.deflate.DeflatedRecords class.
+    """
+
+    def test_add(self, tmp_path):
+        filepath = tmp_path / 'foo.nc'
+        filepath.write_bytes(b'deflated')
+        fvcom_cmd.deflate.DeflatedRecords().add(filepath, 4)
+        records = fvcom_cmd.deflate.DeflatedRecords()
+        assert records.contains(filepath, 4)
+        assert not records.contains(filepath, 9)
+
+    def test_codec(self, tmp_path):
+        filepath = tmp_path / 'foo.nc'
+        filepath.write_bytes(b'deflated')
+        fvcom_cmd.deflate.DeflatedRecords().add(filepath, 4, 'zstd')
+        records = fvcom_cmd.deflate.DeflatedRecords()
+        assert records.contains(filepath, 4, 'zstd')
+        assert not records.contains(filepath, 4)
+
+    def test_shuffle_and_quantize(self, tmp_path):
+        filepath = tmp_path / 'foo.nc'
+        filepath.write_bytes(b'deflated')
+        fvcom_cmd.deflate.DeflatedRecords().add(
+            filepath, 4, shuffle=False, quantize={'temp': 8, 'salinity': 10}
+        )
+        records = fvcom_cmd.deflate.DeflatedRecords()
+        assert records.contains(
+            filepath, 4, shuffle=False, quantize={'salinity': 10, 'temp': 8}
+        )
+        assert not records.contains(filepath, 4, quantize={'temp': 8})
+        assert not records.contains(filepath, 4, shuffle=False)
+
+    def test_record_without_settings(self, tmp_path):
+        filepath = tmp_path / 'foo.nc'
+        filepath.write_bytes(b'deflated')
+        stat = filepath.stat()
+        with (tmp_path / fvcom_cmd.deflate.DEFLATED_RECORD).open('wt') as f:
+            f.write(
+                u'{{"name": "foo.nc", "inode": {0.st_ino}, '
+                u'"size": {0.st_size}, "mtime_ns": {1}, "dfl_lvl": 4}}\n'.
+                format(stat, fvcom_cmd.verify.mtime_ns(stat))
+            )
+        records = fvcom_cmd.deflate.DeflatedRecords()
+        assert records.contains(filepath, 4)
+        assert not records.contains(filepath, 4, quantize={'temp': 8})
+
+    def test_changed_file(self, tmp_path):
+        filepath = tmp_path / 'foo.nc'
+        filepath.write_bytes(b'deflated')
+        fvcom_cmd.deflate.DeflatedRecords().add(filepath, 4)
+        filepath.write_bytes(b'replaced by a new file')
+        assert not fvcom_cmd.deflate.DeflatedRecords().contains(filepath, 4)
+
+    def test_journal(self, tmp_path):
+        filepath = tmp_path / 'foo.nc'
+        filepath.write_bytes(b'original')
+        job = fvcom_cmd.deflate.DeflateJob(filepath)
+        fvcom_cmd.deflate.DeflatedRecords().journal(
+            job, fvcom_cmd.deflate.STARTED
+        )
+        unfinished = fvcom_cmd.deflate.DeflatedRecords().unfinished(tmp_path)
+        assert unfinished['foo.nc']['state'] == fvcom_cmd.deflate.STARTED
+        assert not fvcom_cmd.deflate.DeflatedRecords().contains(filepath, 4)
+
+    def test_journal_after_partial_line(self, tmp_path):
+        filepath = tmp_path / 'foo.nc'
+        filepath.write_bytes(b'original')
+        with (tmp_path / fvcom_cmd.deflate.DEFLATED_RECORD).open('wt') as f:
+            f.write(u'{"name": "bar.nc", "ino')
+        job = fvcom_cmd.deflate.DeflateJob(filepath)
+        fvcom_cmd.deflate.DeflatedRecords().journal(
+            job, fvcom_cmd.deflate.WRITTEN
+        )
+        unfinished = fvcom_cmd.deflate.DeflatedRecords().unfinished(tmp_path)
+        assert list(unfinished) == ['foo.nc']
+
+    def test_partial_line_ignored(self, tmp_path):
+        filepath = tmp_path / 'foo.nc'
+        filepath.write_bytes(b'deflated')
+        records = fvcom_cmd.deflate.DeflatedRecords()
+        records.add(filepath, 4)
+        with (tmp_path / fvcom_cmd.deflate.DEFLATED_RECORD).open('at') as f:
+            f.write(u'{"name": "bar.nc", "ino')
+        assert fvcom_cmd.deflate.DeflatedRecords().contains(filepath, 4)
@@ -0,0 +1,144 @@
+# Copyright 2013-2017 The Salish Sea MEOPAR Contributors
+# and The University of British Columbia
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""FVCOM-Cmd finished file watcher unit tests
+"""
+import sys
+import time
+try:
+    from unittest.mock import patch
+except ImportError:
+    # Python 2.7
+    from mock import patch
+
+import pytest
+
+from fvcom_cmd import filewatch
+
+
+class TestSeriesKey:
+    """Unit tests for series_key() function.
+    """
+
+    @pytest.mark.parametrize(
+        'name, expected', [
+            ('casename_0001.nc', ('casename_.nc', 1)),
+            ('casename_0012.nc', ('casename_.nc', 12)),
+            ('casename_restart_0003.nc', ('casename_restart_.nc', 3)),
+            ('casename_station_timeseries.nc',
+             ('casename_station_timeseries.nc', 0)),
+        ]
+    )
+    def test_series_key(self, name, expected):
+        assert filewatch.series_key(name) == expected
+
+
+class TestFileWatcher:
+    """Unit tests for FileWatcher class.
+    """
+
+    def test_last_of_series_not_finished(self, tmp_path):
+        for name in ('run_0001.nc', 'run_0002.nc', 'run_station.nc'):
+            (tmp_path / name).write_bytes(b'x')
+        watcher = filewatch.FileWatcher(tmp_path, settle_time=0)
+        watcher.start(use_inotify=False)
+        assert watcher.finished() == [tmp_path / 'run_0001.nc']
+
+    def test_finished_reported_once(self, tmp_path):
+        for name in ('run_0001.nc', 'run_0002.nc'):
+            (tmp_path / name).write_bytes(b'x')
+        watcher = filewatch.FileWatcher(tmp_path, settle_time=0)
+        watcher.start(use_inotify=False)
+        watcher.finished()
+        assert watcher.finished() == []
+        assert watcher.remaining() == [tmp_path / 'run_0002.nc']
+
+    def test_unsettled_not_finished(self, tmp_path):
+        for name in ('run_0001.nc', 'run_0002.nc'):
+            (tmp_path / name).write_bytes(b'x')
+        watcher = filewatch.FileWatcher(tmp_path, settle_time=60)
+        watcher.start(use_inotify=False)
+        assert watcher.finished() == []
+        assert watcher.finished(now=time.time() + 61) == [
+            tmp_path / 'run_0001.nc'
+        ]
+
+    def test_polled_change_unsettles(self, tmp_path):
+        watcher = filewatch.FileWatcher(
+            tmp_path, settle_time=60, poll_interval=0
+        )
+        watcher.start(use_inotify=False)
+        (tmp_path / 'run_0001.nc').write_bytes(b'x')
+        (tmp_path / 'run_0002.nc').write_bytes(b'x')
+        t_write = time.time()
+        watcher.wait(0)
+        assert watcher.finished(now=t_write + 30) == []
+        assert watcher.finished(now=t_write + 61) == [
+            tmp_path / 'run_0001.nc'
+        ]
+
+    def test_ignores_unmatched_files(self, tmp_path):
+        for name in ('run_0001.nc', 'run_0002.nc.nccopy.tmp', 'run_0002.nc'):
+            (tmp_path / name).write_bytes(b'x')
+        watcher = filewatch.FileWatcher(tmp_path, settle_time=0)
+        watcher.start(use_inotify=False)
+        assert sorted(watcher.files) == ['run_0001.nc', 'run_0002.nc']
+
+    @pytest.mark.skipif(
+        not sys.platform.startswith('linux'), reason='requires inotify'
+    )
+    def test_inotify_open_file_not_finished(self, tmp_path):
+        watcher = filewatch.FileWatcher(tmp_path, settle_time=0)
+        watcher.start()
+        try:
+            assert watcher.inotify_fd is not None
+            (tmp_path / 'run_0001.nc').write_bytes(b'x')
+            with (tmp_path / 'run_0002.nc').open('wb') as f:
+                f.write(b'x')
+                f.flush()
+                watcher.wait(1)
+                # The model is still writing the first record of run_0002
+                # when it reopens run_0001
+                with (tmp_path / 'run_0001.nc').open('ab') as g:
+                    g.write(b'x')
+                    g.flush()
+                    watcher.wait(1)
+                    assert watcher.finished() == []
+            watcher.wait(1)
+            assert watcher.finished() == [tmp_path / 'run_0001.nc']
+        finally:
+            watcher.close()
+
+    @pytest.mark.skipif(
+        not sys.platform.startswith('linux'), reason='requires inotify'
+    )
+    def test_inotify_rescans(self, tmp_path):
+        watcher = filewatch.FileWatcher(
+            tmp_path, settle_time=60, poll_interval=0
+        )
+        watcher.start()
+        try:
+            # Writes from another node of a parallel file system don't
+            # generate inotify events
+            with patch.object(watcher, '_read_events'):
+                (tmp_path / 'run_0001.nc').write_bytes(b'x')
+                (tmp_path / 'run_0002.nc').write_bytes(b'x')
+                t_write = time.time()
+                watcher.wait(0)
+            assert sorted(watcher.files) == ['run_0001.nc', 'run_0002.nc']
+            assert watcher.finished(now=t_write + 61) == [
+                tmp_path / 'run_0001.nc'
+            ]
+        finally:
+            watcher.close()
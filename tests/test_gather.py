@@ -14,6 +14,10 @@
 # limitations under the License.
 """SalishSeaCmd gather sub-command plug-in unit tests
 """
+import errno
+import hashlib
+import threading
+import time
 try:
     from pathlib import Path
 except ImportError:
@@ -37,6 +41,10 @@ except ImportError:
 import cliff.app
 import pytest
 
+import fvcom_cmd.filewatch
+import fvcom_cmd.gather
+import fvcom_cmd.pack
+import fvcom_cmd.verify
 import nemo_cmd.gather
 
 
@@ -45,6 +53,11 @@ def gather_cmd():
     return nemo_cmd.gather.Gather(Mock(spec=cliff.app.App), [])
 
 
+@pytest.fixture
+def fvc_gather_cmd():
+    return fvcom_cmd.gather.Gather(Mock(spec=cliff.app.App), [])
+
+
 class TestGetParser:
     """Unit tests for `nemo gather` sub-command command-line parser.
     """
@@ -68,3 +81,492 @@ class TestTakeAction:
         parsed_args = SimpleNamespace(results_dir=Path('/results/'))
         gather_cmd.take_action(parsed_args)
         m_gather.assert_called_once_with(Path('/results/'))
+
+
+class TestFVCOMWatchAction:
+    """Unit tests for `fvc gather --watch` sub-command take_action() method.
+    """
+
+    @pytest.mark.parametrize('option', [['--pack'], ['--dedup']])
+    @patch('fvcom_cmd.gather.watch')
+    def test_whole_results_dir_options_rejected(
+        self, m_watch, option, fvc_gather_cmd
+    ):
+        parsed_args = fvc_gather_cmd.get_parser('fvc gather').parse_args(
+            ['results', '--watch', 'output'] + option
+        )
+        with pytest.raises(SystemExit) as exc_info:
+            fvc_gather_cmd.take_action(parsed_args)
+        assert exc_info.value.code == 2
+        assert not m_watch.called
+
+    @patch('fvcom_cmd.gather.watch')
+    def test_jobs(self, m_watch, fvc_gather_cmd):
+        parsed_args = fvc_gather_cmd.get_parser('fvc gather').parse_args(
+            ['results', '--watch', 'output', '-j', '2']
+        )
+        fvc_gather_cmd.take_action(parsed_args)
+        assert m_watch.call_args[1]['max_threads'] == 2
+
+
+class TestFVCOMGather:
+    """Unit tests for fvcom_cmd.gather.gather() function.
+    """
+
+    def test_same_device_renames(self, tmp_path, monkeypatch):
+        run_dir = tmp_path / 'run'
+        (run_dir / 'output').mkdir(parents=True)
+        (run_dir / 'output' / 'results_0001.nc').write_bytes(b'x' * 10)
+        (run_dir / 'namelist').write_text(u'&NML_CASE /')
+        (run_dir / 'fvcom').symlink_to(tmp_path)
+        monkeypatch.chdir(run_dir)
+        results_dir = tmp_path / 'results'
+        report = fvcom_cmd.gather.gather(results_dir)
+        assert list(run_dir.iterdir()) == []
+        assert (results_dir / 'output' / 'results_0001.nc').exists()
+        assert (results_dir / 'namelist').read_text() == u'&NML_CASE /'
+        assert not (results_dir / 'fvcom').exists()
+        assert sorted(move.path for move in report.renamed) == [
+            Path('namelist'), Path('output')
+        ]
+        assert report.copied == []
+
+    def test_merge_into_existing_dir(self, tmp_path, monkeypatch):
+        run_dir = tmp_path / 'run'
+        (run_dir / 'output').mkdir(parents=True)
+        (run_dir / 'output' / 'results_0002.nc').write_bytes(b'x')
+        results_dir = tmp_path / 'results'
+        (results_dir / 'output').mkdir(parents=True)
+        (results_dir / 'output' / 'results_0001.nc').write_bytes(b'x')
+        monkeypatch.chdir(run_dir)
+        monkeypatch.setattr(fvcom_cmd.gather, '_unsupported', set())
+        report = fvcom_cmd.gather.gather(results_dir)
+        assert list(run_dir.iterdir()) == []
+        assert sorted(p.name for p in (results_dir / 'output').iterdir()) == [
+            'results_0001.nc', 'results_0002.nc'
+        ]
+        assert [move.method for move in report.moves] == ['hardlink']
+
+    def test_manifest(self, tmp_path, monkeypatch):
+        run_dir = tmp_path / 'run'
+        (run_dir / 'output').mkdir(parents=True)
+        (run_dir / 'output' / 'results_0001.nc').write_bytes(b'x' * 10)
+        monkeypatch.chdir(run_dir)
+        results_dir = tmp_path / 'results'
+        fvcom_cmd.gather.gather(results_dir, manifest=True)
+        manifest = fvcom_cmd.verify.Manifest.read(results_dir)
+        assert [entry.path for entry in manifest.entries] == [
+            'output/results_0001.nc'
+        ]
+        assert fvcom_cmd.verify.verify(results_dir).failed == []
+
+    def test_pack(self, tmp_path, monkeypatch):
+        run_dir = tmp_path / 'run'
+        (run_dir / 'output').mkdir(parents=True)
+        (run_dir / 'output' / 'results_0001.nc').write_bytes(b'x' * 100)
+        (run_dir / 'namelist').write_text(u'&NML_CASE /')
+        monkeypatch.chdir(run_dir)
+        results_dir = tmp_path / 'results'
+        report = fvcom_cmd.gather.gather(results_dir, pack_threshold=100)
+        assert list(run_dir.iterdir()) == []
+        assert report.pack_report.paths == [Path('namelist')]
+        assert not (results_dir / 'namelist').exists()
+        assert (results_dir / 'output' / 'results_0001.nc').exists()
+        with fvcom_cmd.pack.PackedFiles(results_dir) as packed:
+            assert packed.read_text('namelist') == u'&NML_CASE /'
+
+    def test_dedup(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(fvcom_cmd.gather, '_unsupported', set())
+        for run in ('run1', 'run2'):
+            run_dir = tmp_path / 'runs' / run
+            (run_dir / 'output').mkdir(parents=True)
+            (run_dir / 'output' / 'grid.nc').write_bytes(b'g' * 100)
+            monkeypatch.chdir(run_dir)
+            report = fvcom_cmd.gather.gather(
+                tmp_path / 'results' / run, dedup=True, manifest=True
+            )
+        assert report.dedup_report.n_linked == 1
+        assert report.dedup_report.saved_bytes == 100
+        assert (tmp_path / 'results' / 'run2' / 'output' / 'grid.nc'
+                ).stat().st_nlink == 3
+        assert fvcom_cmd.verify.verify(tmp_path / 'results' / 'run2'
+                                       ).failed == []
+
+    def test_results_dir_in_run_dir(self, tmp_path, monkeypatch):
+        (tmp_path / 'namelist').write_text(u'&NML_CASE /')
+        monkeypatch.chdir(tmp_path)
+        fvcom_cmd.gather.gather(Path('results'))
+        assert [p.name for p in tmp_path.iterdir()] == ['results']
+        assert (tmp_path / 'results' / 'namelist').exists()
+
+
+class TestWatch:
+    """Unit tests for fvcom_cmd.gather.watch() function.
+    """
+
+    @pytest.fixture
+    def run_dir(self, tmp_path, monkeypatch):
+        run_dir = tmp_path / 'run'
+        (run_dir / 'output').mkdir(parents=True)
+        for name in ('results_0001.nc', 'results_0002.nc', 'results_0003.nc'):
+            (run_dir / 'output' / name).write_bytes(b'x' * 10)
+        (run_dir / 'fvcom.log').write_text(u'log')
+        monkeypatch.chdir(run_dir)
+        monkeypatch.setattr(fvcom_cmd.gather, 'WATCH_WAKE_INTERVAL', 0.01)
+        return run_dir
+
+    def _stop_when_idle(self, monkeypatch):
+        """Return a stop event that is set the first time that no files
+        are finished.
+        """
+        stop = threading.Event()
+        finished = fvcom_cmd.filewatch.FileWatcher.finished
+
+        def finished_or_stop(watcher, now=None):
+            filepaths = finished(watcher, now=time.time() + 1)
+            if not filepaths:
+                stop.set()
+            return filepaths
+
+        monkeypatch.setattr(
+            fvcom_cmd.filewatch.FileWatcher, 'finished', finished_or_stop
+        )
+        return stop
+
+    def test_gathers_finished_files(self, run_dir, tmp_path, monkeypatch):
+        results_dir = tmp_path / 'results'
+        report = fvcom_cmd.gather.watch(
+            results_dir,
+            Path('output'),
+            settle_time=0,
+            stop=self._stop_when_idle(monkeypatch)
+        )
+        assert sorted(p.name for p in (results_dir / 'output').iterdir()) == [
+            'results_0001.nc', 'results_0002.nc'
+        ]
+        assert sorted(p.name for p in (run_dir / 'output').iterdir()) == [
+            'results_0003.nc'
+        ]
+        assert (run_dir / 'fvcom.log').exists()
+        assert [move.method for move in report.moves] == ['rename', 'rename']
+        assert not (results_dir / '.fvc_gather').exists()
+
+    def test_watch_dir_outside_run_dir(self, run_dir, tmp_path):
+        with pytest.raises(ValueError):
+            fvcom_cmd.gather.watch(tmp_path / 'results', tmp_path)
+
+    def test_missing_watch_dir(self, run_dir, tmp_path):
+        with pytest.raises(ValueError):
+            fvcom_cmd.gather.watch(tmp_path / 'results', Path('missing'))
+
+    def test_absolute_watch_dir(self, run_dir, tmp_path, monkeypatch):
+        results_dir = tmp_path / 'results'
+        fvcom_cmd.gather.watch(
+            results_dir,
+            run_dir / 'output',
+            settle_time=0,
+            stop=self._stop_when_idle(monkeypatch)
+        )
+        assert sorted(p.name for p in (results_dir / 'output').iterdir()) == [
+            'results_0001.nc', 'results_0002.nc'
+        ]
+
+    def test_gather_after_watch(self, run_dir, tmp_path, monkeypatch):
+        results_dir = tmp_path / 'results'
+        fvcom_cmd.gather.watch(
+            results_dir,
+            Path('output'),
+            settle_time=0,
+            stop=self._stop_when_idle(monkeypatch),
+            manifest=True
+        )
+        monkeypatch.setattr(fvcom_cmd.gather, '_unsupported', set())
+        report = fvcom_cmd.gather.gather(results_dir, manifest=True)
+        assert list(run_dir.iterdir()) == []
+        assert sorted(move.path for move in report.moves) == [
+            Path('fvcom.log'), Path('output/results_0003.nc')
+        ]
+        manifest = fvcom_cmd.verify.Manifest.read(results_dir)
+        assert len(manifest.entries) == 4
+        assert fvcom_cmd.verify.verify(results_dir).failed == []
+
+    def test_throttled_copies(self, run_dir, tmp_path, monkeypatch):
+        monkeypatch.setattr(
+            fvcom_cmd.gather.os, 'rename',
+            Mock(side_effect=OSError(errno.EXDEV, 'cross-device link'))
+        )
+        results_dir = tmp_path / 'results'
+        report = fvcom_cmd.gather.watch(
+            results_dir,
+            Path('output'),
+            settle_time=0,
+            stop=self._stop_when_idle(monkeypatch),
+            bandwidth=1e9
+        )
+        assert [move.method for move in report.moves] == ['hardlink'] * 2
+        assert not (run_dir / 'output' / 'results_0001.nc').exists()
+
+
+class TestThrottle:
+    """Unit tests for fvcom_cmd.gather.Throttle class.
+    """
+
+    def test_consume(self, monkeypatch):
+        now = [100.0]
+        sleeps = []
+        monkeypatch.setattr(fvcom_cmd.gather.time, 'time', lambda: now[0])
+        monkeypatch.setattr(
+            fvcom_cmd.gather.time, 'sleep', lambda secs: sleeps.append(secs)
+        )
+        throttle = fvcom_cmd.gather.Throttle(rate=1000)
+        throttle.consume(500)
+        throttle.consume(1000)
+        now[0] = 110.0
+        throttle.consume(1000)
+        assert sleeps == [pytest.approx(0.5)]
+        assert throttle.next_time == pytest.approx(111)
+
+    def test_buffered_copy_throttled(self, tmp_path):
+        src = tmp_path / 'results_0001.nc'
+        src.write_bytes(b'x' * 1000)
+        throttle = Mock(name='throttle')
+        fvcom_cmd.gather._buffered_copy(
+            src, tmp_path / 'copy.nc', 1000, throttle=throttle
+        )
+        throttle.consume.assert_called_once_with(1000)
+
+
+class TestGatherJournal:
+    """Unit tests for fvcom_cmd.gather.GatherJournal class.
+    """
+
+    def test_recover(self, tmp_path):
+        run_dir, results_dir = tmp_path / 'run', tmp_path / 'results'
+        run_dir.mkdir()
+        results_dir.mkdir()
+        journal = fvcom_cmd.gather.GatherJournal(results_dir / '.fvc_gather')
+        journal.plan(run_dir, [Path('a.nc'), Path('b.nc')])
+        for name in ('a.nc', 'b.nc'):
+            (run_dir / name).write_bytes(b'x')
+            (results_dir / name).write_bytes(b'x')
+        journal.copied(
+            run_dir, Path('a.nc'), results_dir / 'a.nc', 'abc', 'sha256'
+        )
+        checksums = fvcom_cmd.gather.GatherJournal(
+            results_dir / '.fvc_gather'
+        ).recover(results_dir, 'sha256')
+        assert checksums == {Path('a.nc'): 'abc'}
+        assert not (run_dir / 'a.nc').exists()
+        assert (results_dir / 'a.nc').exists()
+        assert (run_dir / 'b.nc').exists()
+        assert not (results_dir / 'b.nc').exists()
+
+    def test_changed_copy_rolled_back(self, tmp_path):
+        journal = fvcom_cmd.gather.GatherJournal(tmp_path / '.fvc_gather')
+        (tmp_path / 'run').mkdir()
+        (tmp_path / 'run' / 'a.nc').write_bytes(b'x')
+        journal.plan(tmp_path / 'run', [Path('a.nc')])
+        (tmp_path / 'a.nc').write_bytes(b'x')
+        journal.copied(tmp_path / 'run', Path('a.nc'), tmp_path / 'a.nc')
+        (tmp_path / 'a.nc').write_bytes(b'partial rewrite')
+        assert journal.recover(tmp_path) == {}
+        assert (tmp_path / 'run' / 'a.nc').exists()
+        assert not (tmp_path / 'a.nc').exists()
+
+    def test_existing_file_kept(self, tmp_path):
+        journal = fvcom_cmd.gather.GatherJournal(tmp_path / '.fvc_gather')
+        (tmp_path / 'run').mkdir()
+        (tmp_path / 'run' / 'a.nc').write_bytes(b'x')
+        (tmp_path / 'a.nc').write_bytes(b'gathered before')
+        journal.plan(tmp_path / 'run', [Path('a.nc')])
+        assert journal.recover(tmp_path) == {}
+        assert (tmp_path / 'a.nc').read_bytes() == b'gathered before'
+
+    def test_resume_interrupted_gather(self, tmp_path, monkeypatch):
+        run_dir = tmp_path / 'run'
+        (run_dir / 'output').mkdir(parents=True)
+        for name in ('a.nc', 'b.nc'):
+            (run_dir / 'output' / name).write_bytes(b'x')
+        (run_dir / 'grid.nc').symlink_to(tmp_path)
+        results_dir = tmp_path / 'results'
+        (results_dir / 'output').mkdir(parents=True)
+        (results_dir / 'output' / 'restart.nc').write_bytes(b'x')
+        monkeypatch.chdir(run_dir)
+        copy_file = fvcom_cmd.gather._copy_file
+
+        def interrupted_copy(src, dst, **kwargs):
+            if src.name == 'b.nc':
+                raise OSError(errno.EIO, 'interrupted')
+            return copy_file(src, dst, **kwargs)
+
+        monkeypatch.setattr(
+            fvcom_cmd.gather, '_copy_file', interrupted_copy
+        )
+        with pytest.raises(OSError):
+            fvcom_cmd.gather.gather(results_dir, max_threads=1)
+        assert (results_dir / '.fvc_gather').exists()
+        monkeypatch.setattr(fvcom_cmd.gather, '_copy_file', copy_file)
+        report = fvcom_cmd.gather.gather(results_dir)
+        assert [move.path for move in report.moves] == [Path('output/b.nc')]
+        assert list(run_dir.iterdir()) == []
+        assert not (results_dir / '.fvc_gather').exists()
+
+
+class TestDeflateResults:
+    """Unit tests for fvcom_cmd.gather._deflate_results() function.
+    """
+
+    def test_destinations(self, tmp_path, monkeypatch):
+        run_dir = tmp_path / 'run'
+        (run_dir / 'output').mkdir(parents=True)
+        (run_dir / 'output' / 'results_0001.nc').write_bytes(b'x')
+        (run_dir / 'output' / 'results_0001.txt').write_bytes(b'x')
+        (run_dir / 'grid.nc').symlink_to(tmp_path / 'grid.nc')
+        (run_dir / 'results').mkdir()
+        (run_dir / 'results' / 'old.nc').write_bytes(b'x')
+        monkeypatch.chdir(run_dir)
+        m_deflate = Mock(name='deflate', return_value=Mock(failed=[]))
+        monkeypatch.setattr(
+            fvcom_cmd.gather.deflate_plugin, 'deflate', m_deflate
+        )
+        fvcom_cmd.gather._deflate_results(Path('results'))
+        src = run_dir / 'output' / 'results_0001.nc'
+        dst = run_dir / 'results' / 'output' / 'results_0001.nc'
+        m_deflate.assert_called_once_with(
+            [src], None, destinations={src: dst}
+        )
+        assert dst.parent.is_dir()
+
+    def test_merge_deflated_records(self, tmp_path):
+        (tmp_path / 'run').mkdir()
+        (tmp_path / 'results').mkdir()
+        src_record = tmp_path / 'run' / '.fvc_deflated'
+        src_record.write_bytes(b'{"name": "a.nc", "state": "written"}')
+        dst_record = tmp_path / 'results' / '.fvc_deflated'
+        dst_record.write_bytes(b'{"name": "a.nc", "state": "deflated"}\n')
+        fvcom_cmd.gather._merge_deflated_records(
+            tmp_path / 'run', tmp_path / 'results'
+        )
+        assert not src_record.exists()
+        assert dst_record.read_bytes() == (
+            b'{"name": "a.nc", "state": "written"}\n'
+            b'{"name": "a.nc", "state": "deflated"}\n'
+        )
+
+
+class TestCopyFile:
+    """Unit tests for fvcom_cmd.gather._copy_file() and _tree_copies()
+    functions.
+    """
+
+    @pytest.fixture
+    def src(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(fvcom_cmd.gather, '_unsupported', set())
+        (tmp_path / 'results').mkdir()
+        src = tmp_path / 'results_0001.nc'
+        src.write_bytes(b'x' * 1000)
+        return src
+
+    @pytest.mark.parametrize(
+        'method', ['hardlink', 'copy_file_range', 'sendfile', 'copy']
+    )
+    def test_copy_file(self, method, src, tmp_path):
+        dst = tmp_path / 'results' / 'results_0001.nc'
+        move = fvcom_cmd.gather._copy_file(src, dst, methods=(method, ))
+        assert not src.exists()
+        assert dst.read_bytes() == b'x' * 1000
+        assert move.path == Path('results_0001.nc')
+        assert move.nbytes == 1000
+        assert move.method == method
+
+    def test_hardlink_same_file_system(self, src, tmp_path):
+        dst = tmp_path / 'results' / 'results_0001.nc'
+        ino = src.stat().st_ino
+        move = fvcom_cmd.gather._copy_file(src, dst)
+        assert move.method == 'hardlink'
+        assert dst.stat().st_ino == ino
+
+    def test_checksum_while_copying(self, src, tmp_path):
+        dst = tmp_path / 'results' / 'results_0001.nc'
+        move = fvcom_cmd.gather._copy_file(
+            src, dst, methods=('sendfile', 'copy'), algorithm='sha256'
+        )
+        assert move.method == 'copy'
+        assert move.checksum == hashlib.sha256(b'x' * 1000).hexdigest()
+
+    def test_checksum_of_hardlink(self, src, tmp_path):
+        dst = tmp_path / 'results' / 'results_0001.nc'
+        move = fvcom_cmd.gather._copy_file(src, dst, algorithm='sha256')
+        assert move.method == 'hardlink'
+        assert move.checksum == hashlib.sha256(b'x' * 1000).hexdigest()
+
+    def test_fall_back_when_unsupported(self, src, tmp_path, monkeypatch):
+        monkeypatch.setitem(
+            fvcom_cmd.gather._COPIERS, 'reflink',
+            Mock(side_effect=OSError(errno.EOPNOTSUPP, 'not supported'))
+        )
+        dst = tmp_path / 'results' / 'results_0001.nc'
+        move = fvcom_cmd.gather._copy_file(
+            src, dst, methods=('reflink', 'copy')
+        )
+        assert move.method == 'copy'
+        assert dst.read_bytes() == b'x' * 1000
+        dev = tmp_path.stat().st_dev
+        assert fvcom_cmd.gather._unsupported == {('reflink', (dev, dev))}
+
+    def test_skip_unsupported(self, src, tmp_path, monkeypatch):
+        dev = tmp_path.stat().st_dev
+        fvcom_cmd.gather._unsupported.add(('copy_file_range', (dev, dev)))
+        move = fvcom_cmd.gather._copy_file(
+            src, tmp_path / 'results' / 'results_0001.nc',
+            methods=('copy_file_range', 'sendfile')
+        )
+        assert move.method == 'sendfile'
+
+    def test_other_error_raised(self, src, tmp_path, monkeypatch):
+        monkeypatch.setitem(
+            fvcom_cmd.gather._COPIERS, 'sendfile',
+            Mock(side_effect=OSError(errno.EIO, 'I/O error'))
+        )
+        with pytest.raises(OSError):
+            fvcom_cmd.gather._copy_file(
+                src, tmp_path / 'results' / 'results_0001.nc',
+                methods=('sendfile', 'copy')
+            )
+        assert src.exists()
+
+    def test_tree_copies(self, tmp_path):
+        src_dir = tmp_path / 'output'
+        (src_dir / 'station').mkdir(parents=True)
+        (src_dir / 'results_0001.nc').write_bytes(b'x')
+        (src_dir / 'station' / 'station_0001.nc').write_bytes(b'x')
+        (src_dir / 'latest.nc').symlink_to('results_0001.nc')
+        dst_dir = tmp_path / 'results' / 'output'
+        copies = fvcom_cmd.gather._tree_copies(src_dir, dst_dir)
+        assert sorted(copies) == [
+            (src_dir / 'results_0001.nc', dst_dir / 'results_0001.nc'),
+            (src_dir / 'station' / 'station_0001.nc',
+             dst_dir / 'station' / 'station_0001.nc'),
+        ]
+        assert (dst_dir / 'station').is_dir()
+        assert (dst_dir / 'latest.nc').is_symlink()
+
+
+class TestGatherReport:
+    """Unit tests for fvcom_cmd.gather.GatherReport class.
+    """
+
+    def test_summary(self):
+        report = fvcom_cmd.gather.GatherReport([
+            fvcom_cmd.gather.MoveStats(Path('namelist'), 100, 'rename', 0),
+            fvcom_cmd.gather.MoveStats(
+                Path('a.nc'), 3000000, 'copy_file_range', 1
+            ),
+            fvcom_cmd.gather.MoveStats(Path('b.nc'), 1000000, 'copy', 1),
+        ], wall_time=2)
+        assert report.copied_bytes == 4000000
+        assert report.summary() == (
+            'Gathered 1 entries by renaming and 2 files by copying 4.0 MB '
+            'in 2.0 s = 2.0 MB/s; 1 by copy_file_range, 1 by copy'
+        )
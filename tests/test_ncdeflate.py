@@ -0,0 +1,325 @@
+# Copyright 2013-2017 The Salish Sea MEOPAR Contributors
+# and The University of British Columbia
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""FVCOM-Cmd in-process netCDF deflation engine unit tests
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from fvcom_cmd import ncdeflate
+from fvcom_cmd.fspath import fspath
+
+netCDF4 = pytest.importorskip('netCDF4')
+pytest.importorskip('h5py')
+numpy = pytest.importorskip('numpy')
+
+
+@pytest.fixture
+def results_file(tmp_path):
+    filepath = tmp_path / 'results.nc'
+    with netCDF4.Dataset(
+        fspath(filepath), 'w', format='NETCDF3_64BIT_OFFSET'
+    ) as ds:
+        ds.title = 'FVCOM results'
+        ds.createDimension('time', None)
+        ds.createDimension('siglay', 3)
+        ds.createDimension('node', 50)
+        ds.createDimension('DateStrLen', 26)
+        time_ = ds.createVariable('time', 'f4', ('time', ))
+        time_.units = 'days since 1858-11-17 00:00:00'
+        temp = ds.createVariable(
+            'temp', 'f4', ('time', 'siglay', 'node'), fill_value=-999.
+        )
+        times = ds.createVariable('Times', 'S1', ('time', 'DateStrLen'))
+        ds.createVariable('iint', 'i4', ()).assignValue(42)
+        for t in range(4):
+            time_[t] = t
+            temp[t] = numpy.arange(150, dtype='f4').reshape(3, 50) + t
+            times[t] = numpy.array(list('2017-01-01T00:00:00.000000'), 'S1')
+    return filepath
+
+
+class TestChunkShape:
+    """Unit tests for chunk_shape() function.
+    """
+
+    def test_3d_record_variable(self):
+        chunks = ncdeflate.chunk_shape(
+            (24, 10, 100000), (True, False, False), 4
+        )
+        assert chunks == [1, 10, 100000]
+
+    def test_1d_record_variable(self):
+        chunks = ncdeflate.chunk_shape((24, ), (True, ), 4)
+        assert chunks == [24]
+
+    def test_large_static_variable(self):
+        chunks = ncdeflate.chunk_shape((10, 1000000), (False, False), 8)
+        assert chunks == [1, 524288]
+
+    def test_zero_length_record_dimension(self):
+        chunks = ncdeflate.chunk_shape((0, 10), (True, False), 4)
+        assert chunks == [1, 10]
+
+
+class TestDeflateFile:
+    """Unit tests for deflate_file() function.
+    """
+
+    @pytest.mark.parametrize('dfl_lvl', [0, 4])
+    def test_deflate_file(self, dfl_lvl, results_file, tmp_path):
+        dst = tmp_path / 'deflated.nc'
+        with ThreadPoolExecutor(2) as executor:
+            ncdeflate.deflate_file(
+                results_file, dst, dfl_lvl, executor=executor
+            )
+        with netCDF4.Dataset(fspath(results_file)) as src_ds, \
+                netCDF4.Dataset(fspath(dst)) as dst_ds:
+            assert dst_ds.data_model == 'NETCDF4'
+            assert dst_ds.title == 'FVCOM results'
+            assert len(dst_ds.dimensions['time']) == 4
+            assert dst_ds.dimensions['time'].isunlimited()
+            for name, src_var in src_ds.variables.items():
+                numpy.testing.assert_array_equal(
+                    dst_ds.variables[name][...], src_var[...]
+                )
+            assert dst_ds.variables['temp']._FillValue == -999.
+            assert dst_ds.variables['temp'].filters()['zlib'] == bool(dfl_lvl)
+
+    def test_pipeline_across_slabs(self, results_file, tmp_path, monkeypatch):
+        # One record per chunk and a window of 2 chunks make the chunks of
+        # successive records overlap on the pool and be written back in order
+        monkeypatch.setattr(ncdeflate, 'MIN_CHUNK_ELEMS', 1)
+        monkeypatch.setattr(ncdeflate, 'PIPELINE_BYTES', 1)
+        dst = tmp_path / 'deflated.nc'
+        with ThreadPoolExecutor(4) as executor:
+            ncdeflate.deflate_file(results_file, dst, 4, executor=executor)
+        with netCDF4.Dataset(fspath(results_file)) as src_ds, \
+                netCDF4.Dataset(fspath(dst)) as dst_ds:
+            assert dst_ds.variables['temp'].chunking()[0] == 1
+            numpy.testing.assert_array_equal(
+                dst_ds.variables['temp'][...], src_ds.variables['temp'][...]
+            )
+
+
+class TestIsDeflated:
+    """Unit tests for is_deflated() function.
+    """
+
+    def test_netcdf3_file(self, results_file):
+        assert not ncdeflate.is_deflated(results_file)
+
+    def test_deflated_file(self, results_file, tmp_path):
+        dst = tmp_path / 'deflated.nc'
+        ncdeflate.deflate_file(results_file, dst, 4)
+        assert ncdeflate.is_deflated(dst, 4)
+        assert not ncdeflate.is_deflated(dst, 1)
+
+    def test_quantized_file(self, results_file, tmp_path):
+        dst = tmp_path / 'deflated.nc'
+        ncdeflate.deflate_file(results_file, dst, 4)
+        assert not ncdeflate.is_deflated(dst, 4, quantize={'temp': 8})
+        ncdeflate.deflate_file(results_file, dst, 4, quantize={'temp': 8})
+        assert ncdeflate.is_deflated(dst, 4, quantize={'temp': 8})
+        assert not ncdeflate.is_deflated(dst, 4, quantize={'temp': 10})
+
+    def test_missing_file(self, tmp_path):
+        assert not ncdeflate.is_deflated(tmp_path / 'missing.nc')
+
+
+class TestVerifySample:
+    """Unit tests for verify_sample() function.
+    """
+
+    def test_match(self, results_file, tmp_path):
+        dst = tmp_path / 'deflated.nc'
+        ncdeflate.deflate_file(results_file, dst, 4)
+        assert ncdeflate.verify_sample(results_file, dst) == []
+
+    def test_quantized_match(self, results_file, tmp_path):
+        dst = tmp_path / 'deflated.nc'
+        ncdeflate.deflate_file(results_file, dst, 4, quantize={'temp': 4})
+        assert ncdeflate.verify_sample(results_file, dst) == []
+
+    def test_metadata_mismatch(self, results_file, tmp_path):
+        dst = tmp_path / 'deflated.nc'
+        ncdeflate.deflate_file(results_file, dst, 4)
+        with netCDF4.Dataset(fspath(dst), 'a') as ds:
+            ds.title = 'changed'
+            ds.variables['time'].delncattr('units')
+        assert ncdeflate.verify_sample(results_file, dst) == [
+            'global attribute title differs',
+            'time attribute units is missing',
+        ]
+
+    def test_value_mismatch(self, results_file, tmp_path):
+        dst = tmp_path / 'deflated.nc'
+        ncdeflate.deflate_file(results_file, dst, 4)
+        with netCDF4.Dataset(fspath(dst), 'a') as ds:
+            ds.variables['temp'][2, 1, 7] = 0
+        mismatches = ncdeflate.verify_sample(results_file, dst, n_samples=1)
+        assert mismatches == [
+            'values of temp differ in hyperslab [0:4, 0:3, 0:50]'
+        ]
+
+
+class TestBitRound:
+    """Unit tests for bit_round() and digits_to_bits() functions.
+    """
+
+    @pytest.mark.parametrize('keep_bits', [3, 10, 16])
+    def test_relative_error(self, keep_bits):
+        values = numpy.random.RandomState(42).normal(size=1000)
+        rounded = ncdeflate.bit_round(values.astype('f4'), keep_bits)
+        error = numpy.abs(rounded - values.astype('f4')) / numpy.abs(values)
+        assert error.max() <= 2.**-(keep_bits + 1)
+
+    def test_low_bits_zeroed(self):
+        rounded = ncdeflate.bit_round(numpy.array([1.1], 'f4'), 7)
+        assert rounded.view('u4')[0] & (2**16 - 1) == 0
+
+    def test_special_values_unchanged(self):
+        values = numpy.array([numpy.nan, numpy.inf, -999.1], 'f4')
+        rounded = ncdeflate.bit_round(values, 1, fill_value=values[2])
+        numpy.testing.assert_array_equal(rounded, values)
+
+    def test_largest_values_not_rounded_to_inf(self):
+        largest = numpy.finfo('f4').max
+        values = numpy.array([largest, -largest], 'f4')
+        rounded = ncdeflate.bit_round(values, 3)
+        numpy.testing.assert_array_equal(rounded, values)
+
+    def test_integers_unchanged(self):
+        values = numpy.arange(10, dtype='i4')
+        assert ncdeflate.bit_round(values, 1) is values
+
+    def test_digits_to_bits(self):
+        assert ncdeflate.digits_to_bits(3) == 10
+
+    def test_deflate_file_quantize(self, results_file, tmp_path):
+        dst = tmp_path / 'deflated.nc'
+        ncdeflate.deflate_file(results_file, dst, 4, quantize={'te*': 4})
+        with netCDF4.Dataset(fspath(dst)) as ds:
+            temp = ds.variables['temp']
+            assert temp.getncattr('quantization') == (
+                ncdeflate.QUANTIZATION_VAR
+            )
+            assert temp.quantization_nsb == 4
+            assert 'quantization' not in ds.variables['time'].ncattrs()
+            assert ds.variables[ncdeflate.QUANTIZATION_VAR].algorithm == (
+                'bitround'
+            )
+            numpy.testing.assert_array_equal(
+                temp[3, 0, 17:20], [20, 21, 22]
+            )
+            assert temp[3, 0, 30] == 32
+
+
+class TestCodecs:
+    """Unit tests for compression codecs other than zlib.
+    """
+
+    @pytest.mark.parametrize('codec', ['zstd', 'bzip2'])
+    def test_deflate_file(self, codec, results_file, tmp_path):
+        if not ncdeflate.codec_available(codec):
+            pytest.skip('{} filter not available'.format(codec))
+        dst = tmp_path / 'deflated.nc'
+        ncdeflate.deflate_file(results_file, dst, 3, codec=codec)
+        ncdeflate.check_readable(dst, codec, 3)
+        assert ncdeflate.is_deflated(dst, 3, codec)
+        assert not ncdeflate.is_deflated(dst, 3)
+        with netCDF4.Dataset(fspath(dst)) as ds:
+            temp = ds.variables['temp']
+            assert ncdeflate.filter_codec(temp.filters()) == codec
+            numpy.testing.assert_array_equal(temp[3, 0, :3], [3, 4, 5])
+
+    def test_check_readable_wrong_codec(self, results_file, tmp_path):
+        dst = tmp_path / 'deflated.nc'
+        ncdeflate.deflate_file(results_file, dst, 4)
+        with pytest.raises(ValueError):
+            ncdeflate.check_readable(dst, 'zstd', 4)
+
+    def test_unknown_codec_not_available(self):
+        assert ncdeflate.codec_available('zlib')
+        assert not ncdeflate.codec_available('lzma')
+
+    @pytest.mark.parametrize(
+        'codec, shuffle, expected', [
+            ('zstd', True, '32015,5'),
+            ('bzip2', True, '307,5'),
+            ('blosc_zstd', False, '32001,0,0,0,0,5,0,5'),
+        ]
+    )
+    def test_hdf5_filter_spec(self, codec, shuffle, expected):
+        assert ncdeflate.hdf5_filter_spec(codec, 5, shuffle) == expected
+
+
+class TestTune:
+    """Unit tests for tune(), save_profile(), and load_profile() functions.
+    """
+
+    def test_tune(self, results_file):
+        profile = ncdeflate.tune(results_file, n_samples=2)
+        assert sorted(profile['variables']) == ['Times', 'temp', 'time']
+        for settings in profile['variables'].values():
+            assert settings['dfl_lvl'] in ncdeflate.TUNE_LEVELS
+            assert settings['shuffle'] in (True, False)
+
+    def test_save_and_load_profile(self, results_file, tmp_path):
+        profile = ncdeflate.tune(results_file, n_samples=2)
+        profile_file = ncdeflate.save_profile(profile, tmp_path)
+        assert profile_file.parent == tmp_path
+        loaded = ncdeflate.load_profile(tmp_path, profile['signature'])
+        assert loaded == profile
+
+    def test_no_profile(self, tmp_path):
+        assert ncdeflate.load_profile(tmp_path, 'foo') is None
+
+    def test_deflate_file_applies_profile(self, results_file, tmp_path):
+        with netCDF4.Dataset(fspath(results_file)) as ds:
+            config_signature = ncdeflate.signature(ds)
+        profile = {
+            'signature': config_signature,
+            'source': fspath(results_file),
+            'variables': {
+                'temp': {'dfl_lvl': 1, 'shuffle': False},
+                'time': {'dfl_lvl': 0, 'shuffle': True},
+            },
+        }
+        ncdeflate.save_profile(profile, tmp_path)
+        dst = tmp_path / 'deflated.nc'
+        ncdeflate.deflate_file(results_file, dst, 4, profile_dir=tmp_path)
+        with netCDF4.Dataset(fspath(dst)) as ds:
+            assert ds.variables['temp'].filters()['complevel'] == 1
+            assert not ds.variables['temp'].filters()['shuffle']
+            assert not ds.variables['time'].filters()['zlib']
+            assert ds.variables['Times'].filters()['complevel'] == 4
+            numpy.testing.assert_array_equal(
+                ds.variables['temp'][3, 0, :3], [3, 4, 5]
+            )
+
+    def test_is_deflated_with_profile(self, results_file, tmp_path):
+        with netCDF4.Dataset(fspath(results_file)) as ds:
+            config_signature = ncdeflate.signature(ds)
+        profile = {
+            'signature': config_signature,
+            'source': fspath(results_file),
+            'variables': {'temp': {'dfl_lvl': 1, 'shuffle': False}},
+        }
+        ncdeflate.save_profile(profile, tmp_path)
+        dst = tmp_path / 'deflated.nc'
+        ncdeflate.deflate_file(results_file, dst, 4, profile_dir=tmp_path)
+        assert ncdeflate.is_deflated(dst, 4, profile_dir=tmp_path)
+        assert not ncdeflate.is_deflated(dst, 4)
@@ -0,0 +1,151 @@
+# Copyright 2013-2017 The Salish Sea MEOPAR Contributors
+# and The University of British Columbia
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""FVCOM-Cmd small file packing unit tests
+"""
+try:
+    from pathlib import Path
+except ImportError:
+    # Python 2.7
+    from pathlib2 import Path
+import zipfile
+
+import pytest
+
+import fvcom_cmd.ncdeflate
+import fvcom_cmd.pack
+
+
+@pytest.fixture
+def run_dir(tmp_path):
+    run_dir = tmp_path / 'run'
+    (run_dir / 'output').mkdir(parents=True)
+    (run_dir / 'namelist').write_text(u'&NML_CASE /')
+    (run_dir / 'fvcom.log').write_text(u'log')
+    (run_dir / 'output' / 'station_0001.nc').write_bytes(b'CDF' * 10)
+    (run_dir / 'output' / 'results_0001.nc').write_bytes(b'x' * 100)
+    (run_dir / 'output' / '.fvc_deflated').write_text(u'{}')
+    (run_dir / 'grid.dat').symlink_to(tmp_path / 'grid.dat')
+    (tmp_path / 'results').mkdir()
+    return run_dir
+
+
+class TestSmallFiles:
+    """Unit tests for fvcom_cmd.pack.small_files() function.
+    """
+
+    def test_small_files(self, run_dir):
+        paths = fvcom_cmd.pack.small_files(run_dir, threshold=100)
+        assert paths == [
+            Path('fvcom.log'),
+            Path('namelist'),
+            Path('output/station_0001.nc'),
+        ]
+
+    def test_exclude_dir(self, run_dir):
+        paths = fvcom_cmd.pack.small_files(
+            run_dir, threshold=100, exclude={run_dir / 'output'}
+        )
+        assert paths == [Path('fvcom.log'), Path('namelist')]
+
+
+class TestPack:
+    """Unit tests for fvcom_cmd.pack.pack() function.
+    """
+
+    def test_pack(self, run_dir, tmp_path):
+        (run_dir / 'output' / 'grid.nc').write_bytes(
+            fvcom_cmd.ncdeflate.HDF5_SIGNATURE + b'x'
+        )
+        paths = [
+            Path('namelist'),
+            Path('output/grid.nc'),
+            Path('output/station_0001.nc'),
+        ]
+        report = fvcom_cmd.pack.pack(run_dir, paths, tmp_path / 'results')
+        assert report.paths == paths
+        assert report.nbytes == 50
+        assert not (run_dir / 'namelist').exists()
+        assert not (run_dir / 'output' / 'station_0001.nc').exists()
+        archive = tmp_path / 'results' / 'fvc_packed.zip'
+        with zipfile.ZipFile(str(archive)) as zf:
+            compression = {
+                info.filename: info.compress_type for info in zf.infolist()
+            }
+        assert compression == {
+            'namelist': zipfile.ZIP_DEFLATED,
+            'output/grid.nc': zipfile.ZIP_STORED,
+            'output/station_0001.nc': zipfile.ZIP_DEFLATED,
+        }
+        assert not (tmp_path / 'results' / 'fvc_packed.zip.tmp').exists()
+
+    def test_add_to_archive(self, run_dir, tmp_path):
+        results_dir = tmp_path / 'results'
+        fvcom_cmd.pack.pack(run_dir, [Path('namelist')], results_dir)
+        fvcom_cmd.pack.pack(run_dir, [Path('fvcom.log')], results_dir)
+        with fvcom_cmd.pack.PackedFiles(results_dir) as packed:
+            assert packed.paths() == [Path('namelist'), Path('fvcom.log')]
+
+    def test_already_packed_deleted(self, run_dir, tmp_path):
+        results_dir = tmp_path / 'results'
+        (tmp_path / 'namelist').write_text(u'&NML_CASE /')
+        fvcom_cmd.pack.pack(tmp_path, [Path('namelist')], results_dir)
+        mtime = (results_dir / 'fvc_packed.zip').stat().st_mtime_ns
+        report = fvcom_cmd.pack.pack(run_dir, [Path('namelist')], results_dir)
+        assert report.paths == [Path('namelist')]
+        assert not (run_dir / 'namelist').exists()
+        assert (results_dir / 'fvc_packed.zip').stat().st_mtime_ns == mtime
+
+    def test_different_member_not_packed(self, run_dir, tmp_path):
+        results_dir = tmp_path / 'results'
+        (tmp_path / 'namelist').write_text(u'&NML_CASE name /')
+        fvcom_cmd.pack.pack(tmp_path, [Path('namelist')], results_dir)
+        report = fvcom_cmd.pack.pack(run_dir, [Path('namelist')], results_dir)
+        assert report.paths == []
+        assert (run_dir / 'namelist').exists()
+
+
+class TestPackedFiles:
+    """Unit tests for fvcom_cmd.pack.PackedFiles class.
+    """
+
+    @pytest.fixture
+    def results_dir(self, run_dir, tmp_path):
+        results_dir = tmp_path / 'results'
+        fvcom_cmd.pack.pack(
+            run_dir,
+            [Path('namelist'), Path('output/station_0001.nc')],
+            results_dir
+        )
+        return results_dir
+
+    def test_read(self, results_dir):
+        with fvcom_cmd.pack.PackedFiles(results_dir) as packed:
+            assert packed.read('output/station_0001.nc') == b'CDF' * 10
+            assert packed.read_text(Path('namelist')) == u'&NML_CASE /'
+
+    def test_open(self, results_dir):
+        with fvcom_cmd.pack.PackedFiles(results_dir) as packed:
+            with packed.open('output/station_0001.nc') as f:
+                assert f.read(3) == b'CDF'
+
+    def test_contains(self, results_dir):
+        with fvcom_cmd.pack.PackedFiles(results_dir) as packed:
+            assert Path('namelist') in packed
+            assert 'fvcom.log' not in packed
+
+    def test_missing_member(self, results_dir):
+        with fvcom_cmd.pack.PackedFiles(results_dir) as packed:
+            with pytest.raises(KeyError):
+                packed.read('fvcom.log')
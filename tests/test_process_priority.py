@@ -0,0 +1,108 @@
+# Copyright 2013-2017 The Salish Sea MEOPAR Contributors
+# and The University of British Columbia
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""FVCOM-Cmd post-processing process priority unit tests
+"""
+import argparse
+try:
+    from unittest.mock import patch
+except ImportError:
+    # Python 2.7
+    from mock import patch
+
+import pytest
+
+from fvcom_cmd import process_priority
+from fvcom_cmd.process_priority import ProcessPriority
+
+
+class TestArguments:
+    """Unit tests for the --nice, --ionice, and --cpus command-line options.
+    """
+
+    def test_parsed_args(self):
+        parser = argparse.ArgumentParser()
+        process_priority.add_arguments(parser)
+        parsed_args = parser.parse_args(
+            ['--nice', '10', '--ionice', 'best-effort:7', '--cpus', '36-38,0']
+        )
+        assert ProcessPriority.from_parsed_args(parsed_args) == (
+            ProcessPriority(10, 'best-effort', 7, {0, 36, 37, 38})
+        )
+
+    def test_defaults(self):
+        parser = argparse.ArgumentParser()
+        process_priority.add_arguments(parser)
+        parsed_args = parser.parse_args([])
+        assert ProcessPriority.from_parsed_args(parsed_args) == (
+            ProcessPriority()
+        )
+
+    @pytest.mark.parametrize(
+        'args', [
+            ['--ionice', 'lazy'],
+            ['--ionice', 'idle:8'],
+            ['--cpus', '0-x'],
+        ]
+    )
+    def test_bad_args(self, args):
+        parser = argparse.ArgumentParser()
+        process_priority.add_arguments(parser)
+        with pytest.raises(SystemExit):
+            parser.parse_args(args)
+
+
+class TestProcessPriority:
+    """Unit tests for ProcessPriority class.
+    """
+
+    def test_from_run_desc(self):
+        run_desc = {
+            'post-processing': {
+                'nice': 10,
+                'ionice': 'idle',
+                'cpus': [38, 39],
+            }
+        }
+        priority = ProcessPriority.from_run_desc(run_desc)
+        assert priority == ProcessPriority(10, 'idle', None, {38, 39})
+
+    def test_from_run_desc_without_section(self):
+        assert ProcessPriority.from_run_desc({}) == ProcessPriority()
+
+    def test_cli_args(self):
+        priority = ProcessPriority(10, 'best-effort', 7, {3, 2})
+        assert priority.cli_args() == [
+            '--nice', '10', '--ionice', 'best-effort:7', '--cpus', '2,3'
+        ]
+
+    @patch('fvcom_cmd.process_priority.os.sched_setaffinity', create=True)
+    @patch('fvcom_cmd.process_priority.subprocess.check_output')
+    @patch('fvcom_cmd.process_priority.os.nice', return_value=0)
+    def test_apply(self, m_nice, m_check_output, m_setaffinity):
+        ProcessPriority(10, 'idle', 7, {2, 3}).apply()
+        m_nice.assert_called_with(10)
+        cmd = m_check_output.call_args[0][0]
+        assert cmd[:3] == ['ionice', '-c', '3']
+        assert '-n' not in cmd
+        m_setaffinity.assert_called_once_with(0, {2, 3})
+
+    @patch('fvcom_cmd.process_priority.logger')
+    @patch(
+        'fvcom_cmd.process_priority.subprocess.check_output',
+        side_effect=OSError('ionice not found')
+    )
+    def test_apply_missing_ionice(self, m_check_output, m_logger):
+        ProcessPriority(ionice='idle').apply()
+        assert m_logger.warning.called
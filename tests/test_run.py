@@ -36,6 +36,7 @@ except ImportError:
 import cliff.app
 import pytest
 
+import fvcom_cmd.run
 import nemo_cmd.run
 
 
@@ -273,3 +274,93 @@ class TestCleanup:
         expected = expected.splitlines()
         for i, line in enumerate(script.splitlines()):
             assert line.strip() == expected[i].strip()
+
+
+class TestBuildBatchScript:
+    """Unit tests for fvcom_cmd.run._build_batch_script() function.
+    """
+
+    @pytest.fixture
+    def run_desc(self):
+        return {
+            'run_id': 'test',
+            'casename': 'estuary',
+            'nproc': 4,
+            'SGE resources': ['res_cpus=4'],
+        }
+
+    def _script(self, run_desc):
+        with patch('fvcom_cmd.run.lib.load_run_desc', return_value=run_desc):
+            return fvcom_cmd.run._build_batch_script(
+                Path('test.yaml'), Path('results'), Path('tmp_run_dir')
+            )
+
+    def test_post_processing_defaults(self, run_desc):
+        script = self._script(run_desc)
+        assert (
+            u'DEFLATE="${HOME}/.local/bin/fvc deflate"\n'
+            u'GATHER="${HOME}/.local/bin/fvc gather"\n'
+        ) in script
+        assert u'--watch' not in script
+        assert u'GATHER_PID' not in script
+        assert u'${GATHER} ${RESULTS_DIR} --debug\n' in script
+
+    def test_priority_args(self, run_desc):
+        run_desc['post-processing'] = {
+            'nice': 10,
+            'ionice': 'idle',
+            'cpus': '0-1',
+        }
+        script = self._script(run_desc)
+        priority_args = u'--nice 10 --ionice idle --cpus 0,1'
+        assert u'DEFLATE="${{HOME}}/.local/bin/fvc deflate {}"\n'.format(
+            priority_args
+        ) in script
+        assert u'GATHER="${{HOME}}/.local/bin/fvc gather {}"\n'.format(
+            priority_args
+        ) in script
+
+    def test_gather_during_run(self, run_desc):
+        run_desc['post-processing'] = {'gather during run': 'output'}
+        script = self._script(run_desc)
+        assert (
+            u'mkdir -p ${RESULTS_DIR}\n'
+            u'\n'
+            u'mkdir -p output\n'
+            u'${GATHER} ${RESULTS_DIR} --watch output --debug &\n'
+            u'GATHER_PID=$!\n'
+            u'\n'
+            u'time mpirun -np 4 '
+        ) in script
+        assert (
+            u'MPIRUN_EXIT_CODE=$?\n'
+            u'echo "Ended run at $(date)"\n'
+            u'\n'
+            u'kill -TERM ${GATHER_PID}\n'
+            u'wait ${GATHER_PID}\n'
+            u'echo "Results gathering started at $(date)"\n'
+            u'${GATHER} ${RESULTS_DIR} --debug\n'
+        ) in script
+
+    def test_gather_during_run_quoted_dir(self, run_desc):
+        run_desc['post-processing'] = {
+            'gather during run': "my output; rm -rf $HOME's"
+        }
+        script = self._script(run_desc)
+        watch_dir = "'my output; rm -rf $HOME'\"'\"'s'"
+        assert (
+            u'mkdir -p {0}\n'
+            u'${{GATHER}} ${{RESULTS_DIR}} --watch {0} --debug &\n'.
+            format(watch_dir)
+        ) in script
+
+    def test_gather_bandwidth(self, run_desc):
+        run_desc['post-processing'] = {
+            'gather during run': 'output',
+            'gather bandwidth': 50,
+        }
+        script = self._script(run_desc)
+        assert (
+            u'${GATHER} ${RESULTS_DIR} --watch output --bwlimit 50 --debug &\n'
+        ) in script
+        assert u'${GATHER} ${RESULTS_DIR} --bwlimit 50 --debug\n' in script
@@ -0,0 +1,154 @@
+# Copyright 2013-2017 The Salish Sea MEOPAR Contributors
+# and The University of British Columbia
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""FVCOM-Cmd verify sub-command plug-in unit tests
+"""
+import hashlib
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    # Python 2.7
+    from mock import Mock, patch
+
+import cliff.app
+import pytest
+
+import fvcom_cmd.verify
+
+
+@pytest.fixture
+def verify_cmd():
+    return fvcom_cmd.verify.Verify(Mock(spec=cliff.app.App), [])
+
+
+@pytest.fixture
+def results_dir(tmp_path):
+    (tmp_path / 'output').mkdir()
+    (tmp_path / 'output' / 'results_0001.nc').write_bytes(b'x' * 1000)
+    (tmp_path / 'output' / '.fvc_deflated').write_bytes(b'{}\n')
+    (tmp_path / 'namelist').write_bytes(b'&NML_CASE /')
+    (tmp_path / 'grid.nc').symlink_to(tmp_path / 'namelist')
+    return tmp_path
+
+
+class TestParser:
+    """Unit tests for `fvc verify` sub-command command-line parser.
+    """
+
+    def test_parsed_args_defaults(self, verify_cmd):
+        parser = verify_cmd.get_parser('fvc verify')
+        parsed_args = parser.parse_args(['results/'])
+        assert parsed_args.jobs == fvcom_cmd.verify.VERIFY_THREADS
+
+
+class TestChecksumAlgorithm:
+    """Unit tests for checksum_algorithm() and new_hash() functions.
+    """
+
+    def test_hashlib_fallback(self):
+        with patch.object(fvcom_cmd.verify, 'xxhash', None):
+            algorithm = fvcom_cmd.verify.checksum_algorithm()
+        assert algorithm == 'blake2b'
+        hasher = fvcom_cmd.verify.new_hash(algorithm)
+        hasher.update(b'x')
+        assert hasher.hexdigest() == hashlib.blake2b(b'x').hexdigest()
+
+    def test_xxhash_unavailable(self):
+        with patch.object(fvcom_cmd.verify, 'xxhash', None):
+            with pytest.raises(ValueError):
+                fvcom_cmd.verify.new_hash('xxh3_128')
+
+
+class TestWriteManifest:
+    """Unit tests for write_manifest() function.
+    """
+
+    def test_manifest(self, results_dir):
+        manifest = fvcom_cmd.verify.write_manifest(results_dir, 'blake2b')
+        assert [entry.path for entry in manifest.entries] == [
+            'namelist', 'output/results_0001.nc'
+        ]
+        assert manifest.entries[1].size == 1000
+        assert manifest.entries[1].checksum == (
+            hashlib.blake2b(b'x' * 1000).hexdigest()
+        )
+        assert fvcom_cmd.verify.Manifest.read(results_dir) == manifest
+
+    def test_precomputed_checksum_used(self, results_dir):
+        with patch.object(fvcom_cmd.verify, 'file_checksum') as m_checksum:
+            m_checksum.return_value = 'read'
+            manifest = fvcom_cmd.verify.write_manifest(
+                results_dir, 'blake2b',
+                {results_dir.joinpath('namelist').relative_to(results_dir):
+                 'streamed'}
+            )
+        assert [entry.checksum for entry in manifest.entries] == [
+            'streamed', 'read'
+        ]
+
+    def test_unchanged_files_not_reread(self, results_dir):
+        fvcom_cmd.verify.write_manifest(results_dir, 'blake2b')
+        (results_dir / 'restart.nc').write_bytes(b'y')
+        with patch.object(fvcom_cmd.verify, 'file_checksum') as m_checksum:
+            m_checksum.return_value = 'read'
+            fvcom_cmd.verify.write_manifest(results_dir, 'blake2b')
+        m_checksum.assert_called_once_with(
+            results_dir / 'restart.nc', 'blake2b'
+        )
+
+
+class TestVerify:
+    """Unit tests for verify() function.
+    """
+
+    def test_unchanged(self, results_dir):
+        fvcom_cmd.verify.write_manifest(results_dir, 'blake2b')
+        report = fvcom_cmd.verify.verify(results_dir, max_threads=2)
+        assert report.n_files == 2
+        assert report.nbytes == 1011
+        assert report.failed == []
+        assert report.unlisted == []
+
+    def test_bookkeeping_files_ignored(self, results_dir):
+        fvcom_cmd.verify.write_manifest(results_dir, 'blake2b')
+        (results_dir / 'output' / '.fvc_deflated').write_bytes(b'{"a": 4}\n')
+        report = fvcom_cmd.verify.verify(results_dir)
+        assert report.failed == []
+        assert report.unlisted == []
+
+    def test_problems(self, results_dir):
+        fvcom_cmd.verify.write_manifest(results_dir, 'blake2b')
+        (results_dir / 'output' / 'results_0001.nc').write_bytes(b'y' * 1000)
+        (results_dir / 'namelist').unlink()
+        (results_dir / 'restart.nc').write_bytes(b'y')
+        report = fvcom_cmd.verify.verify(results_dir)
+        assert report.problems == {
+            'namelist': 'missing',
+            'output/results_0001.nc': 'checksum does not match',
+        }
+        assert report.unlisted == ['restart.nc']
+
+    def test_no_manifest(self, tmp_path):
+        with pytest.raises(IOError):
+            fvcom_cmd.verify.verify(tmp_path)
+
+    def test_take_action_exit_status(self, verify_cmd, results_dir):
+        fvcom_cmd.verify.write_manifest(results_dir, 'blake2b')
+        (results_dir / 'namelist').write_bytes(b'changed')
+        parsed_args = verify_cmd.get_parser('fvc verify').parse_args(
+            [str(results_dir)]
+        )
+        with pytest.raises(SystemExit) as exc_info:
+            verify_cmd.take_action(parsed_args)
+        assert exc_info.value.code == 1